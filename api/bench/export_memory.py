@@ -0,0 +1,93 @@
+"""
+ストリーミング ZIP エクスポートのピークメモリ (RSS) の計測
+
+    cd api && python -m bench.export_memory --files 10 --file-mb 20
+
+添付ファイルの合計サイズを増やしてもピーク RSS がほぼ変わらないことを確認する
+"""
+
+import argparse
+import os
+import resource
+import tempfile
+import time
+
+from src.database import init_db, get_connection, close_pool
+from src.services.export import iter_export_zip
+
+
+def peak_rss_mb():
+    # Linux の ru_maxrss は KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def build_data(upload_dir, n_files, file_mb, n_notes):
+
+    conn = get_connection()
+    cur = conn.cursor()
+
+    cur.execute(
+        "INSERT INTO users (username, password, role, created_at) VALUES ('bench', '-', 'user', '2025-01-01')"
+    )
+    user_id = cur.lastrowid
+
+    ts = "2025-01-01T00:00:00"
+    cur.executemany(
+        "INSERT INTO notes (user_id, title, content, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+        [(user_id, f"note {i}", "本文\n" * 200, ts, ts) for i in range(n_notes)],
+    )
+
+    cur.execute("SELECT id FROM notes WHERE user_id=? ORDER BY id LIMIT ?", (user_id, n_files))
+    note_ids = [row[0] for row in cur.fetchall()]
+
+    chunk = os.urandom(1024 * 1024)
+    for i, note_id in enumerate(note_ids):
+        stored = f"bench_{i}.bin"
+        with open(os.path.join(upload_dir, stored), "wb") as f:
+            for _ in range(file_mb):
+                f.write(chunk)
+        cur.execute(
+            "INSERT INTO attachments (note_id, filename_original, filename_stored, uploaded_at) VALUES (?, ?, ?, ?)",
+            (note_id, f"video_{i}.bin", stored, ts),
+        )
+
+    conn.commit()
+    conn.close()
+    return user_id
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--file-mb", type=int, default=20)
+    parser.add_argument("--notes", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        upload_dir = os.path.join(tmp, "files")
+        os.makedirs(upload_dir)
+
+        init_db({"database": {"type": "sqlite", "path": os.path.join(tmp, "bench.db")}})
+        user_id = build_data(upload_dir, args.files, args.file_mb, args.notes)
+
+        before = peak_rss_mb()
+
+        total = 0
+        t0 = time.perf_counter()
+        for data in iter_export_zip(user_id, upload_dir):
+            total += len(data)
+        elapsed = time.perf_counter() - t0
+
+        after = peak_rss_mb()
+
+        print(f"attachments: {args.files} x {args.file_mb}MB, notes: {args.notes}")
+        print(f"zip size:    {total / 1024 / 1024:.1f}MB in {elapsed:.1f}s")
+        print(f"peak RSS:    {before:.1f}MB before export, {after:.1f}MB after (+{after - before:.1f}MB)")
+
+        close_pool()
+
+
+if __name__ == "__main__":
+    main()
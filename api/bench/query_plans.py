@@ -0,0 +1,263 @@
+"""
+主要なクエリの実行計画 (EXPLAIN QUERY PLAN) の確認
+
+    cd api && python -m bench.query_plans [-v]
+
+ルーター・サービスの SQL を同じ形で並べ、インデックスを使わずに表全体を走査する (SCAN) ものがあれば
+終了コード 1 で終わる。クエリやスキーマ (database.MIGRATIONS) を変えたらここも合わせて更新すること
+"""
+
+import argparse
+import os
+import re
+import sys
+import tempfile
+
+from src.database import init_db, get_connection, close_pool, SCHEMA_VERSION
+from src.utils import TRASH_TAG_NAME, note_hashes
+
+U = 1           # user_id
+N = 1           # note_id
+A = 1           # attachment_id
+
+# (名前, SQL, パラメータ, 走査を許す表の別名)
+# 許しているのは件数が少ない・全件が必要なものだけ
+QUERIES = [
+    # ---- notes ----
+    ("notes: list", """
+        SELECT n.*, GROUP_CONCAT(t.name, ',') AS tags
+        FROM (
+            SELECT n.* FROM notes n
+            WHERE n.user_id = ?
+            ORDER BY n.is_important DESC, n.updated_at DESC, n.id DESC
+            LIMIT ?
+        ) n
+        LEFT JOIN note_tags nt ON n.id = nt.note_id
+        LEFT JOIN tags t ON nt.tag_id = t.id
+        GROUP BY n.id
+        ORDER BY n.is_important DESC, n.updated_at DESC, n.id DESC
+    """, (U, 51), set()),
+    ("notes: list by tag with cursor", """
+        SELECT n.* FROM notes n
+        WHERE n.user_id = ?
+          AND EXISTS (
+              SELECT 1 FROM note_tags nt1 JOIN tags t1 ON nt1.tag_id = t1.id
+              WHERE nt1.note_id = n.id AND t1.name = ?
+          )
+          AND (n.is_important, n.updated_at, n.id) < (?, ?, ?)
+        ORDER BY n.is_important DESC, n.updated_at DESC, n.id DESC
+        LIMIT ?
+    """, (U, "WORK", 1, "2100-01-01", 1 << 40, 51), set()),
+    ("notes: get", """
+        SELECT n.*, GROUP_CONCAT(t.name, ',') AS tags
+        FROM notes n
+        LEFT JOIN note_tags nt ON n.id = nt.note_id
+        LEFT JOIN tags t ON nt.tag_id = t.id
+        WHERE n.id = ? AND n.user_id = ?
+        GROUP BY n.id
+    """, (N, U), set()),
+    ("notes: attachments of notes", """
+        SELECT id, note_id, filename_original, filename_stored
+        FROM attachments WHERE note_id IN (?, ?, ?) ORDER BY id
+    """, (1, 2, 3), set()),
+    ("notes: owner check", "SELECT id FROM notes WHERE id=? AND user_id=?", (N, U), set()),
+    ("notes: delete attachments", "DELETE FROM attachments WHERE note_id IN (?, ?)", (1, 2), set()),
+    ("notes: delete", "DELETE FROM notes WHERE user_id=? AND id IN (?, ?)", (U, 1, 2), set()),
+    # ノート削除の外部キー (ON DELETE CASCADE) が内部で行う検索
+    ("cascade: note_tags of note", "SELECT 1 FROM note_tags WHERE note_id = ?", (N,), set()),
+    ("cascade: note_tags of tag", "SELECT 1 FROM note_tags WHERE tag_id = ?", (1,), set()),
+    ("cascade: attachments of note", "SELECT 1 FROM attachments WHERE note_id = ?", (N,), set()),
+
+    # ---- tags ----
+    ("tags: note tags", """
+        SELECT t.name FROM tags t JOIN note_tags nt ON t.id = nt.tag_id WHERE nt.note_id=?
+    """, (N,), set()),
+    ("tags: tag counts", """
+        SELECT t.name, c.note_count
+        FROM user_tag_counts c JOIN tags t ON t.id = c.tag_id
+        WHERE c.user_id = ? AND c.note_count > 0
+        ORDER BY t.name COLLATE NOCASE
+    """, (U,), set()),
+    ("tag counts: trigger update", """
+        UPDATE user_tag_counts SET note_count = note_count - 1
+        WHERE user_id = (SELECT user_id FROM notes WHERE id = ? AND trashed_at IS NULL) AND tag_id = ?
+    """, (N, 1), set()),
+    ("tag counts: trashed note", """
+        UPDATE user_tag_counts SET note_count = note_count - 1
+        WHERE user_id = ? AND tag_id IN (SELECT tag_id FROM note_tags WHERE note_id = ?)
+    """, (U, N), set()),
+    ("trash: list", """
+        SELECT n.* FROM notes n
+        WHERE n.user_id = ? AND n.trashed_at IS NOT NULL
+        ORDER BY n.is_important DESC, n.updated_at DESC, n.id DESC
+        LIMIT ?
+    """, (U, 51), set()),
+    ("trash: empty", "SELECT id FROM notes WHERE user_id = ? AND trashed_at IS NOT NULL", (U,), set()),
+    ("trash: trigger tag lookup", "SELECT upper(name) FROM tags WHERE id = ?", (1,), set()),
+
+    # ---- attachments ----
+    ("attachments: owned attachment", """
+        SELECT a.filename_original, a.filename_stored, a.sha256, a.mime_type
+        FROM attachments a JOIN notes n ON n.id = a.note_id
+        WHERE a.id = ? AND n.user_id = ?
+    """, (A, U), set()),
+    ("attachments: blob by sha256", "SELECT filename_stored FROM attachment_blobs WHERE sha256=?", ("x",), set()),
+    ("files: alias", "SELECT filename_stored FROM attachment_aliases WHERE filename=?", ("x",), set()),
+
+    # ---- sync ----
+    ("sync: full", """
+        SELECT n.*, GROUP_CONCAT(t.name, ',') AS tags
+        FROM notes n
+        LEFT JOIN note_tags nt ON n.id = nt.note_id
+        LEFT JOIN tags t ON nt.tag_id = t.id
+        WHERE n.user_id = ?
+        GROUP BY n.id
+    """, (U,), set()),
+    ("sync: changes", """
+        SELECT n.*, GROUP_CONCAT(t.name, ',') AS tags
+        FROM note_changes c
+        JOIN notes n ON n.id = c.note_id
+        LEFT JOIN note_tags nt ON n.id = nt.note_id
+        LEFT JOIN tags t ON nt.tag_id = t.id
+        WHERE c.user_id = ? AND c.seq > ? AND c.deleted = 0
+        GROUP BY n.id
+    """, (U, 0), set()),
+
+    # ---- import / export ----
+    ("import: existing titles", "SELECT title, note_hash FROM notes WHERE user_id=?", (U,), set()),
+    ("import: title exists", "SELECT 1 FROM notes WHERE user_id=? AND title=?", (U, "t"), set()),
+    ("export: notes", """
+        SELECT id, title, content, is_important, updated_at FROM notes WHERE user_id=? ORDER BY id
+    """, (U,), set()),
+    ("tombstones: exists", """
+        SELECT EXISTS (SELECT 1 FROM note_tombstones WHERE user_id = ? AND note_hash = ?)
+            OR EXISTS (SELECT 1 FROM note_tombstones WHERE user_id = ? AND content_hash = ?)
+    """, (U, "x", U, "y"), set()),
+    ("tombstones: copy from notes", """
+        INSERT INTO note_tombstones (user_id, note_hash, content_hash, source_note_id, deleted_at)
+        SELECT user_id, note_hash, content_hash, id, ?
+        FROM notes
+        WHERE id IN (?, ?) AND user_id = ?
+        ON CONFLICT(user_id, note_hash) DO UPDATE SET
+            content_hash = excluded.content_hash,
+            source_note_id = excluded.source_note_id,
+            deleted_at = excluded.deleted_at
+        RETURNING user_id, note_hash, content_hash
+    """, ("2025-01-01", 1, 2, U), set()),
+    ("tombstones: trashed notes", """
+        SELECT user_id, note_hash, content_hash, id FROM notes WHERE trashed_at IS NOT NULL
+    """, (), set()),
+    ("tombstones: load filter", "SELECT note_hash, content_hash FROM note_tombstones WHERE user_id = ?", (U,), set()),
+    ("tombstones: expired", """
+        SELECT id FROM note_tombstones WHERE deleted_at < ? ORDER BY deleted_at LIMIT ?
+    """, ("2025-01-01", 500), set()),
+
+    # ---- maintenance / cleanup ----
+    ("maintenance: expired trash of user", """
+        SELECT id, user_id FROM notes
+        WHERE user_id = ? AND trashed_at < strftime('%Y-%m-%dT%H:%M:%S', 'now', '-30 days')
+        LIMIT ?
+    """, (U, 500), set()),
+    ("maintenance: expired trash", """
+        SELECT id, user_id FROM notes
+        WHERE trashed_at < strftime('%Y-%m-%dT%H:%M:%S', 'now', '-30 days')
+        LIMIT ?
+    """, (500,), set()),
+    ("maintenance: unused tags (given)", """
+        DELETE FROM tags WHERE id IN (?, ?)
+          AND NOT EXISTS (SELECT 1 FROM note_tags nt WHERE nt.tag_id = tags.id)
+    """, (1, 2), set()),
+    ("file_cleanup: referenced", """
+        SELECT EXISTS (SELECT 1 FROM attachments WHERE filename_stored = ?)
+            OR EXISTS (SELECT 1 FROM attachment_blobs WHERE filename_stored = ?)
+    """, ("x", "x"), set()),
+    ("file_cleanup: due", """
+        SELECT id, filename_stored, thumbnail_key, attempts FROM file_deletions
+        WHERE next_attempt_at <= datetime('now') ORDER BY id LIMIT ?
+    """, (100,), {"file_deletions"}),
+]
+
+SCAN_RE = re.compile(r"^SCAN (\S+)")
+
+
+def full_scans(cur, sql, params):
+    """インデックスを使わない SCAN の対象 (別名) と実行計画を返す"""
+
+    cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+    plan = [row["detail"] for row in cur.fetchall()]
+
+    # サブクエリ (CO-ROUTINE / MATERIALIZE) の結果の走査は対象外
+    subqueries = {d.split()[-1] for d in plan if d.startswith(("CO-ROUTINE", "MATERIALIZE"))}
+
+    scans = []
+    for detail in plan:
+        m = SCAN_RE.match(detail)
+        if not m or "INDEX" in detail or "VIRTUAL TABLE" in detail or "CONSTANT ROW" in detail:
+            continue
+        if m.group(1) in subqueries:
+            continue
+        scans.append(m.group(1))
+
+    return scans, plan
+
+
+def seed(cur):
+    # 空の表だと実行計画が変わることがあるので最低限の行を入れる (行がある DB でも使えるよう OR IGNORE)
+    cur.execute("INSERT OR IGNORE INTO users (username, password, created_at) VALUES ('plan', '-', '2025-01-01')")
+    for i in range(20):
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO notes (user_id, title, content, note_hash, content_hash, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (U, f"t{i}", f"c{i}", *note_hashes(f"t{i}", f"c{i}"), "2025-01-01", "2025-01-01"),
+        )
+    cur.execute("INSERT OR IGNORE INTO tags (name) VALUES ('WORK'), (?)", (TRASH_TAG_NAME,))
+    cur.execute("""
+        INSERT OR IGNORE INTO note_tags (note_id, tag_id)
+        SELECT id, (SELECT id FROM tags WHERE name = 'WORK') FROM notes WHERE user_id = ?
+    """, (U,))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every plan")
+    args = parser.parse_args()
+
+    failures = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        init_db({"database": {"type": "sqlite", "path": os.path.join(tmp, "plans.db")}})
+
+        conn = get_connection()
+        cur = conn.cursor()
+
+        cur.execute("PRAGMA user_version")
+        print(f"schema version {cur.fetchone()[0]} (expected {SCHEMA_VERSION})")
+
+        seed(cur)
+
+        for name, sql, params, allowed in QUERIES:
+            scans, plan = full_scans(cur, sql, params)
+            bad = [s for s in scans if s not in allowed]
+            status = "FAIL" if bad else "ok"
+            print(f"{status:<5} {name}" + (f"  (full scan: {', '.join(bad)})" if bad else ""))
+            if bad or args.verbose:
+                for detail in plan:
+                    print(f"        {detail}")
+            if bad:
+                failures.append(name)
+
+        conn.rollback()
+        conn.close()
+        close_pool()
+
+    if failures:
+        print(f"{len(failures)} queries regressed to a full scan")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+trigram 索引と LIKE '%...%' の検索速度の比較
+
+    cd api && python -m bench.search_trigram --notes 50000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from src.database import init_db, get_connection, close_pool
+from src.services.search import choose_index, search_notes
+
+# ひらがな・カタカナ・常用漢字あたりからランダムな語彙を作る
+KANA = [chr(c) for c in range(0x3042, 0x3094)] + [chr(c) for c in range(0x30A2, 0x30F4)]
+KANJI = [chr(c) for c in range(0x4E00, 0x4E00 + 2000)]
+PARTICLES = ["の", "は", "を", "に", "と", "が", "で", "です。", "ます。", "、"]
+
+
+def make_vocabulary(rnd, size):
+    words = set()
+    while len(words) < size:
+        n = rnd.randint(2, 4)
+        pool = KANJI if rnd.random() < 0.6 else KANA
+        words.add("".join(rnd.choice(pool) for _ in range(n)))
+    return sorted(words)
+
+
+def make_text(rnd, vocab, n_words):
+    out = []
+    for _ in range(n_words):
+        out.append(rnd.choice(vocab))
+        out.append(rnd.choice(PARTICLES))
+    return "".join(out)
+
+
+def build_corpus(n_notes, vocab, seed=1):
+
+    rnd = random.Random(seed)
+    conn = get_connection()
+    cur = conn.cursor()
+
+    cur.execute(
+        "INSERT INTO users (username, password, role, created_at) VALUES ('bench', '-', 'user', '2025-01-01')"
+    )
+    user_id = cur.lastrowid
+
+    rows = []
+    for i in range(n_notes):
+        ts = f"2025-01-01T00:00:{i % 60:02d}"
+        rows.append((user_id, make_text(rnd, vocab, 3), make_text(rnd, vocab, 150), ts, ts))
+
+    cur.executemany(
+        "INSERT INTO notes (user_id, title, content, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+    return user_id
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def like_scan(cur, user_id, q, limit):
+    where = []
+    params = [user_id]
+    for term in q.split():
+        where.append("(title LIKE ? OR content LIKE ?)")
+        params.extend([f"%{term}%", f"%{term}%"])
+    cur.execute(f"""
+        SELECT id FROM notes
+        WHERE user_id = ? AND {" AND ".join(where)}
+        ORDER BY is_important DESC, updated_at DESC
+        LIMIT ?
+    """, [*params, limit])
+    return cur.fetchall()
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notes", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--vocab", type=int, default=50000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        init_db({"database": {"type": "sqlite", "path": os.path.join(tmp, "bench.db")}})
+
+        rnd = random.Random(0)
+        vocab = make_vocabulary(rnd, args.vocab)
+
+        # 3文字以上の語 (trigram) / 2語の AND / 2文字の語 (LIKE にフォールバック)
+        long_words = [w for w in vocab if len(w) >= 3]
+        short_words = [w for w in vocab if len(w) == 2]
+        queries = (
+            [rnd.choice(long_words) for _ in range(3)]
+            + [f"{rnd.choice(long_words)} {rnd.choice(long_words)}"]
+            + [rnd.choice(short_words)]
+        )
+
+        t0 = time.perf_counter()
+        user_id = build_corpus(args.notes, vocab)
+        print(f"corpus: {args.notes} notes, built in {time.perf_counter() - t0:.1f}s")
+
+        conn = get_connection(readonly=True)
+        cur = conn.cursor()
+
+        print(f"{'query':<20} {'index':<10} {'search':>10} {'LIKE':>10} {'speedup':>8}")
+        for q in queries:
+            t_idx, _ = timed(lambda: search_notes(cur, user_id, q, limit=args.limit), args.repeat)
+            t_like, _ = timed(lambda: like_scan(cur, user_id, q, args.limit), args.repeat)
+            print(f"{q:<20} {choose_index(q):<10} {t_idx * 1000:>8.1f}ms {t_like * 1000:>8.1f}ms {t_like / t_idx:>7.1f}x")
+
+        conn.close()
+        close_pool()
+
+
+if __name__ == "__main__":
+    main()
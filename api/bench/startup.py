@@ -0,0 +1,101 @@
+"""
+再起動時の起動処理 (init_db / init_users) の所要時間の計測
+
+    cd api && python -m bench.startup --notes 200000 --trashed 0.2 --users 20
+
+ノート数・ゴミ箱のノート数を増やしても再起動の時間がほぼ変わらないことを確認する
+(ゴミ箱の墓標の作成はマイグレーションで1回だけ、bcrypt は新しいユーザの分だけ)
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from src import config as config_module
+
+# 計測用の設定を共有の設定にする (/data/config.json を読み書きしない)
+config_module._config = dict(config_module.DEFAULT_CONFIG)
+
+from src.auth import init_users
+from src.database import init_db, get_connection, close_pool
+from src.utils import note_hashes, TRASH_TAG_NAME
+
+
+def build_data(n_notes, trashed_ratio):
+
+    conn = get_connection()
+    cur = conn.cursor()
+
+    cur.execute(
+        "INSERT INTO users (username, password, role, created_at) VALUES ('bench', '-', 'user', '2025-01-01')"
+    )
+    user_id = cur.lastrowid
+
+    ts = "2025-01-01T00:00:00"
+    rows = []
+    for i in range(n_notes):
+        content = f"本文 {i}\n" * 20
+        rows.append((user_id, f"note {i}", content, *note_hashes(f"note {i}", content), ts, ts))
+    cur.executemany(
+        """
+        INSERT INTO notes (user_id, title, content, note_hash, content_hash, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
+
+    cur.execute("INSERT INTO tags (name) VALUES (?)", (TRASH_TAG_NAME,))
+    trash_id = cur.lastrowid
+    cur.execute(
+        "INSERT INTO note_tags (note_id, tag_id) SELECT id, ? FROM notes WHERE user_id = ? LIMIT ?",
+        (trash_id, user_id, int(n_notes * trashed_ratio)),
+    )
+
+    conn.commit()
+    conn.close()
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - t0) * 1000
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notes", type=int, default=50000)
+    parser.add_argument("--trashed", type=float, default=0.2, help="ratio of notes in the trash")
+    parser.add_argument("--users", type=int, default=10, help="users listed in the config")
+    parser.add_argument("--restarts", type=int, default=5)
+    args = parser.parse_args()
+
+    users = [{"username": f"user{i}", "password": f"pass{i}"} for i in range(args.users)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        db_config = {"database": {"type": "sqlite", "path": os.path.join(tmp, "bench.db")}}
+
+        init_db(db_config)
+        build_data(args.notes, args.trashed)
+
+        # 初回起動 (ユーザの追加で bcrypt を計算する)
+        first_users = timed(init_users, users)
+        close_pool()
+
+        init_db_ms, init_users_ms = [], []
+        for _ in range(args.restarts):
+            init_db_ms.append(timed(init_db, db_config))
+            init_users_ms.append(timed(init_users, users))
+            close_pool()
+
+        print(f"notes: {args.notes} ({int(args.notes * args.trashed)} in trash), config users: {args.users}")
+        print(f"first boot: init_users {first_users:.1f}ms")
+        print(f"restart:    init_db {statistics.median(init_db_ms):.1f}ms, "
+              f"init_users {statistics.median(init_users_ms):.1f}ms (median of {args.restarts})")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,58 +4,115 @@ from datetime import datetime, timedelta, timezone
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from .database import get_connection
-from .config import load_config
+from .config import get_config
+from .services.cache import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+import time
 
 router = APIRouter()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
-_config = load_config()
+_config = get_config()
 _auth_config = _config.get("auth", {})
+
+# bcrypt のコストとハッシュ計算用スレッドの設定
+# rounds を変えるとログイン時に古いハッシュを自動で再計算する
+_password_config = _auth_config.get("password", {})
+BCRYPT_ROUNDS = int(_password_config.get("bcrypt_rounds", 12))
+PASSWORD_WORKERS = int(_password_config.get("workers", 2))
+PASSWORD_QUEUE_SIZE = int(_password_config.get("queue_size", 16))
+PASSWORD_TIMEOUT_SECONDS = float(_password_config.get("timeout_seconds", 10))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# ログインの bcrypt は共有スレッドプールを使わず、専用の小さなプールで実行する
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password")
+_password_slots = threading.BoundedSemaphore(PASSWORD_WORKERS + PASSWORD_QUEUE_SIZE)
 SECRET_KEY = _auth_config.get("secret_key", "simplynote-secret")
 ALGORITHM = "HS256"
 
 EXPIRE_ACCESS_TOKEN_MINUTES = _auth_config.get("expire_access_token_minutes", 60)
 EXPIRE_REFRESH_TOKEN_DAYS = _auth_config.get("expire_refresh_token_days", 30)
 
-def init_users(users):
+# <img> / <iframe> 用の添付1件だけのダウンロードトークンの有効期間
+DOWNLOAD_TOKEN_SECONDS = int(_auth_config.get("download_token_seconds", 300))
+
+# 認証キャッシュ (トークン → ユーザ名、ユーザ名 → users 行)
+_auth_cache_config = _auth_config.get("cache", {})
+_token_cache = TTLCache(
+    max_entries=_auth_cache_config.get("max_entries", 1024),
+    ttl_seconds=_auth_cache_config.get("ttl_seconds", 60),
+)
+_user_cache = TTLCache(
+    max_entries=_auth_cache_config.get("max_entries", 1024),
+    ttl_seconds=_auth_cache_config.get("ttl_seconds", 60),
+)
+
+
+def invalidate_auth_cache(username: str | None = None):
+    """ユーザの追加・削除時に呼ぶ。username=None で全件"""
+    if username is None:
+        _user_cache.clear()
+        _token_cache.clear()
+    else:
+        _user_cache.pop(username)
+        _token_cache.discard_where(lambda token, name: name == username)
+
 
-    conn = get_connection()
-    cur = conn.cursor()
+def auth_cache_stats():
+    return {
+        "tokens": _token_cache.stats(),
+        "users": _user_cache.stats(),
+    }
+
+
+def init_users(users):
+    """
+    設定のユーザを DB に反映する (起動時)
+    既存ユーザのパスワードは変更しない。bcrypt は新しく追加するユーザの分だけ計算し、
+    書き込みロックを持たずに済むよう、先に読み取り接続で差分を調べておく
+    """
 
-    # 現在のユーザ一覧を取得
-    cur.execute("SELECT username, role FROM users")
-    existing_users = cur.fetchall()
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT username, role FROM users")
+        existing_roles = {row[0]: row[1] for row in cur.fetchall()}
 
-    existing_usernames = {row[0] for row in existing_users}
     keep_usernames = {u.get("username", "").strip() for u in users if u.get("username")}
 
     # DB上に存在するが users に載っていない一般ユーザを削除
-    to_delete = [u for u in existing_users if u[1] == "user" and u[0] not in keep_usernames]
-    for username, _ in to_delete:
-        cur.execute("DELETE FROM users WHERE username=?", (username,))
+    to_delete = [name for name, role in existing_roles.items() if role == "user" and name not in keep_usernames]
 
     # users に載っているが DB に存在しないユーザを追加
+    to_add = {}
     for u in users:
         username = u.get("username", "").strip()
         password = u.get("password", "").strip()[:72]
         role = u.get("role", "user")
 
-        if not username or not password:
+        if not username or not password or username in existing_roles or username in to_add:
             continue
 
-        cur.execute("SELECT id FROM users WHERE username=?", (username,))
-        if cur.fetchone():
-            continue
+        to_add[username] = (username, hash_password(password), role, datetime.now(timezone.utc).isoformat())
+
+    if not to_delete and not to_add:
+        return
 
-        cur.execute(
-            "INSERT INTO users (username, password, role, created_at) VALUES (?, ?, ?, ?)",
-#            (username, hash_password(password), role, datetime.utcnow().isoformat()),
-            (username, hash_password(password), role, datetime.now(timezone.utc).isoformat() ),
+    with get_connection() as conn:
+        cur = conn.cursor()
+
+        for username in to_delete:
+            cur.execute("DELETE FROM users WHERE username=?", (username,))
+
+        # 読み取りの後に他で追加されていたら何もしない
+        cur.executemany(
+            "INSERT OR IGNORE INTO users (username, password, role, created_at) VALUES (?, ?, ?, ?)",
+            list(to_add.values()),
         )
 
-    conn.commit()
-    conn.close()
+    invalidate_auth_cache()
 
 
 def hash_password(password: str):
@@ -65,29 +122,87 @@ def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def authenticate_user(username: str, password: str):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE username=?", (username,))
-    user = cur.fetchone()
-    conn.close()
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM users WHERE username=?", (username,))
+        user = cur.fetchone()
     if not user:
         return False
-    if not verify_password(password, user["password"]):
+
+    valid, new_hash = pwd_context.verify_and_update(password, user["password"])
+    if not valid:
         return False
+
+    # 設定したコストと異なるハッシュはこの場で作り直す
+    if new_hash:
+        with get_connection() as conn:
+            conn.execute("UPDATE users SET password=? WHERE id=?", (new_hash, user["id"]))
+            conn.commit()
+        invalidate_auth_cache(username)
+
     return user
 
+
+async def run_password_task(fn, *args):
+    """
+    パスワードのハッシュ計算・検証を専用スレッドで実行する
+    待ち行列が一杯なら即座に 503 を返す
+    """
+    if not _password_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts in progress",
+            headers={"Retry-After": "1"},
+        )
+
+    try:
+        future = _password_executor.submit(fn, *args)
+    except BaseException:
+        _password_slots.release()
+        raise
+    future.add_done_callback(lambda _: _password_slots.release())
+
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=PASSWORD_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Login timed out",
+            headers={"Retry-After": "1"},
+        )
+
+def _decode_username(token: str) -> str:
+    """トークンを検証してユーザ名を返す (検証済みのトークンは有効期限までキャッシュ)"""
+
+    username = _token_cache.get(token)
+    if username is not None:
+        return username
+
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    username = payload.get("sub")
+    if username is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    exp = payload.get("exp")
+    ttl = exp - time.time() if exp else None
+    _token_cache.set(token, username, ttl_seconds=ttl)
+
+    return username
+
+
 def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
+        username = _decode_username(token)
 
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE username=?", (username,))
-        user = cur.fetchone()
-        conn.close()
+        user = _user_cache.get(username)
+        if user is None:
+            with get_connection(readonly=True) as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT * FROM users WHERE username=?", (username,))
+                user = cur.fetchone()
+
+            if user:
+                _user_cache.set(username, user)
 
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
@@ -106,10 +221,43 @@ def create_access_token(data: dict, expires_delta: timedelta):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+def create_download_token(user_id: int, attachment_id: int) -> str:
+    """
+    添付1件だけに使える短時間のトークン (URL のクエリに載せるのでアクセストークンは使わない)
+    sub を持たないので get_current_user・refresh では通らない
+    """
+    expire = datetime.now(timezone.utc) + timedelta(seconds=DOWNLOAD_TOKEN_SECONDS)
+    return jwt.encode(
+        {"typ": "download", "uid": user_id, "aid": attachment_id, "exp": expire},
+        SECRET_KEY, algorithm=ALGORITHM,
+    )
+
+
+def read_download_token(token: str) -> tuple[int, int]:
+    """ダウンロードトークンを確認して (user_id, attachment_id) を返す (期限切れ・別の種類のトークンは 401)"""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    if payload.get("typ") != "download" or not payload.get("uid") or not isinstance(payload.get("aid"), int):
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    return int(payload["uid"]), payload["aid"]
+
+
+def verify_download_token(token: str, attachment_id: int) -> int:
+    """ダウンロードトークンを確認して user_id を返す (別の添付のトークン・期限切れは 401)"""
+    user_id, token_attachment_id = read_download_token(token)
+    if token_attachment_id != attachment_id:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return user_id
+
+
 @router.post("/token")
-def login( form_data: OAuth2PasswordRequestForm = Depends() ):
+async def login( form_data: OAuth2PasswordRequestForm = Depends() ):
 
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await run_password_task(authenticate_user, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
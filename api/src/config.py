@@ -7,23 +7,91 @@ DEFAULT_CONFIG = {
     "auth": {
         "secret_key": "simplynote-secret",
         "expire_access_token_minutes": 60,
-        "expire_refresh_token_days": 30
+        "expire_refresh_token_days": 30,
+        "download_token_seconds": 300,       # 添付のダウンロード URL (?dl=) の有効期間
+        "cache": {
+            "max_entries": 1024,             # 認証キャッシュの件数上限
+            "ttl_seconds": 60
+        },
+        "password": {
+            "bcrypt_rounds": 12,             # 変更するとログイン時にハッシュを再計算
+            "workers": 2,                    # bcrypt 用スレッド数
+            "queue_size": 16,                # これを超えるログイン要求は 503
+            "timeout_seconds": 10
+        }
     },
     "database": {
         "type": "sqlite",                # 将来 "postgres", "mysql" などに変更可能
-        "path": "/data/simplynote.db"
+        "path": "/data/simplynote.db",
+        # ※ uvicorn のワーカーは1つで動かすこと (--workers を指定しない)
+        #   接続プールと ETag の世代カウンタ (services/generation.py) はプロセス内にあり、
+        #   別のワーカーの書き込みでは ETag が変わらず、古い一覧に 304 を返してしまう
+        #   削除済みノートのブルームフィルタ (tombstones.bloom_filter) も同じで、
+        #   別のワーカーで作った墓標を見落として削除したノートの再作成を許してしまう
+        "pool": {
+            "max_readers": 40,               # 読み取り接続数の上限 (スレッドごと)
+            "statement_cache_size": 128,
+            "health_check_interval": 30,     # 秒
+            "writer_timeout": 10             # 秒
+        }
     },
     "upload": {
         "max_size_mb": 50,
-        "dir": "/data/files"
+        "dir": "/data/files",
+        "migration": {
+            "on_startup": False,             # 起動時にバックグラウンドで保存形式を移行する (既定は CLI か管理者 API で明示的に実行)
+            "batch_size": 200,               # 1回の書き込みロックで処理するファイル数
+            "pause_seconds": 0.2             # バッチ間の休止 (通常のリクエストを優先)
+        },
+        "cleanup": {
+            "interval_seconds": 30,          # 削除待ち (file_deletions) を確認する間隔
+            "batch_size": 100,               # 1回の書き込みロックで削除するファイル数
+            "max_backoff_seconds": 3600,     # 削除に失敗したファイルの再試行間隔の上限
+            "sweep_interval_hours": 6,       # 参照されていないファイルを探す間隔
+            "sweep_batch_size": 500,         # 1回に調べるファイル数
+            "grace_seconds": 3600            # 更新からこの時間が経っていないファイルは消さない
+        }
+    },
+    "thumbnails": {
+        "enabled": True,                 # Pillow が無い場合は作らない
+        "dir": "/data/thumbs",
+        "sizes": [256, 1024],            # 一覧用・プレビュー用 (要求サイズはこのどれかに丸める)
+        "max_cache_mb": 512,             # 超えたら古いものから削除
+        "workers": 2,
+        "quality": 80,
+        "timeout_seconds": 30            # 要求時の生成を待つ上限 (超えたら 503 と Retry-After)
+    },
+    "download": {
+        "accel_redirect": {
+            "enabled": False,                # True: 本体の送信を nginx に任せる (X-Accel-Redirect)
+            "prefix": "/_protected_files/"   # nginx の internal location (upload.dir を alias)
+        }
     },
     "logging": {
         "level": "INFO"
     },
+    "import": {
+        "workers": 0                     # parallel=true 時の解析プロセス数 (0 = CPU数)
+    },
     "trash": {
         "enabled": True,
         "auto_empty_days": 30            # ゴミ箱を自動的に空にするまでの日数
     },
+    "tombstones": {
+        "bloom_filter": True,            # 削除済みノートの確認の前にユーザごとのブルームフィルタを見る (ワーカー1つが前提)
+        "false_positive_rate": 0.01,     # フィルタの誤判定率 (誤判定時は SQL で確認する)
+        "max_cached_users": 1000,        # メモリに置くフィルタの数
+        "retention_days": 0,             # 削除済みノートの再作成を拒否する期間、日数を指定すると古い墓標を消す (0 = 無期限)
+        "max_per_user": 0                # ユーザごとの墓標の上限、超えた分は古い順に消す (0 = 無制限)
+    },
+    "maintenance": {
+        "debounce_seconds": 5,           # タグ操作などの要求をまとめてから実行するまでの待ち時間
+        "interval_minutes": 60,          # 全ユーザ分の定期実行の間隔
+        "batch_size": 500,               # 1回の書き込みロックで削除する行数
+        "time_budget_ms": 200,           # ユーザごとの1回の実行時間の上限 (残りは次回)
+        "global_time_budget_ms": 2000,   # 定期実行1回の実行時間の上限
+        "reconcile_tag_counts_hours": 24 # タグ件数の集計 (user_tag_counts) を数え直して検証する間隔
+    },
 #   , "users": [
 #         {"username": "user",  "password": "user_pass"}
 #     ]
@@ -52,3 +120,17 @@ def load_config():
 
     return config
 
+
+_config = None
+
+
+def get_config():
+    """
+    プロセスで共有する設定 (最初の呼び出しで1回だけ load_config する)
+    各モジュールは import 時にこれを呼ぶ。設定ファイルの変更は再起動で反映
+    """
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
+
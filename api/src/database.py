@@ -1,16 +1,39 @@
-import os, sqlite3
-from datetime import datetime
+import logging, os, sqlite3, threading, time
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from pathlib import Path
 
-from .utils import TRASH_TAG_NAME, note_content_fingerprint, note_fingerprint
+from .utils import TRASH_TAG_NAME, normalize_newlines, note_hashes
+
+logger = logging.getLogger("database")
 
 _config = None
+_pool = None
+_pool_init_lock = threading.Lock()
+
+# FTS 索引の INSERT トリガー (一括取り込み中は外して最後にまとめて索引する)
+FTS_INSERT_TRIGGERS = {
+    "notes_ai": """
+    CREATE TRIGGER IF NOT EXISTS notes_ai AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts(rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+    END;
+    """,
+    "notes_trigram_ai": """
+    CREATE TRIGGER IF NOT EXISTS notes_trigram_ai AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts_trigram(rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+    END;
+    """,
+}
 
 def init_db(config):
 
     global _config
     _config = config
 
+    close_pool()
+
     conn = get_connection()
     cur = conn.cursor()
 
@@ -65,6 +88,112 @@ def init_db(config):
     )
     """)
 
+    cur.execute("PRAGMA table_info(attachments)")
+    attachment_columns = {row["name"] for row in cur.fetchall()}
+    for column, column_type in (("sha256", "TEXT"), ("size", "INTEGER"), ("mime_type", "TEXT")):
+        if column not in attachment_columns:
+            cur.execute(f"ALTER TABLE attachments ADD COLUMN {column} {column_type}")
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_attachments_sha256
+    ON attachments(sha256)
+    """)
+
+    # 内容 (SHA-256) 単位の実ファイル。同じ内容の添付は1ファイルを共有する
+    # refcount は attachments の追加・削除 (ノート削除によるカスケードを含む) でトリガーが増減する
+    # sha256 が NULL の添付は以前の形式 (1添付1ファイル) で、参照カウントしない
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS attachment_blobs (
+        sha256 TEXT PRIMARY KEY,
+        filename_stored TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mime_type TEXT,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL
+    )
+    """)
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_attachment_blobs_unreferenced
+    ON attachment_blobs(refcount) WHERE refcount <= 0
+    """)
+
+    # 移行前の保存名 → 内容単位の保存名 (/files/ の古い URL を解決するため)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS attachment_aliases (
+        filename TEXT PRIMARY KEY,
+        filename_stored TEXT NOT NULL
+    )
+    """)
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_attachment_aliases_stored
+    ON attachment_aliases(filename_stored)
+    """)
+
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS attachments_blob_ai
+    AFTER INSERT ON attachments WHEN new.sha256 IS NOT NULL BEGIN
+        UPDATE attachment_blobs SET refcount = refcount + 1 WHERE sha256 = new.sha256;
+    END;
+    """)
+
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS attachments_blob_ad
+    AFTER DELETE ON attachments WHEN old.sha256 IS NOT NULL BEGIN
+        UPDATE attachment_blobs SET refcount = refcount - 1 WHERE sha256 = old.sha256;
+    END;
+    """)
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_attachments_filename_stored
+    ON attachments(filename_stored)
+    """)
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_attachment_blobs_filename_stored
+    ON attachment_blobs(filename_stored)
+    """)
+
+    # 削除待ちのファイル (行の削除と同じトランザクションでトリガーが積む)
+    # 実ファイルはバックグラウンドの file_cleanup が消す (失敗したら間隔を空けて再試行)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS file_deletions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename_stored TEXT NOT NULL UNIQUE,
+        thumbnail_key TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT NOT NULL DEFAULT (datetime('now')),
+        last_error TEXT,
+        created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    )
+    """)
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_file_deletions_next_attempt
+    ON file_deletions(next_attempt_at)
+    """)
+
+    # 以前の形式の添付 (1添付1ファイル) は行の削除 (ノート削除のカスケードを含む) でファイルも削除待ちにする
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS attachments_file_ad
+    AFTER DELETE ON attachments WHEN old.sha256 IS NULL BEGIN
+        INSERT OR IGNORE INTO file_deletions (filename_stored, thumbnail_key)
+        VALUES (old.filename_stored, old.filename_stored);
+    END;
+    """)
+
+    # 参照カウントが 0 になった内容は行を消してファイルを削除待ちにする
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS attachment_blobs_released
+    AFTER UPDATE OF refcount ON attachment_blobs WHEN new.refcount <= 0 BEGIN
+        DELETE FROM attachment_aliases WHERE filename_stored = new.filename_stored;
+        INSERT OR IGNORE INTO file_deletions (filename_stored, thumbnail_key)
+        VALUES (new.filename_stored, new.sha256);
+        DELETE FROM attachment_blobs WHERE sha256 = new.sha256;
+    END;
+    """)
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS note_tombstones (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -93,7 +222,7 @@ def init_db(config):
     """)
 
     # -------------------------------------------
-    # 全文検索用インデックス (未使用)
+    # 全文検索用インデックス
     # -------------------------------------------
 
     cur.execute("""
@@ -105,77 +234,756 @@ def init_db(config):
     )
     """)
 
+    # 外部コンテンツ型の FTS5 は、削除時に旧い値を 'delete' コマンドで渡す必要がある
+    # (以前のトリガーは DELETE 文で消していたため索引に古い語が残る → 作り直して再構築)
+    cur.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name='notes_ad'")
+    row = cur.fetchone()
+    rebuild_fts = row is not None and "'delete'" not in row["sql"]
+    if rebuild_fts:
+        for name in ("notes_ai", "notes_ad", "notes_au"):
+            cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+    cur.execute(FTS_INSERT_TRIGGERS["notes_ai"])
+
     cur.execute("""
-    CREATE TRIGGER IF NOT EXISTS notes_ai AFTER INSERT ON notes BEGIN
+    CREATE TRIGGER IF NOT EXISTS notes_ad AFTER DELETE ON notes BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+    END;
+    """)
+
+    # 本文・タイトルが変わったときだけ索引を更新する (重要フラグの切り替え等では触らない)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS notes_au AFTER UPDATE OF title, content ON notes BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
         INSERT INTO notes_fts(rowid, title, content)
         VALUES (new.id, new.title, new.content);
     END;
     """)
 
+    if rebuild_fts:
+        cur.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')")
+
+    # 日本語用の部分一致インデックス (trigram)
+    # unicode61 は日本語を分かち書きしないため、部分一致検索はこちらを使う
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='notes_fts_trigram'")
+    rebuild_trigram = cur.fetchone() is None
+
     cur.execute("""
-    CREATE TRIGGER IF NOT EXISTS notes_ad AFTER DELETE ON notes BEGIN
-        DELETE FROM notes_fts WHERE rowid = old.id;
+    CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts_trigram USING fts5(
+        title,
+        content,
+        content='notes',
+        content_rowid='id',
+        tokenize='trigram'
+    )
+    """)
+
+    cur.execute(FTS_INSERT_TRIGGERS["notes_trigram_ai"])
+
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS notes_trigram_ad AFTER DELETE ON notes BEGIN
+        INSERT INTO notes_fts_trigram(notes_fts_trigram, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
     END;
     """)
 
     cur.execute("""
-    CREATE TRIGGER IF NOT EXISTS notes_au AFTER UPDATE ON notes BEGIN
-        DELETE FROM notes_fts WHERE rowid = old.id;
-        INSERT INTO notes_fts(rowid, title, content)
+    CREATE TRIGGER IF NOT EXISTS notes_trigram_au AFTER UPDATE OF title, content ON notes BEGIN
+        INSERT INTO notes_fts_trigram(notes_fts_trigram, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO notes_fts_trigram(rowid, title, content)
         VALUES (new.id, new.title, new.content);
     END;
     """)
 
+    if rebuild_trigram:
+        cur.execute("INSERT INTO notes_fts_trigram(notes_fts_trigram) VALUES ('rebuild')")
+
+    # -------------------------------------------
+    # 差分同期用の変更ログ
+    # -------------------------------------------
+
+    # ユーザごとの変更シーケンス
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sync_seq (
+        user_id INTEGER PRIMARY KEY,
+        seq INTEGER NOT NULL
+    )
+    """)
+
+    # ノートごとの最終変更シーケンス (1ノート1行)
     cur.execute("""
-        SELECT n.id, n.user_id, n.title, n.content, n.updated_at
-        FROM notes n
-        JOIN note_tags nt ON n.id = nt.note_id
-        JOIN tags t ON nt.tag_id = t.id
-        WHERE upper(t.name) = ?
-    """, (TRASH_TAG_NAME,))
-    for row in cur.fetchall():
-        cur.execute("""
-            INSERT INTO note_tombstones
-                (user_id, note_hash, content_hash, source_note_id, deleted_at)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(user_id, note_hash) DO UPDATE SET
-                content_hash = excluded.content_hash,
-                source_note_id = excluded.source_note_id,
-                deleted_at = excluded.deleted_at
-        """, (
-            row["user_id"],
-            note_fingerprint(row["title"], row["content"]),
-            note_content_fingerprint(row["content"]),
-            row["id"],
-            row["updated_at"] or datetime.utcnow().isoformat(),
-        ))
+    CREATE TABLE IF NOT EXISTS note_changes (
+        user_id INTEGER NOT NULL,
+        note_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        changed_at TEXT NOT NULL,
+        PRIMARY KEY (user_id, note_id)
+    )
+    """)
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_note_changes_user_seq
+    ON note_changes(user_id, seq)
+    """)
+
+    # 変更ログはトリガーで書くので、ノート/タグ/添付の更新と同じトランザクションに入る
+    for name, event, note_ref in (
+        ("notes_sync_ai", "AFTER INSERT ON notes", "new.id"),
+        ("notes_sync_au", "AFTER UPDATE ON notes", "new.id"),
+        ("note_tags_sync_ai", "AFTER INSERT ON note_tags", "new.note_id"),
+        ("note_tags_sync_ad", "AFTER DELETE ON note_tags", "old.note_id"),
+        ("attachments_sync_ai", "AFTER INSERT ON attachments", "new.note_id"),
+        ("attachments_sync_ad", "AFTER DELETE ON attachments", "old.note_id"),
+    ):
+        # ノート削除に伴うカスケード削除では notes に行が無いので何もしない
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN
+            INSERT INTO sync_seq (user_id, seq)
+            SELECT user_id, 1 FROM notes WHERE id = {note_ref}
+            ON CONFLICT(user_id) DO UPDATE SET seq = seq + 1;
+            INSERT INTO note_changes (user_id, note_id, seq, deleted, changed_at)
+            SELECT n.user_id, n.id, s.seq, 0, datetime('now')
+            FROM notes n JOIN sync_seq s ON s.user_id = n.user_id
+            WHERE n.id = {note_ref}
+            ON CONFLICT(user_id, note_id) DO UPDATE SET
+                seq = excluded.seq,
+                deleted = 0,
+                changed_at = excluded.changed_at;
+        END;
+        """)
+
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS notes_sync_ad AFTER DELETE ON notes BEGIN
+        INSERT INTO sync_seq (user_id, seq) VALUES (old.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET seq = seq + 1;
+        INSERT INTO note_changes (user_id, note_id, seq, deleted, changed_at)
+        VALUES (
+            old.user_id, old.id,
+            (SELECT seq FROM sync_seq WHERE user_id = old.user_id),
+            1, datetime('now')
+        )
+        ON CONFLICT(user_id, note_id) DO UPDATE SET
+            seq = excluded.seq,
+            deleted = 1,
+            changed_at = excluded.changed_at;
+    END;
+    """)
 
     conn.commit()
+
+    apply_migrations(conn)
+
     conn.close()
 
 
-def get_connection():
+# -------------------------------------------
+# スキーマのマイグレーション (PRAGMA user_version)
+# -------------------------------------------
+# init_db の CREATE ... IF NOT EXISTS が基本スキーマ (version 0)
+# 以降のスキーマ変更はここに番号付きで追加する。適用済みの番号は user_version に記録され、二度は実行されない
+# 1つのマイグレーションと user_version の更新は同じトランザクションで行う
 
-    if _config is None:
-        raise RuntimeError("init_db(config) が呼ばれていません")
+def _migrate_hot_path_indexes(cur):
+    # ノート一覧 (user_id で絞って is_important, updated_at 順) をソートなしで返す
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_notes_user_important_updated
+    ON notes(user_id, is_important, updated_at)
+    """)
+    # ノートごとの添付の取得・ノート削除時のカスケード
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_attachments_note_id
+    ON attachments(note_id)
+    """)
+    # タグからノートを引く (タグの削除時のカスケード・未使用タグの判定)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_note_tags_tag_id
+    ON note_tags(tag_id, note_id)
+    """)
+    # インポート時のタイトル重複判定
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_notes_user_title
+    ON notes(user_id, title)
+    """)
 
-    db_cfg = _config.get("database", {})
-    db_type = db_cfg.get("type", "sqlite")
 
-    if db_type == "sqlite":
+def _migrate_trashed_at(cur):
+    # ゴミ箱に入れた日時 (TRASH タグの付け外しでトリガーが更新する)
+    # upper(tags.name) の結合を使わずに、部分インデックスでゴミ箱のノートを引けるようにする
+    cur.execute("ALTER TABLE notes ADD COLUMN trashed_at TEXT")
+
+    # 既存のゴミ箱のノートは、これまで期限の判定に使っていた updated_at を入れる
+    cur.execute("""
+        UPDATE notes SET trashed_at = updated_at
+        WHERE id IN (
+            SELECT nt.note_id FROM note_tags nt
+            JOIN tags t ON nt.tag_id = t.id
+            WHERE upper(t.name) = ?
+        )
+    """, (TRASH_TAG_NAME,))
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_notes_user_trashed
+    ON notes(user_id, trashed_at) WHERE trashed_at IS NOT NULL
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_notes_trashed
+    ON notes(trashed_at) WHERE trashed_at IS NOT NULL
+    """)
+
+    # タグ名は大文字に正規化して保存するが、インポートした古いデータのため upper() で比較する
+    # (tags の主キーで1行引くだけ)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS note_tags_trash_ai
+    AFTER INSERT ON note_tags
+    WHEN (SELECT upper(name) FROM tags WHERE id = new.tag_id) = '{TRASH_TAG_NAME}' BEGIN
+        UPDATE notes SET trashed_at = strftime('%Y-%m-%dT%H:%M:%S', 'now')
+        WHERE id = new.note_id AND trashed_at IS NULL;
+    END;
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS note_tags_trash_ad
+    AFTER DELETE ON note_tags
+    WHEN (SELECT upper(name) FROM tags WHERE id = old.tag_id) = '{TRASH_TAG_NAME}' BEGIN
+        UPDATE notes SET trashed_at = NULL
+        WHERE id = old.note_id
+          AND NOT EXISTS (
+              SELECT 1 FROM note_tags nt JOIN tags t ON nt.tag_id = t.id
+              WHERE nt.note_id = old.note_id AND upper(t.name) = '{TRASH_TAG_NAME}'
+          );
+    END;
+    """)
+
 
-        ## db_path = _config["database"]["path"]
-        ## os.makedirs(os.path.dirname(db_path), exist_ok=True)
+# ゴミ箱以外のノートのタグごとの件数 (GET /tags はこの表だけを読む)
+# TRASH タグ自身の行は数えない (ゴミ箱のノートは数えないので常に 0)
+USER_TAG_COUNTS_SQL = f"""
+    SELECT n.user_id, nt.tag_id, COUNT(*) AS note_count
+    FROM note_tags nt
+    JOIN notes n ON n.id = nt.note_id
+    JOIN tags t ON t.id = nt.tag_id
+    WHERE n.trashed_at IS NULL AND upper(t.name) != '{TRASH_TAG_NAME}'
+    GROUP BY n.user_id, nt.tag_id
+"""
 
-        db_path = Path(db_cfg.get("path", "/data/simplynote.db"))
-        db_path.parent.mkdir(parents=True, exist_ok=True)
 
-        conn = sqlite3.connect(db_path, timeout=10.0, check_same_thread=False)
-        conn.execute("PRAGMA journal_mode=WAL;")
+def _migrate_user_tag_counts(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_tag_counts (
+        user_id INTEGER NOT NULL,
+        tag_id INTEGER NOT NULL,
+        note_count INTEGER NOT NULL,
+        PRIMARY KEY (user_id, tag_id)
+    ) WITHOUT ROWID
+    """)
+
+    is_counted_tag = f"(SELECT upper(name) FROM tags WHERE id = {{ref}}) != '{TRASH_TAG_NAME}'"
+
+    # タグの付け外し (ゴミ箱のノートは数えない。カスケード削除では notes に行が無いので何もしない)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS note_tags_count_ai
+    AFTER INSERT ON note_tags WHEN {is_counted_tag.format(ref="new.tag_id")} BEGIN
+        INSERT INTO user_tag_counts (user_id, tag_id, note_count)
+        SELECT user_id, new.tag_id, 1 FROM notes WHERE id = new.note_id AND trashed_at IS NULL
+        ON CONFLICT(user_id, tag_id) DO UPDATE SET note_count = note_count + 1;
+    END;
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS note_tags_count_ad
+    AFTER DELETE ON note_tags WHEN {is_counted_tag.format(ref="old.tag_id")} BEGIN
+        UPDATE user_tag_counts SET note_count = note_count - 1
+        WHERE user_id = (SELECT user_id FROM notes WHERE id = old.note_id AND trashed_at IS NULL)
+          AND tag_id = old.tag_id;
+        DELETE FROM user_tag_counts
+        WHERE user_id = (SELECT user_id FROM notes WHERE id = old.note_id)
+          AND tag_id = old.tag_id AND note_count <= 0;
+    END;
+    """)
+
+    # ゴミ箱への出し入れ (trashed_at は note_tags_trash_* トリガーが更新する)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS notes_count_trashed
+    AFTER UPDATE OF trashed_at ON notes
+    WHEN old.trashed_at IS NULL AND new.trashed_at IS NOT NULL BEGIN
+        UPDATE user_tag_counts SET note_count = note_count - 1
+        WHERE user_id = new.user_id
+          AND tag_id IN (SELECT tag_id FROM note_tags WHERE note_id = new.id);
+        DELETE FROM user_tag_counts WHERE user_id = new.user_id AND note_count <= 0;
+    END;
+    """)
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS notes_count_restored
+    AFTER UPDATE OF trashed_at ON notes
+    WHEN old.trashed_at IS NOT NULL AND new.trashed_at IS NULL BEGIN
+        INSERT INTO user_tag_counts (user_id, tag_id, note_count)
+        SELECT new.user_id, nt.tag_id, 1
+        FROM note_tags nt JOIN tags t ON t.id = nt.tag_id
+        WHERE nt.note_id = new.id AND upper(t.name) != '{TRASH_TAG_NAME}'
+        ON CONFLICT(user_id, tag_id) DO UPDATE SET note_count = note_count + 1;
+    END;
+    """)
+
+    # ノートの削除 (note_tags はこの後カスケードで消えるので、行が残っている BEFORE で減らす)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS notes_count_bd
+    BEFORE DELETE ON notes WHEN old.trashed_at IS NULL BEGIN
+        UPDATE user_tag_counts SET note_count = note_count - 1
+        WHERE user_id = old.user_id
+          AND tag_id IN (SELECT tag_id FROM note_tags WHERE note_id = old.id);
+        DELETE FROM user_tag_counts WHERE user_id = old.user_id AND note_count <= 0;
+    END;
+    """)
+
+    cur.execute("DELETE FROM user_tag_counts")
+    cur.execute(f"INSERT INTO user_tag_counts (user_id, tag_id, note_count) {USER_TAG_COUNTS_SQL}")
+
+
+def _migrate_tombstone_retention(cur):
+    # 保持期間を過ぎた墓標を古い順に消す (tombstones.compact_tombstones)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_note_tombstones_deleted_at
+    ON note_tombstones(deleted_at)
+    """)
+
+
+def _migrate_note_hashes(cur, batch_size=1000):
+    # 墓標用の指紋 (utils.note_hashes) を保存時に計算して持たせる
+    # 削除・ゴミ箱への移動では本文を読まずに列をコピーし、インポートでは同じノートを飛ばす
+    cur.execute("ALTER TABLE notes ADD COLUMN note_hash TEXT")
+    cur.execute("ALTER TABLE notes ADD COLUMN content_hash TEXT")
+
+    # 既存ノートの計算で同期の変更履歴 (notes_sync_au) を全件に付けないよう、その間だけ外す
+    cur.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name='notes_sync_au'")
+    row = cur.fetchone()
+    sync_trigger = row[0] if row else None
+    if sync_trigger:
+        cur.execute("DROP TRIGGER notes_sync_au")
+
+    last_id = 0
+    while True:
+        cur.execute(
+            "SELECT id, title, content FROM notes WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, batch_size),
+        )
+        rows = cur.fetchall()
+        if not rows:
+            break
+        cur.executemany(
+            "UPDATE notes SET note_hash=?, content_hash=? WHERE id=?",
+            [(*note_hashes(row[1], normalize_newlines(row[2] or "")), row[0]) for row in rows],
+        )
+        last_id = rows[-1][0]
+
+    if sync_trigger:
+        cur.execute(sync_trigger)
+
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_notes_user_note_hash
+    ON notes(user_id, note_hash)
+    """)
+
+
+def _migrate_trash_tombstones(cur):
+    # 墓標の導入前からゴミ箱にあったノートの墓標 (以前は起動のたびに全件を調べていた)
+    # 以降にゴミ箱に入るノートは add_tag / インポートで墓標を作る
+    cur.execute("""
+        INSERT INTO note_tombstones (user_id, note_hash, content_hash, source_note_id, deleted_at)
+        SELECT user_id, note_hash, content_hash, id, COALESCE(updated_at, ?)
+        FROM notes
+        WHERE trashed_at IS NOT NULL
+        ON CONFLICT(user_id, note_hash) DO UPDATE SET
+            content_hash = excluded.content_hash,
+            source_note_id = excluded.source_note_id,
+            deleted_at = excluded.deleted_at
+    """, (datetime.now(timezone.utc).isoformat(),))
+
+
+MIGRATIONS = [
+    (1, "hot path indexes", _migrate_hot_path_indexes),
+    (2, "notes.trashed_at", _migrate_trashed_at),
+    (3, "user_tag_counts", _migrate_user_tag_counts),
+    (4, "note_tombstones.deleted_at index", _migrate_tombstone_retention),
+    (5, "notes.note_hash / content_hash", _migrate_note_hashes),
+    (6, "tombstones for trashed notes", _migrate_trash_tombstones),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def apply_migrations(conn):
+    """未適用のマイグレーションを番号順に適用する"""
+
+    cur = conn.cursor()
+    cur.execute("PRAGMA user_version")
+    current = cur.fetchone()[0]
+
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        # DDL も含めて1トランザクションにする (途中で失敗したら何も適用されない)
+        cur.execute("BEGIN")
+        try:
+            migrate(cur)
+            cur.execute(f"PRAGMA user_version = {int(version)}")
+            cur.execute("COMMIT")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        logger.info(f"🗄️ Applied schema migration {version}: {description}")
+
+
+@contextmanager
+def deferred_fts_index(cur):
+    """
+    一括 INSERT の間だけ FTS の INSERT トリガーを外し、終了時に追加分をまとめて索引する
+    書き込み接続の明示的なトランザクション内で使うこと (失敗時は rollback でトリガーも元に戻る)
+    """
+
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM notes")
+    max_id = cur.fetchone()[0]
+
+    for name in FTS_INSERT_TRIGGERS:
+        cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+    try:
+        yield
+    finally:
+        for sql in FTS_INSERT_TRIGGERS.values():
+            cur.execute(sql)
+
+    for table in ("notes_fts", "notes_fts_trigram"):
+        cur.execute(f"""
+            INSERT INTO {table}(rowid, title, content)
+            SELECT id, title, content FROM notes WHERE id > ?
+        """, (max_id,))
+
+
+# -------------------------------------------
+# 接続プール
+# -------------------------------------------
+
+DEFAULT_POOL_CONFIG = {
+    "max_readers": 40,                  # スレッドごとに保持する読み取り接続の上限 (anyio のスレッドプール既定値に合わせる)
+    "statement_cache_size": 128,        # 接続ごとのプリペアドステートメントキャッシュ
+    "health_check_interval": 30,        # 秒。これ以上アイドルだった接続は SELECT 1 で確認
+    "writer_timeout": 10,               # 秒。書き込み接続の取得待ち上限
+}
+
+
+class PooledConnection:
+    """
+    プールから貸し出す接続
+    close() は実際には閉じずにプールへ返却する
+    with 文で使うと正常終了時に commit、例外時に rollback してから返却する
+    (同じスレッド内でネストして取得した書き込み接続は、外側の取得のときだけ commit / rollback する)
+    """
+
+    def __init__(self, pool, conn, readonly: bool, transient: bool = False, nested: bool = False):
+        self._pool = pool
+        self._conn = conn
+        self._released = False
+        self.readonly = readonly
+        self.transient = transient
+        self.nested = nested
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        self._pool.release(self._conn, self.readonly, self.transient)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.nested:
+                pass
+            elif exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+        finally:
+            self.close()
+
+    def __del__(self):
+        # close() し忘れた接続もプールへ戻す
+        if not getattr(self, "_released", True):
+            self.close()
+
+
+class ConnectionPool:
+    """
+    SQLite 用の接続プール
+    読み取りはスレッドごとの接続、書き込みは専用の1接続をロックで排他して使う
+    PRAGMA は接続作成時に一度だけ設定する
+    """
+
+    def __init__(self, db_path: Path, pool_cfg: dict):
+
+        cfg = {**DEFAULT_POOL_CONFIG, **(pool_cfg or {})}
+
+        self.db_path = db_path
+        self.max_readers = int(cfg["max_readers"])
+        self.statement_cache_size = int(cfg["statement_cache_size"])
+        self.health_check_interval = float(cfg["health_check_interval"])
+        self.writer_timeout = float(cfg["writer_timeout"])
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._readers = {}              # thread -> connection
+        self._last_used = {}
+
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._writer_owner = None
+        self._writer_depth = 0
+
+        self.stats = {
+            "connections_created": 0,
+            "reader_checkouts": 0,
+            "writer_checkouts": 0,
+            "transient_readers": 0,
+            "health_check_failures": 0,
+        }
+
+    def _connect(self, readonly: bool):
+
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=10.0,
+            check_same_thread=False,
+            cached_statements=self.statement_cache_size,
+        )
+        if not readonly:
+            conn.execute("PRAGMA journal_mode=WAL;")
         conn.execute("PRAGMA foreign_keys=ON;")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON;")
         conn.row_factory = sqlite3.Row  # 辞書形式で取得
 
+        with self._lock:
+            self.stats["connections_created"] += 1
+            self._last_used[conn] = time.monotonic()
+
         return conn
 
-    else:
+    def _ensure_healthy(self, conn, readonly: bool):
+        """しばらく使われていない接続は SELECT 1 で確認し、失敗したら作り直す"""
+
+        now = time.monotonic()
+        last_used = self._last_used.get(conn, now)
+
+        if now - last_used >= self.health_check_interval:
+            try:
+                conn.execute("SELECT 1").fetchone()
+            except sqlite3.Error:
+                with self._lock:
+                    self.stats["health_check_failures"] += 1
+                self._discard(conn)
+                conn = self._connect(readonly)
+
+        self._last_used[conn] = now
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._last_used.pop(conn, None)
+            for thread, reader in list(self._readers.items()):
+                if reader is conn:
+                    del self._readers[thread]
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _prune_dead_readers(self):
+        """終了したスレッドの読み取り接続を閉じる (self._lock 取得済みで呼ぶ)"""
+        dead = [t for t in self._readers if not t.is_alive()]
+        for thread in dead:
+            conn = self._readers.pop(thread)
+            self._last_used.pop(conn, None)
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def acquire_reader(self, dedicated: bool = False):
+
+        if dedicated:
+            # ストリーミング応答などスレッドをまたいで使う接続はプールに入れない
+            return PooledConnection(self, self._connect(readonly=True), readonly=True, transient=True)
+
+        thread = threading.current_thread()
+
+        with self._lock:
+            self.stats["reader_checkouts"] += 1
+            conn = self._readers.get(thread)
+
+        if conn is not None:
+            healthy = self._ensure_healthy(conn, readonly=True)
+            if healthy is not conn:
+                with self._lock:
+                    self._readers[thread] = healthy
+            return PooledConnection(self, healthy, readonly=True)
+
+        with self._lock:
+            if len(self._readers) >= self.max_readers:
+                self._prune_dead_readers()
+            pooled = len(self._readers) < self.max_readers
+            if not pooled:
+                self.stats["transient_readers"] += 1
+
+        conn = self._connect(readonly=True)
+
+        if not pooled:
+            # 上限を超えた分はその場限りの接続にする
+            return PooledConnection(self, conn, readonly=True, transient=True)
+
+        with self._lock:
+            self._readers[thread] = conn
+
+        return PooledConnection(self, conn, readonly=True)
+
+    def acquire_writer(self):
+
+        me = threading.get_ident()
+
+        # 同じスレッド内でのネストした取得は同じ接続を共有する
+        if self._writer_owner == me:
+            self._writer_depth += 1
+            return PooledConnection(self, self._writer, readonly=False, nested=True)
+
+        if not self._writer_lock.acquire(timeout=self.writer_timeout):
+            raise sqlite3.OperationalError("database is locked (writer connection busy)")
+
+        try:
+            if self._writer is None:
+                self._writer = self._connect(readonly=False)
+            else:
+                self._writer = self._ensure_healthy(self._writer, readonly=False)
+        except Exception:
+            self._writer_lock.release()
+            raise
+
+        self._writer_owner = me
+        self._writer_depth = 1
+
+        with self._lock:
+            self.stats["writer_checkouts"] += 1
+
+        return PooledConnection(self, self._writer, readonly=False)
+
+    def release(self, conn, readonly: bool, transient: bool = False):
+
+        if transient:
+            self._discard(conn)
+            return
+
+        if not readonly:
+            # ネストした取得の close() では何もしない (外側のトランザクションを消さない)
+            self._writer_depth -= 1
+            if self._writer_depth > 0:
+                return
+
+        # commit されていない変更は破棄 (close() と同じ挙動)
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            if not readonly:
+                self._writer = None
+
+        self._last_used[conn] = time.monotonic()
+
+        if readonly:
+            return
+
+        self._writer_depth = 0
+        self._writer_owner = None
+        self._writer_lock.release()
+
+    def close_all(self):
+
+        with self._lock:
+            conns = list(self._readers.values())
+            self._readers.clear()
+        if self._writer is not None:
+            conns.append(self._writer)
+            self._writer = None
+
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._last_used.clear()
+
+    def status(self):
+        with self._lock:
+            return {
+                **self.stats,
+                "readers": len(self._readers),
+                "max_readers": self.max_readers,
+                "writer_busy": self._writer_owner is not None,
+            }
+
+
+def _get_pool():
+
+    global _pool
+
+    if _config is None:
+        raise RuntimeError("init_db(config) が呼ばれていません")
+
+    if _pool is not None:
+        return _pool
+
+    db_cfg = _config.get("database", {})
+    db_type = db_cfg.get("type", "sqlite")
+
+    if db_type != "sqlite":
         raise NotImplementedError(f"Unsupported database type: {db_type}")
+
+    db_path = Path(db_cfg.get("path", "/data/simplynote.db"))
+
+    with _pool_init_lock:
+        if _pool is None:
+            _pool = ConnectionPool(db_path, db_cfg.get("pool", {}))
+
+    return _pool
+
+
+def get_connection(readonly: bool = False, dedicated: bool = False):
+    """
+    プールから接続を取得する
+    readonly=True は読み取り専用のスレッドごとの接続、それ以外は書き込み用の専用接続
+    dedicated=True (読み取りのみ) はスレッドに紐付かない使い捨ての接続
+    使い終わったら close() するか with 文で使うこと
+    """
+    pool = _get_pool()
+    if readonly:
+        return pool.acquire_reader(dedicated=dedicated)
+    return pool.acquire_writer()
+
+
+def close_pool():
+    """プール内の接続をすべて閉じる"""
+    global _pool
+    if _pool is not None:
+        _pool.close_all()
+        _pool = None
+
+
+def pool_status():
+    if _pool is None:
+        return {}
+    return _pool.status()
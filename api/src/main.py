@@ -1,15 +1,20 @@
-from fastapi import FastAPI, Response, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Response, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 
-from .database import init_db, get_connection
-from .auth import init_users, get_current_user, oauth2_scheme, router as auth_router
-from .config import load_config
+from .database import init_db, get_connection, close_pool
+from .auth import init_users, get_current_user, oauth2_scheme, auth_cache_stats, router as auth_router
+from .config import get_config
 
-from .routers import notes, attachments, tags, import_export
+from .routers import notes, attachments, tags, import_export, sync, files
 from .routers.notes import delete_notes_and_attachments
-from .services.maintenance import run_maintenance
-from .utils import TRASH_TAG_NAME
+from .services.maintenance import (
+    request_maintenance, maintenance_stats, start_maintenance_scheduler, stop_maintenance_scheduler,
+)
+from .services.importer import shutdown_process_pool
+from .services.thumbnails import shutdown_thumbnail_pool, thumbnail_stats
+from .services.storage_migration import start_storage_migration, stop_storage_migration, migration_stats
+from .services.file_cleanup import start_file_cleanup, stop_file_cleanup, cleanup_stats
+from .services.tombstones import tombstone_stats
 
 import os
 import logging
@@ -21,7 +26,7 @@ import logging
 #swagger_enabled = True
 swagger_enabled = False
 
-config = load_config()
+config = get_config()
 
 logging.basicConfig(
     level=config["logging"]["level"],
@@ -58,6 +63,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 # ------------------------------------------------------------
@@ -69,6 +75,8 @@ app.include_router(notes.router)
 app.include_router(attachments.router)
 app.include_router(tags.router)
 app.include_router(import_export.router)
+app.include_router(sync.router)
+app.include_router(files.router)
 
 # ------------------------------------------------------------
 # Startup
@@ -80,7 +88,7 @@ def startup():
     init_db(config)
 
     # DBユーザ
-    users = config.get("users", [])
+    users = list(config.get("users", []))     # 共有の設定を書き換えない
     admin_user = os.getenv("ADMIN_USER", "admin").strip()
     admin_pass = os.getenv("ADMIN_PASS", "password").strip()[:72]
     if admin_user and admin_pass:
@@ -96,11 +104,22 @@ def startup():
     os.makedirs(upload_dir, exist_ok=True)
     logger.info(f"📂 File storage initialized: {upload_dir}")
 
-    app.mount("/files", StaticFiles(directory=upload_dir), name="files")
+    # /files/ は routers.files で配信する (シャード化したレイアウトと移行前のパスの両方を解決)
+    # 保存形式の移行は upload.migration.on_startup が有効な場合だけ (既定は POST /maintenance/storage-migration)
+    start_storage_migration(upload_dir, config)
+    start_file_cleanup(upload_dir, config)
+
+    # 期限切れのゴミ箱・未使用タグの削除
+    start_maintenance_scheduler()
 
-    for route in app.routes:
-        if hasattr(route, "app") and isinstance(route.app, StaticFiles):
-            logger.info(f"=== StaticFiles mount  name: {route.name}, path: {route.path}, directory: {route.app.directory}")
+@app.on_event("shutdown")
+def shutdown():
+    stop_maintenance_scheduler()
+    stop_storage_migration()
+    stop_file_cleanup()
+    shutdown_process_pool()
+    shutdown_thumbnail_pool()
+    close_pool()
 
 # ------------------------------------------------------------
 # Health Check
@@ -110,45 +129,59 @@ def startup():
 async def ping_head():
     return Response(status_code=200)
 
+
+@app.get("/maintenance/stats", tags=["maintenance"])
+def get_maintenance_stats(token: str = Depends(oauth2_scheme)):
+    """バックグラウンド処理の最終実行結果 (管理者のみ)"""
+    current_user = get_current_user(token)
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    return {
+        "maintenance": maintenance_stats(),
+        "file_cleanup": cleanup_stats(),
+        "tombstones": tombstone_stats(),
+        "storage_migration": migration_stats(),
+        "auth_cache": auth_cache_stats(),
+        "thumbnails": thumbnail_stats(),
+    }
+
+
+@app.post("/maintenance/storage-migration", tags=["maintenance"])
+def run_storage_migration(token: str = Depends(oauth2_scheme)):
+    """添付ファイルの保存形式の移行をバックグラウンドで始める (管理者のみ、結果は /maintenance/stats)"""
+    current_user = get_current_user(token)
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    upload_dir = os.path.abspath(config["upload"]["dir"])
+    started = start_storage_migration(upload_dir, config, force=True)
+
+    return {"started": started, "storage_migration": migration_stats()}
+
 # ------------------------------------------------------------
 # Trash
 # ------------------------------------------------------------
 
 @app.delete("/trash", tags=["trash"])
-def empty_trash(
-    token: str = Depends(oauth2_scheme),
-    background: BackgroundTasks = None
-):
+def empty_trash(token: str = Depends(oauth2_scheme)):
     """ゴミ箱を空にする"""
-    conn = get_connection()
-    cur = conn.cursor()
-
     current_user = get_current_user(token)
     user_id = current_user["id"]
 
-    # trash タグに紐づく note_id を列挙（ユーザー制約付き）
-    cur.execute("""
-        SELECT DISTINCT n.id
-        FROM notes n
-        JOIN note_tags nt ON nt.note_id = n.id
-        JOIN tags t ON t.id = nt.tag_id
-        WHERE n.user_id = ? AND upper(t.name) = ?
-    """, (user_id, TRASH_TAG_NAME))
-    note_ids = [row[0] for row in cur.fetchall()]
-
-    deleted, files = delete_notes_and_attachments(conn, cur, user_id, note_ids)
-    conn.close()
-
-    if background is not None:
-        background.add_task(run_maintenance, user_id)
-
-    # 実ファイル削除
-    for filename in files:
-        path = os.path.join(config["upload"]["dir"], filename)
-        try:
-            if os.path.exists(path):
-                os.remove(path)
-        except Exception as e:
-            print(f"⚠️ Failed to remove file {path}: {e}")
+    with get_connection() as conn:
+        cur = conn.cursor()
+
+        # ゴミ箱のノートを列挙（ユーザー制約付き、trashed_at の部分インデックス）
+        cur.execute("""
+            SELECT id
+            FROM notes
+            WHERE user_id = ? AND trashed_at IS NOT NULL
+        """, (user_id,))
+        note_ids = [row[0] for row in cur.fetchall()]
+
+        deleted = delete_notes_and_attachments(conn, cur, user_id, note_ids)
+
+    request_maintenance(user_id)
 
     return {"detail": "Trash emptied", "deleted": deleted}
@@ -13,6 +13,7 @@ class FileOut(BaseModel):
     id: int
     filename: str
     url: str
+    download_url: Optional[str] = None
 
 class NoteOut(BaseModel):
     id: int
@@ -24,4 +25,23 @@ class NoteOut(BaseModel):
     created_at: Optional[str] = None
     updated_at: Optional[str] = None
 
+class SearchHit(BaseModel):
+    id: int
+    title: str
+    title_highlight: str
+    snippet: str
+    is_important: int = 0
+    tags: List[str] = []
+    score: float
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+
+class SearchOut(BaseModel):
+    results: List[SearchHit] = []
+    next_offset: Optional[int] = None
 
+class SyncOut(BaseModel):
+    seq: int
+    full: bool = False
+    notes: List[NoteOut] = []
+    deleted: List[int] = []
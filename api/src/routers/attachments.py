@@ -1,119 +1,351 @@
-from fastapi import APIRouter, HTTPException, Request, Depends, UploadFile, File
-from pathlib import Path
+from fastapi import APIRouter, HTTPException, Request, Response, Depends, Query
+from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime, timezone
+from typing import Optional
+from urllib.parse import quote
 import os
-import shutil
-import uuid
-import logging
 
 from ..database import get_connection
-from ..auth import get_current_user, oauth2_scheme
-from ..config import load_config
+from ..auth import get_current_user, oauth2_scheme, create_download_token, verify_download_token, DOWNLOAD_TOKEN_SECONDS
+from ..config import get_config
+from ..services.generation import bump_generation, is_not_modified
+from ..services import thumbnails
+from ..services.file_cleanup import wake_file_cleanup
+from ..services.upload import StreamedUpload, UploadError, receive_upload
+from ..services.storage import (
+    file_entry, guess_mime_type, store_blob, remove_file,
+    resolve_stored_file, stored_path,
+)
 
 router = APIRouter(tags=["attachments"])
-config = load_config()
+config = get_config()
 
+# ブラウザでそのまま表示してよい種類
+INLINE_MIME_PREFIXES = ("image/", "video/", "audio/", "application/pdf", "text/plain")
 
-@router.post("/notes/{note_id}/attachments")
-def upload_attachment(
+# 添付の ID と内容の対応は変わらないので、ETag での再検証なしにしばらく使ってよい
+DOWNLOAD_CACHE_CONTROL = "private, max-age=86400"
+
+
+def _check_note_owner(note_id: int, user_id: int):
+
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+
+        cur.execute("SELECT id FROM notes WHERE id=? AND user_id=?", (note_id, user_id))
+        found = cur.fetchone() is not None
+
+    if not found:
+        raise HTTPException(status_code=404, detail="Note not found")
+
+
+def _save_attachment(note_id: int, user_id: int, upload: StreamedUpload, upload_dir: str):
+
+    mime_type = guess_mime_type(upload.filename, upload.content_type)
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+
+        created = False
+        try:
+            # 同じ内容が保存済みなら一時ファイルは捨てて既存のファイルを参照する
+            filename_stored, created = store_blob(
+                cur, upload_dir, upload.sha256, upload.size, mime_type, upload.commit
+            )
+
+            now = datetime.now(timezone.utc).isoformat()
+
+            cur.execute(
+                """
+                INSERT INTO attachments (note_id, filename_original, filename_stored, uploaded_at, sha256, size, mime_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (note_id, upload.filename, filename_stored, now, upload.sha256, upload.size, mime_type),
+            )
+            attachment_id = cur.lastrowid
+
+            conn.commit()
+        except Exception:
+            # ノートが削除された等で登録できなかった場合は置いたファイルも消す
+            conn.rollback()
+            if created:
+                remove_file(stored_path(upload_dir, filename_stored))
+            raise
+
+        bump_generation(user_id)
+
+    return attachment_id, filename_stored
+
+
+@router.post(
+    "/notes/{note_id}/attachments",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": {"file": {"type": "string", "format": "binary"}},
+                        "required": ["file"],
+                    }
+                }
+            },
+        }
+    },
+)
+async def upload_attachment(
     note_id: int,
     request: Request,
-    file: UploadFile = File(...),
     token: str = Depends(oauth2_scheme),
 ):
+    """
+    添付ファイルをアップロードする
+    本文を読みながら upload.dir の一時ファイルへ直接書き込み、完了したらリネームする
+    """
 
-    conn = get_connection()
-    cur = conn.cursor()
-
-    current_user = get_current_user(token)
+    current_user = await run_in_threadpool(get_current_user, token)
     user_id = current_user["id"]
 
-    cur.execute("SELECT id FROM notes WHERE id=? AND user_id=?", (note_id, user_id))
-    if not cur.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
+    # 本文を受け取る前にノートの存在を確認
+    await run_in_threadpool(_check_note_owner, note_id, user_id)
 
     upload_dir = config["upload"]["dir"]
     max_size_bytes = config["upload"]["max_size_mb"] * 1024 * 1024
     os.makedirs(upload_dir, exist_ok=True)
 
-    # ファイル名衝突回避
-    ext = Path(file.filename).suffix
-    safe_name = f"{uuid.uuid4().hex}{ext}"
-    dest_path = os.path.join(upload_dir, safe_name)
-
-    # サイズ制限
-    file.file.seek(0, os.SEEK_END)
-    size = file.file.tell()
-    file.file.seek(0)
-    if size > max_size_bytes:
-        raise HTTPException(status_code=400, detail=f"File exceeds {config['upload']['max_size_mb']}MB limit")
-
-    # 保存
-    file.file.seek(0)
-    with open(dest_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-
-    now = datetime.now(timezone.utc).isoformat()
-
-    cur.execute(
-        """
-        INSERT INTO attachments (note_id, filename_original, filename_stored, uploaded_at)
-        VALUES (?, ?, ?, ?)
-        """,
-        (note_id, file.filename, safe_name, now),
+    try:
+        upload = await receive_upload(request, "file", upload_dir, max_size_bytes)
+    except UploadError as e:
+        if e.status_code == 413:
+            raise HTTPException(status_code=413, detail=f"File exceeds {config['upload']['max_size_mb']}MB limit")
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+    try:
+        attachment_id, filename_stored = await run_in_threadpool(
+            _save_attachment, note_id, user_id, upload, upload_dir
+        )
+    finally:
+        upload.discard()
+
+    # 画像はバックグラウンドでサムネイルを作っておく
+    thumbnails.schedule_thumbnails(
+        upload.sha256,
+        resolve_stored_file(upload_dir, filename_stored),
+        guess_mime_type(upload.filename, upload.content_type),
     )
-    attachment_id = cur.lastrowid
 
-    conn.commit()
-    conn.close()
+    return {
+        **file_entry(attachment_id, upload.filename, filename_stored),
+        "size": upload.size,
+        "sha256": upload.sha256,
+    }
+
+
+def _content_disposition(disposition: str, filename: str) -> str:
+    # FileResponse と同じ形式 (非 ASCII は RFC 5987)
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"{disposition}; filename*=utf-8''{quoted}"
+    return f'{disposition}; filename="{filename}"'
+
+
+def _download_user_id(request: Request, attachment_id: int, dl: Optional[str]) -> int:
+    # <img> / <iframe> からはヘッダを付けられないので、この添付だけに使える ?dl= も受け付ける
+    authorization = request.headers.get("authorization", "")
+    scheme, _, value = authorization.partition(" ")
+    if scheme.lower() == "bearer" and value:
+        return get_current_user(value)["id"]
+    if dl:
+        return verify_download_token(dl, attachment_id)
+    raise HTTPException(
+        status_code=401,
+        detail="Not authenticated",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+def _find_owned_attachment(attachment_id: int, user_id: int):
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+
+        # 主キーどうしの結合1回で所有者を確認する
+        cur.execute("""
+            SELECT a.filename_original, a.filename_stored, a.sha256, a.mime_type
+            FROM attachments a
+            JOIN notes n ON n.id = a.note_id
+            WHERE a.id = ? AND n.user_id = ?
+        """, (attachment_id, user_id))
+        row = cur.fetchone()
+
+    if not row:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+    return row
+
+
+def _load_owned_attachment(request: Request, attachment_id: int, dl: Optional[str]):
+    """認証し、ユーザのノートの添付であれば (行, 実ファイルのパス) を返す"""
+
+    user_id = _download_user_id(request, attachment_id, dl)
+    row = _find_owned_attachment(attachment_id, user_id)
+
+    path = resolve_stored_file(config["upload"]["dir"], row["filename_stored"])
+    if path is None:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+    return row, path
+
+
+@router.post("/attachments/{attachment_id}/download-token")
+def issue_download_token(attachment_id: int, token: str = Depends(oauth2_scheme)):
+    """
+    <img> / <iframe> / リンクで使う ?dl= のトークンを発行する
+    アクセストークンを URL (アクセスログ・履歴・Referer) に載せないため
+    """
+
+    current_user = get_current_user(token)
+    _find_owned_attachment(attachment_id, current_user["id"])
 
     return {
-        "id": attachment_id,
-        "filename": file.filename,
-        "url": f"/files/{safe_name}",
+        "token": create_download_token(current_user["id"], attachment_id),
+        "expires_in": DOWNLOAD_TOKEN_SECONDS,
     }
 
 
+@router.api_route("/attachments/{attachment_id}", methods=["GET", "HEAD"])
+def download_attachment(
+    attachment_id: int,
+    request: Request,
+    download: bool = False,
+    dl: Optional[str] = Query(None),
+):
+    """
+    添付ファイルをダウンロードする (ノートの所有者のみ)
+    Range / If-Range / If-None-Match に対応。ETag は保存時の SHA-256
+    download.accel_redirect が有効な場合は X-Accel-Redirect を返し、本体は nginx が送る
+    """
+
+    row, path = _load_owned_attachment(request, attachment_id, dl)
+    return attachment_file_response(request, row, path, download)
+
+
+def attachment_file_response(request: Request, row, path: str, download: bool = False):
+    """
+    添付の本体を返す (/attachments/{id} と /files/{filename} 共通)
+    内容が同じ添付は保存先を共有するので、Content-Type は保存名ではなく添付ごとの MIME で決める
+    """
+
+    # 保存名・ハッシュは内容が変わらない限り変わらない
+    etag = f'"{row["sha256"] or row["filename_stored"]}"'
+    media_type = row["mime_type"] or guess_mime_type(row["filename_original"])
+
+    headers = {
+        "ETag": etag,
+        "Cache-Control": DOWNLOAD_CACHE_CONTROL,
+        "X-Content-Type-Options": "nosniff",
+    }
+
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    # 画像・PDF などはそのまま表示、それ以外 (HTML など) はダウンロードさせる
+    inline = (
+        not download
+        and media_type.startswith(INLINE_MIME_PREFIXES)
+        and media_type != "image/svg+xml"       # スクリプトを含められる
+    )
+    disposition = "inline" if inline else "attachment"
+
+    accel_conf = config.get("download", {}).get("accel_redirect", {})
+    if accel_conf.get("enabled"):
+        relpath = os.path.relpath(path, config["upload"]["dir"]).replace(os.sep, "/")
+        prefix = accel_conf.get("prefix", "/_protected_files/").rstrip("/")
+        return Response(
+            status_code=200,
+            media_type=media_type,
+            headers={
+                **headers,
+                "Content-Disposition": _content_disposition(disposition, row["filename_original"]),
+                "X-Accel-Redirect": f"{prefix}/{quote(relpath)}",
+            },
+        )
+
+    # FileResponse が Range・HEAD を処理する (サーバが http.response.pathsend に対応していればゼロコピー)
+    return FileResponse(
+        path, media_type=media_type, filename=row["filename_original"],
+        content_disposition_type=disposition, headers=headers,
+    )
+
+
 @router.delete("/attachments/{attachment_id}")
 def delete_attachment(
     attachment_id: int,
     token: str = Depends(oauth2_scheme),
 ):
 
-    conn = get_connection()
-    cur = conn.cursor()
-
     current_user = get_current_user(token)
     user_id = current_user["id"]
 
-    cur.execute("""
-        SELECT a.filename_stored
-        FROM attachments a
-        JOIN notes n ON a.note_id = n.id
-        WHERE a.id = ? AND n.user_id = ?
-    """, (attachment_id, user_id))
+    with get_connection() as conn:
+        cur = conn.cursor()
 
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Attachment not found")
+        cur.execute("""
+            SELECT a.filename_stored, a.sha256
+            FROM attachments a
+            JOIN notes n ON a.note_id = n.id
+            WHERE a.id = ? AND n.user_id = ?
+        """, (attachment_id, user_id))
 
-    filename_stored = row[0]
-    upload_dir = config["upload"]["dir"]
-    file_path = os.path.join(upload_dir, filename_stored)
+        row = cur.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Attachment not found")
 
-    # DB削除
-    cur.execute("DELETE FROM attachments WHERE id=?", (attachment_id,))
-    conn.commit()
-    conn.close()
+        # DB削除 (ファイルはトリガーが削除待ちに積み、内容を共有している添付が無くなった場合のみ消える)
+        cur.execute("DELETE FROM attachments WHERE id=?", (attachment_id,))
+        conn.commit()
+        bump_generation(user_id)
 
-    # ファイル削除（存在チェック付き）
-    try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-    except Exception as e:
-        # ログだけ出してHTTPエラーにはしない（DBとの整合性優先）
-        logging.getLogger("attachments").warning(f"Failed to delete file {file_path}: {e}")
+    wake_file_cleanup()
 
     return {"detail": "Attachment deleted successfully"}
+
+
+@router.get("/attachments/{attachment_id}/thumbnail")
+def get_attachment_thumbnail(
+    attachment_id: int,
+    request: Request,
+    size: int = Query(256, ge=16, le=4096),
+    dl: Optional[str] = Query(None),
+):
+    """
+    画像の添付の縮小版 (JPEG) を返す
+    size は設定のサイズ (thumbnails.sizes) のうち、要求以上で最小のものに丸める
+    """
+
+    row, path = _load_owned_attachment(request, attachment_id, dl)
+
+    media_type = row["mime_type"] or guess_mime_type(row["filename_original"])
+    if not thumbnails.available() or not thumbnails.is_image(media_type):
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+
+    size = thumbnails.pick_size(size)
+    key = row["sha256"] or row["filename_stored"]
+
+    etag = f'"{key}-{size}"'
+    headers = {"ETag": etag, "Cache-Control": DOWNLOAD_CACHE_CONTROL}
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        thumb_path = thumbnails.get_thumbnail(key, path, size)
+    except TimeoutError:
+        # 大きい画像の生成中。生成は続いているので少し待ってから再要求させる
+        raise HTTPException(
+            status_code=503, detail="Thumbnail is being generated", headers={"Retry-After": "5"},
+        )
+    if thumb_path is None:
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+
+    return FileResponse(thumb_path, media_type="image/jpeg", headers=headers)
@@ -0,0 +1,75 @@
+from fastapi import APIRouter, HTTPException, Request, Query
+from typing import Optional
+
+from ..database import get_connection
+from ..auth import get_current_user, read_download_token
+from ..config import get_config
+from ..services.storage import resolve_stored_file, resolve_alias
+from .attachments import attachment_file_response
+
+router = APIRouter(tags=["files"])
+config = get_config()
+
+
+def resolve_owned_file(filename: str, user_id: int, attachment_id: int | None = None):
+    """
+    /files/{filename} の添付の行と実ファイルを探す (user_id のノートの添付でなければ None)
+    保存名は内容のハッシュで推測できるうえ、同じ内容はユーザをまたいで共有するので必ず所有者を確認する
+    移行前の保存名 (attachment_aliases) は内容単位の保存名に変換してから確認する
+    attachment_id を指定したときは、その添付のファイルである場合だけ
+    """
+
+    upload_dir = config["upload"]["dir"]
+
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+        stored = resolve_alias(cur, filename) or filename
+        cur.execute(f"""
+            SELECT a.filename_original, a.filename_stored, a.sha256, a.mime_type
+            FROM attachments a
+            JOIN notes n ON n.id = a.note_id
+            WHERE a.filename_stored = ? AND n.user_id = ?
+            {"AND a.id = ?" if attachment_id is not None else ""}
+            ORDER BY a.id
+            LIMIT 1
+        """, (stored, user_id) + ((attachment_id,) if attachment_id is not None else ()))
+        row = cur.fetchone()
+
+    if row is None:
+        return None
+
+    path = resolve_stored_file(upload_dir, stored)
+    if path is None:
+        return None
+
+    return row, path
+
+
+@router.api_route("/files/{filename}", methods=["GET", "HEAD"], include_in_schema=False)
+def get_file(filename: str, request: Request, dl: Optional[str] = Query(None)):
+    """
+    以前の StaticFiles マウントと同じ URL で添付ファイルを返す (認証付き、自分の添付のみ)
+    <img> / <a href> からはヘッダを付けられないので、その添付のダウンロードトークン (?dl=) も受け付ける
+    """
+
+    authorization = request.headers.get("authorization", "")
+    scheme, _, value = authorization.partition(" ")
+    if scheme.lower() == "bearer" and value:
+        found = resolve_owned_file(filename, get_current_user(value)["id"])
+    elif dl:
+        user_id, attachment_id = read_download_token(dl)
+        found = resolve_owned_file(filename, user_id, attachment_id)
+    else:
+        raise HTTPException(
+            status_code=401,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    # 他のユーザの添付かどうかも分からないよう、無い場合と同じ 404 にする
+    if found is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    # Content-Type は保存名の拡張子ではなく添付の MIME で決める (nosniff 付き)
+    row, path = found
+    return attachment_file_response(request, row, path)
@@ -1,156 +1,262 @@
-from fastapi import APIRouter, HTTPException, Request, Depends, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Request, Response, Depends, Query
 from typing import Optional
 from datetime import datetime, timezone
-import os
+import json
+import base64
 
 from ..database import get_connection
-from ..models import NoteCreate, NoteUpdate, NoteOut
+from ..models import NoteCreate, NoteUpdate, NoteOut, SearchOut
 from ..auth import get_current_user, oauth2_scheme
-from ..config import load_config
-from ..utils import normalize_newlines, parse_important_flag
-from ..services.maintenance import run_maintenance
-from ..services.tombstones import add_note_tombstone, note_tombstone_exists
+from ..config import get_config
+from ..utils import (
+    normalize_newlines, normalize_tag_name, note_hashes, parse_important_flag, SQL_IN_CHUNK, TRASH_TAG_NAME,
+)
+from ..services.maintenance import request_maintenance
+from ..services.tombstones import add_note_tombstones, note_tombstone_exists
+from ..services.search import search_notes
+from ..services.generation import bump_generation, make_etag, is_not_modified
+from ..services.storage import file_entry
+from ..services.file_cleanup import wake_file_cleanup
 
 router = APIRouter(prefix="/notes", tags=["notes"])
-config = load_config()
+config = get_config()
 
+MAX_PAGE_SIZE = 1000
 
-@router.get("", response_model=list[NoteOut])
-def get_notes(request: Request, tag: Optional[str] = None, token: str = Depends(oauth2_scheme)):
-    conn = get_connection()
-    cur = conn.cursor()
 
+def _encode_cursor(row) -> str:
+    """並び順 (is_important, updated_at, id) の位置をカーソル文字列にする"""
+    raw = json.dumps([row["is_important"], row["updated_at"], row["id"]])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        is_important, updated_at, note_id = json.loads(base64.urlsafe_b64decode(padded))
+        return int(is_important), str(updated_at), int(note_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def load_attachments(cur, note_ids: list[int]) -> dict[int, list[dict]]:
+    """複数ノートの添付ファイルをまとめて取得する (note_id -> files)"""
+    files = {note_id: [] for note_id in note_ids}
+
+    for i in range(0, len(note_ids), SQL_IN_CHUNK):
+        chunk = note_ids[i:i + SQL_IN_CHUNK]
+        placeholders = ",".join(["?"] * len(chunk))
+        cur.execute(
+            f"""
+            SELECT id, note_id, filename_original, filename_stored
+            FROM attachments
+            WHERE note_id IN ({placeholders})
+            ORDER BY id
+            """,
+            chunk,
+        )
+        for fid, note_id, fname, stored in cur.fetchall():
+            files[note_id].append(file_entry(fid, fname, stored))
+
+    return files
+
+
+@router.get("", response_model=list[NoteOut])
+def get_notes(
+    request: Request,
+    response: Response,
+    tag: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    token: str = Depends(oauth2_scheme),
+):
+    """
+    ノート一覧
+    limit を指定するとキーセットページングになり、続きがある場合は
+    X-Next-Cursor ヘッダに次ページのカーソルを返す
+    """
     current_user = get_current_user(token)
     user_id = current_user["id"]
 
-    if tag:
-        # タグ検索 (未使用)
-        cur.execute("""
-            SELECT n.*,
-                   GROUP_CONCAT(t2.name, ',') AS tags
-            FROM notes n
-            JOIN note_tags nt1 ON n.id = nt1.note_id
-            JOIN tags t1 ON nt1.tag_id = t1.id
-            LEFT JOIN note_tags nt2 ON n.id = nt2.note_id
-            LEFT JOIN tags t2 ON nt2.tag_id = t2.id
-            WHERE t1.name = ? AND n.user_id = ?
-            GROUP BY n.id
-            ORDER BY is_important DESC, updated_at DESC
-        """, (tag, user_id))
-    else:
-        cur.execute("""
+    # 変更が無ければ SQL を発行せずに 304
+    etag = make_etag(user_id, "notes", request.url.query)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    where = ["n.user_id = ?"]
+    params = [user_id]
+
+    if tag and tag.upper() == TRASH_TAG_NAME:
+        # ゴミ箱は trashed_at の部分インデックスで引く
+        where.append("n.trashed_at IS NOT NULL")
+
+    elif tag:
+        # タグ検索
+        where.append("""
+            EXISTS (
+                SELECT 1
+                FROM note_tags nt1
+                JOIN tags t1 ON nt1.tag_id = t1.id
+                WHERE nt1.note_id = n.id AND t1.name = ?
+            )
+        """)
+        params.append(tag)
+
+    if cursor:
+        where.append("(n.is_important, n.updated_at, n.id) < (?, ?, ?)")
+        params.extend(_decode_cursor(cursor))
+
+    page_sql = ""
+    if limit is not None:
+        # 続きの有無を判定するため 1 件多く取る
+        page_sql = "LIMIT ?"
+        params.append(limit + 1)
+
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+
+        cur.execute(f"""
             SELECT n.*,
                    GROUP_CONCAT(t.name, ',') AS tags
-            FROM notes n
+            FROM (
+                SELECT n.*
+                FROM notes n
+                WHERE {" AND ".join(where)}
+                ORDER BY n.is_important DESC, n.updated_at DESC, n.id DESC
+                {page_sql}
+            ) n
             LEFT JOIN note_tags nt ON n.id = nt.note_id
             LEFT JOIN tags t ON nt.tag_id = t.id
-            WHERE n.user_id = ?
             GROUP BY n.id
-            ORDER BY is_important DESC, updated_at DESC
-        """, (user_id,))
+            ORDER BY n.is_important DESC, n.updated_at DESC, n.id DESC
+        """, params)
+        rows = cur.fetchall()
 
-    notes = []
-    for row in cur.fetchall():
-        d = dict(row)
-        d["is_important"] = parse_important_flag(d.get("is_important"))
-        d["tags"] = d["tags"].split(",") if d["tags"] else []
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            response.headers["X-Next-Cursor"] = _encode_cursor(rows[-1])
 
-        # 添付ファイル
-        cur2 = conn.cursor()
-        cur2.execute(
-            "SELECT id, filename_original, filename_stored FROM attachments WHERE note_id=?",
-            (d["id"],),
-        )
-        files = [
-            {
-                "id": fid,
-                "filename": fname,
-                "url": f"/files/{stored}",
-            }
-            for fid, fname, stored in cur2.fetchall()
-        ]
-        cur2.close()
-        d["files"] = files
+        # 添付ファイル (ページ分をまとめて取得)
+        files = load_attachments(cur, [row["id"] for row in rows])
 
-        notes.append(d)
+        notes = []
+        for row in rows:
+            d = dict(row)
+            d["is_important"] = parse_important_flag(d.get("is_important"))
+            d["tags"] = d["tags"].split(",") if d["tags"] else []
+            d["files"] = files[d["id"]]
+            notes.append(d)
 
-    conn.close()
     return notes
 
 
-@router.get("/{note_id}", response_model=NoteOut)
-def get_note(note_id: int, request: Request, token: str = Depends(oauth2_scheme)):
-    conn = get_connection()
-    cur = conn.cursor()
+@router.get("/search", response_model=SearchOut)
+def search(
+    q: str = Query(..., min_length=1),
+    tag: Optional[str] = None,
+    important: Optional[bool] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    token: str = Depends(oauth2_scheme),
+):
+    """
+    全文検索 (notes_fts)
+    bm25 のスコア順に、ハイライト済みのタイトルと本文スニペットを返す
+    """
+    current_user = get_current_user(token)
+    user_id = current_user["id"]
+
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
 
+        results, has_more = search_notes(
+            cur, user_id, q,
+            tag=normalize_tag_name(tag) if tag else None,
+            important=important,
+            limit=limit,
+            offset=offset,
+        )
+
+    return {
+        "results": results,
+        "next_offset": offset + limit if has_more else None,
+    }
+
+
+@router.get("/{note_id}", response_model=NoteOut)
+def get_note(note_id: int, request: Request, response: Response, token: str = Depends(oauth2_scheme)):
     current_user = get_current_user(token)
     user_id = current_user["id"]
 
-    cur.execute("""
-        SELECT n.*, GROUP_CONCAT(t.name, ',') AS tags
-        FROM notes n
-        LEFT JOIN note_tags nt ON n.id = nt.note_id
-        LEFT JOIN tags t ON nt.tag_id = t.id
-        WHERE n.id = ? AND n.user_id = ?
-        GROUP BY n.id
-    """, (note_id, user_id))
-    row = cur.fetchone()
-    if not row:
-        raise HTTPException(status_code=404, detail="Note not found")
+    etag = make_etag(user_id, "note", note_id)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+
+        cur.execute("""
+            SELECT n.*, GROUP_CONCAT(t.name, ',') AS tags
+            FROM notes n
+            LEFT JOIN note_tags nt ON n.id = nt.note_id
+            LEFT JOIN tags t ON nt.tag_id = t.id
+            WHERE n.id = ? AND n.user_id = ?
+            GROUP BY n.id
+        """, (note_id, user_id))
+        row = cur.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Note not found")
+
+        d = dict(row)
+
+        # 重要マーク
+        d["is_important"] = parse_important_flag(d.get("is_important"))
+
+        # タグ
+        d["tags"] = d["tags"].split(",") if d["tags"] else []
+
+        # 添付ファイル
+        cur.execute(
+            "SELECT id, filename_original, filename_stored FROM attachments WHERE note_id=?",
+            (note_id,),
+        )
+        files = [file_entry(fid, fname, stored) for fid, fname, stored in cur.fetchall()]
+        d["files"] = files
 
-    d = dict(row)
-
-    # 重要マーク
-    d["is_important"] = parse_important_flag(d.get("is_important"))
-
-    # タグ
-    d["tags"] = d["tags"].split(",") if d["tags"] else []
-
-    # 添付ファイル
-    cur.execute(
-        "SELECT id, filename_original, filename_stored FROM attachments WHERE note_id=?",
-        (note_id,),
-    )
-    files = [
-        {
-            "id": fid,
-            "filename": fname,
-            "url": f"/files/{stored}",
-        }
-        for fid, fname, stored in cur.fetchall()
-    ]
-    d["files"] = files
-
-    conn.close()
     return d
 
 
 @router.post("", response_model=NoteOut)
 def create_note(note: NoteCreate, token: str = Depends(oauth2_scheme)):
 
-    conn = get_connection()
-    cur = conn.cursor()
-
     current_user = get_current_user(token)
     user_id = current_user["id"]
 
-    now = datetime.now(timezone.utc).isoformat()
+    with get_connection() as conn:
+        cur = conn.cursor()
 
-    # 改行コードの正規化
-    content = normalize_newlines(note.content)
+        now = datetime.now(timezone.utc).isoformat()
 
-    if note_tombstone_exists(cur, user_id, note.title, content):
-        conn.close()
-        raise HTTPException(status_code=409, detail="Note was previously deleted")
+        # 改行コードの正規化 (指紋は正規化後の本文から1回だけ計算して保存する)
+        content = normalize_newlines(note.content)
+        note_hash, content_hash = note_hashes(note.title, content)
 
-    cur.execute(
-        "INSERT INTO notes (user_id, title, content, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
-        (user_id, note.title, content, now, now),
-    )
-    note_id = cur.lastrowid
+        if note_tombstone_exists(cur, user_id, note_hash, content_hash):
+            raise HTTPException(status_code=409, detail="Note was previously deleted")
 
-    conn.commit()
-    conn.close()
+        cur.execute(
+            """
+            INSERT INTO notes (user_id, title, content, note_hash, content_hash, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (user_id, note.title, content, note_hash, content_hash, now, now),
+        )
+        note_id = cur.lastrowid
+
+        conn.commit()
+        bump_generation(user_id)
 
     # 添付ファイルとタグは別でAPIで
     return {
@@ -173,44 +279,44 @@ def update_note(
     token: str = Depends(oauth2_scheme),
 ):
 
-    conn = get_connection()
-    cur = conn.cursor()
-
     current_user = get_current_user(token)
     user_id = current_user["id"]
 
-    now = datetime.now(timezone.utc).isoformat()
-
-    # ノートの存在チェックとis_importantの取得
-    cur.execute("SELECT is_important FROM notes WHERE id=? AND user_id=?", (note_id, user_id))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        raise HTTPException(404, "Note not found")
-    is_important = int(row[0])
-
-    # 改行コードの正規化
-    content = normalize_newlines(note.content)
-
-    # 更新
-    cur.execute(
-        "UPDATE notes SET title=?, content=?, updated_at=? WHERE id=? AND user_id=?",
-        (note.title, content, now, note_id, user_id),
-    )
+    with get_connection() as conn:
+        cur = conn.cursor()
+
+        now = datetime.now(timezone.utc).isoformat()
+
+        # ノートの存在チェックとis_importantの取得
+        cur.execute("SELECT is_important FROM notes WHERE id=? AND user_id=?", (note_id, user_id))
+        row = cur.fetchone()
+        if not row:
+            raise HTTPException(404, "Note not found")
+        is_important = int(row[0])
+
+        # 改行コードの正規化
+        content = normalize_newlines(note.content)
+        note_hash, content_hash = note_hashes(note.title, content)
+
+        # 更新
+        cur.execute(
+            """
+            UPDATE notes SET title=?, content=?, note_hash=?, content_hash=?, updated_at=?
+            WHERE id=? AND user_id=?
+            """,
+            (note.title, content, note_hash, content_hash, now, note_id, user_id),
+        )
 
-    # 添付ファイル
-    cur.execute("SELECT id, filename_original, filename_stored FROM attachments WHERE note_id=?", (note_id,))
-    files = [
-        {"id": fid, "filename": fname, "url": f"/files/{stored}"}
-        for fid, fname, stored in cur.fetchall()
-    ]
+        # 添付ファイル
+        cur.execute("SELECT id, filename_original, filename_stored FROM attachments WHERE note_id=?", (note_id,))
+        files = [file_entry(fid, fname, stored) for fid, fname, stored in cur.fetchall()]
 
-    # タグ情報
-    cur.execute("SELECT t.name FROM tags t JOIN note_tags nt ON t.id = nt.tag_id WHERE nt.note_id = ?", (note_id,))
-    tags = [row[0] for row in cur.fetchall()]
+        # タグ情報
+        cur.execute("SELECT t.name FROM tags t JOIN note_tags nt ON t.id = nt.tag_id WHERE nt.note_id = ?", (note_id,))
+        tags = [row[0] for row in cur.fetchall()]
 
-    conn.commit()
-    conn.close()
+        conn.commit()
+        bump_generation(user_id)
 
     return {
         "id": note_id,
@@ -226,33 +332,21 @@ def update_note(
 @router.delete("/{note_id}")
 def delete_note(
     note_id: int,
-    token: str = Depends(oauth2_scheme),
-    background: BackgroundTasks = None
+    token: str = Depends(oauth2_scheme)
 ):
-    conn = get_connection()
-    cur = conn.cursor()
-
     current_user = get_current_user(token)
     user_id = current_user["id"]
 
-    cur.execute("SELECT id FROM notes WHERE id=? AND user_id=?", (note_id, user_id))
-    if not cur.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
+    with get_connection() as conn:
+        cur = conn.cursor()
 
-    deleted, files = _delete_notes_and_attachments(conn, cur, user_id, [note_id])
-    conn.close()
+        cur.execute("SELECT id FROM notes WHERE id=? AND user_id=?", (note_id, user_id))
+        if not cur.fetchone():
+            raise HTTPException(status_code=404, detail="Note not found")
 
-    if background is not None:
-        background.add_task(run_maintenance, user_id)
+        deleted = _delete_notes_and_attachments(conn, cur, user_id, [note_id])
 
-    for filename in files:
-        path = os.path.join(config["upload"]["dir"], filename)
-        try:
-            if os.path.exists(path):
-                os.remove(path)
-        except Exception as e:
-            print(f"⚠️ Failed to remove file {path}: {e}")
+    request_maintenance(user_id)
 
     if deleted == 0:
         raise HTTPException(status_code=404, detail="Note not found")
@@ -263,75 +357,73 @@ def delete_note(
 @router.put("/{note_id}/important")
 def toggle_important(note_id: int, token: str = Depends(oauth2_scheme)):
 
-    conn = get_connection()
-    cur = conn.cursor()
-
     # 認証ユーザ
     current_user = get_current_user(token)
     user_id = current_user["id"]
 
-    # ノート所有チェック & 現在の is_important を取得
-    cur.execute("""
-        SELECT is_important
-        FROM notes
-        WHERE id = ? AND user_id = ?
-    """, (note_id, user_id),)
-    row = cur.fetchone()
+    with get_connection() as conn:
+        cur = conn.cursor()
 
-    if not row:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
+        # ノート所有チェック & 現在の is_important を取得
+        cur.execute("""
+            SELECT is_important
+            FROM notes
+            WHERE id = ? AND user_id = ?
+        """, (note_id, user_id),)
+        row = cur.fetchone()
 
-    current_flag = row["is_important"] or 0
-    new_flag = 0 if current_flag else 1
+        if not row:
+            raise HTTPException(status_code=404, detail="Note not found")
 
-    # 更新
-    cur.execute("""
-        UPDATE notes
-        SET is_important = ?
-        WHERE id = ? AND user_id = ?
-    """, (new_flag, note_id, user_id),)
+        current_flag = row["is_important"] or 0
+        new_flag = 0 if current_flag else 1
 
-    conn.commit()
-    conn.close()
+        # 更新
+        cur.execute("""
+            UPDATE notes
+            SET is_important = ?
+            WHERE id = ? AND user_id = ?
+        """, (new_flag, note_id, user_id),)
+
+        conn.commit()
+        bump_generation(user_id)
 
     return {"note_id": note_id, "is_important": new_flag}
 
 
 def _delete_notes_and_attachments(conn, cur, user_id: int, note_ids: list[int]):
-    """ノートと添付ファイルを削除（内部関数）"""
+    """
+    ノートと添付ファイルを削除（内部関数）
+    IN (...) は SQL_IN_CHUNK 件ずつに分ける (commit は最後に1回)
+    """
     if not note_ids:
-        return 0, []
-
-    placeholders = ",".join(["?"] * len(note_ids))
-
-    # 実ファイル削除用に filename_stored を回収
-    cur.execute(
-        f"SELECT filename_stored FROM attachments WHERE note_id IN ({placeholders})",
-        note_ids,
-    )
-    files = [row[0] for row in cur.fetchall()]
-
-    cur.execute(
-        f"SELECT id, title, content FROM notes WHERE user_id=? AND id IN ({placeholders})",
-        [user_id, *note_ids],
-    )
-    for row in cur.fetchall():
-        add_note_tombstone(cur, user_id, row["title"], row["content"], row["id"])
-
-    # attachments -> notes の順で削除
-    cur.execute(
-        f"DELETE FROM attachments WHERE note_id IN ({placeholders})",
-        note_ids,
-    )
-    cur.execute(
-        f"DELETE FROM notes WHERE user_id=? AND id IN ({placeholders})",
-        [user_id, *note_ids],
-    )
-    deleted = cur.rowcount
+        return 0
+
+    # 墓標は保存済みの指紋をコピーする (本文は読まない)
+    add_note_tombstones(cur, note_ids, user_id)
+
+    deleted = 0
+    for i in range(0, len(note_ids), SQL_IN_CHUNK):
+        chunk = note_ids[i:i + SQL_IN_CHUNK]
+        placeholders = ",".join(["?"] * len(chunk))
+
+        # attachments -> notes の順で削除 (実ファイルはトリガーが削除待ちに積む)
+        cur.execute(
+            f"DELETE FROM attachments WHERE note_id IN ({placeholders})",
+            chunk,
+        )
+        cur.execute(
+            f"DELETE FROM notes WHERE user_id=? AND id IN ({placeholders})",
+            [user_id, *chunk],
+        )
+        deleted += cur.rowcount
 
     conn.commit()
-    return deleted, files
+    bump_generation(user_id)
+
+    wake_file_cleanup()
+
+    return deleted
 
 
 # この関数は他のルーターからも使われるためエクスポート
@@ -0,0 +1,73 @@
+from fastapi import APIRouter, Depends, Query
+
+from ..database import get_connection
+from ..models import SyncOut
+from ..auth import get_current_user, oauth2_scheme
+from ..utils import parse_important_flag
+from .notes import load_attachments
+
+router = APIRouter(tags=["sync"])
+
+
+@router.get("/sync", response_model=SyncOut)
+def sync_notes(since: int = Query(0, ge=0), token: str = Depends(oauth2_scheme)):
+    """
+    差分同期
+    since より後に作成・更新されたノートと、削除されたノートIDを返す
+    since=0 (または未知のシーケンス) の場合は全件を返す (full=true)
+    """
+    current_user = get_current_user(token)
+    user_id = current_user["id"]
+
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+
+        # 先に現在のシーケンスを読む (この後に入った変更は次回も返るだけで取りこぼさない)
+        cur.execute("SELECT seq FROM sync_seq WHERE user_id = ?", (user_id,))
+        row = cur.fetchone()
+        seq = row[0] if row else 0
+
+        full = since == 0 or since > seq
+
+        if full:
+            cur.execute("""
+                SELECT n.*, GROUP_CONCAT(t.name, ',') AS tags
+                FROM notes n
+                LEFT JOIN note_tags nt ON n.id = nt.note_id
+                LEFT JOIN tags t ON nt.tag_id = t.id
+                WHERE n.user_id = ?
+                GROUP BY n.id
+            """, (user_id,))
+            rows = cur.fetchall()
+            deleted = []
+
+        else:
+            cur.execute("""
+                SELECT n.*, GROUP_CONCAT(t.name, ',') AS tags
+                FROM note_changes c
+                JOIN notes n ON n.id = c.note_id
+                LEFT JOIN note_tags nt ON n.id = nt.note_id
+                LEFT JOIN tags t ON nt.tag_id = t.id
+                WHERE c.user_id = ? AND c.seq > ? AND c.deleted = 0
+                GROUP BY n.id
+            """, (user_id, since))
+            rows = cur.fetchall()
+
+            cur.execute("""
+                SELECT note_id
+                FROM note_changes
+                WHERE user_id = ? AND seq > ? AND deleted = 1
+            """, (user_id, since))
+            deleted = [r[0] for r in cur.fetchall()]
+
+        files = load_attachments(cur, [r["id"] for r in rows])
+
+        notes = []
+        for r in rows:
+            d = dict(r)
+            d["is_important"] = parse_important_flag(d.get("is_important"))
+            d["tags"] = d["tags"].split(",") if d["tags"] else []
+            d["files"] = files[d["id"]]
+            notes.append(d)
+
+    return {"seq": seq, "full": full, "notes": notes, "deleted": deleted}
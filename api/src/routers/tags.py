@@ -1,10 +1,11 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
 
 from ..database import get_connection
 from ..auth import get_current_user, oauth2_scheme
 from ..utils import normalize_tag_name, TRASH_TAG_NAME
-from ..services.maintenance import run_maintenance
-from ..services.tombstones import add_note_tombstone
+from ..services.maintenance import request_maintenance
+from ..services.tombstones import add_note_tombstones
+from ..services.generation import bump_generation, make_etag, is_not_modified
 
 router = APIRouter(tags=["tags"])
 
@@ -12,48 +13,47 @@ router = APIRouter(tags=["tags"])
 @router.post("/notes/{note_id}/tags")
 def add_tag(note_id: int, tag: dict, token: str = Depends(oauth2_scheme)):
 
-    conn = get_connection()
-    cur = conn.cursor()
-
     current_user = get_current_user(token)
     user_id = current_user["id"]
 
-    cur.execute("SELECT id, title, content FROM notes WHERE id=? AND user_id=?", (note_id, user_id))
-    note_row = cur.fetchone()
-    if not note_row:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
+    # 例外で抜けても書き込み接続をプールへ返す
+    with get_connection() as conn:
+        cur = conn.cursor()
 
-    # タグの正規化
-    tag_name = normalize_tag_name(tag.get("name"))
-    if not tag_name:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Tag name required")
+        cur.execute("SELECT id FROM notes WHERE id=? AND user_id=?", (note_id, user_id))
+        if not cur.fetchone():
+            raise HTTPException(status_code=404, detail="Note not found")
 
-    # タグ作成
-    cur.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag_name,))
-    cur.execute("SELECT id FROM tags WHERE name=?", (tag_name,))
-    tag_id = cur.fetchone()[0]
+        # タグの正規化
+        name = tag.get("name")
+        tag_name = normalize_tag_name(name) if isinstance(name, str) else ""
+        if not tag_name:
+            raise HTTPException(status_code=400, detail="Tag name required")
 
-    # note_tags 関連付け
-    cur.execute("INSERT OR IGNORE INTO note_tags (note_id, tag_id) VALUES (?, ?)", (note_id, tag_id))
+        # タグ作成
+        cur.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag_name,))
+        cur.execute("SELECT id FROM tags WHERE name=?", (tag_name,))
+        tag_id = cur.fetchone()[0]
 
-    if tag_name == TRASH_TAG_NAME:
-        add_note_tombstone(cur, user_id, note_row["title"], note_row["content"], note_id)
+        # note_tags 関連付け
+        cur.execute("INSERT OR IGNORE INTO note_tags (note_id, tag_id) VALUES (?, ?)", (note_id, tag_id))
 
-    conn.commit()
+        if tag_name == TRASH_TAG_NAME:
+            add_note_tombstones(cur, [note_id], user_id)
 
-    run_maintenance(user_id=user_id)
+        conn.commit()
+        bump_generation(user_id)
 
-    # タグ一覧を返す
-    cur.execute("""
-        SELECT t.name FROM tags t
-        JOIN note_tags nt ON t.id = nt.tag_id
-        WHERE nt.note_id=?
-    """, (note_id,))
-    tags = [row[0] for row in cur.fetchall()]
+        # 期限切れのゴミ箱の削除などはバックグラウンドでまとめて行う
+        request_maintenance(user_id)
 
-    conn.close()
+        # タグ一覧を返す
+        cur.execute("""
+            SELECT t.name FROM tags t
+            JOIN note_tags nt ON t.id = nt.tag_id
+            WHERE nt.note_id=?
+        """, (note_id,))
+        tags = [row[0] for row in cur.fetchall()]
 
     return {"note_id": note_id, "tags": tags}
 
@@ -61,71 +61,64 @@ def add_tag(note_id: int, tag: dict, token: str = Depends(oauth2_scheme)):
 @router.delete("/notes/{note_id}/tags/{tag_name}")
 def remove_tag(note_id: int, tag_name: str, token: str = Depends(oauth2_scheme)):
 
-    conn = get_connection()
-    cur = conn.cursor()
-
     current_user = get_current_user(token)
     user_id = current_user["id"]
 
-    cur.execute("SELECT id FROM notes WHERE id=? AND user_id=?", (note_id, user_id))
-    if not cur.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
+    with get_connection() as conn:
+        cur = conn.cursor()
 
-    # タグID
-    cur.execute("SELECT id FROM tags WHERE name=?", (tag_name,))
-    tag_row = cur.fetchone()
-    if not tag_row:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Tag not found")
-    tag_id = tag_row[0]
+        cur.execute("SELECT id FROM notes WHERE id=? AND user_id=?", (note_id, user_id))
+        if not cur.fetchone():
+            raise HTTPException(status_code=404, detail="Note not found")
 
-    # note_tags
-    cur.execute("DELETE FROM note_tags WHERE note_id=? AND tag_id=?", (note_id, tag_id))
-    conn.commit()
+        # タグID
+        cur.execute("SELECT id FROM tags WHERE name=?", (tag_name,))
+        tag_row = cur.fetchone()
+        if not tag_row:
+            raise HTTPException(status_code=404, detail="Tag not found")
+        tag_id = tag_row[0]
 
-    run_maintenance(user_id=user_id)
+        # note_tags
+        cur.execute("DELETE FROM note_tags WHERE note_id=? AND tag_id=?", (note_id, tag_id))
+        conn.commit()
+        bump_generation(user_id)
 
-    # タグ一覧を返す
-    cur.execute("""
-        SELECT t.name FROM tags t
-        JOIN note_tags nt ON t.id = nt.tag_id
-        WHERE nt.note_id=?
-    """, (note_id,))
-    tags = [row[0] for row in cur.fetchall()]
+        # 外したタグが未使用になっていればバックグラウンドで消す
+        request_maintenance(user_id, [tag_id])
 
-    conn.close()
+        # タグ一覧を返す
+        cur.execute("""
+            SELECT t.name FROM tags t
+            JOIN note_tags nt ON t.id = nt.tag_id
+            WHERE nt.note_id=?
+        """, (note_id,))
+        tags = [row[0] for row in cur.fetchall()]
 
     return {"note_id": note_id, "tags": tags}
 
 
 @router.get("/tags")
-def get_all_tags(token: str = Depends(oauth2_scheme)):
-    conn = get_connection()
-    cur = conn.cursor()
-
+def get_all_tags(request: Request, response: Response, token: str = Depends(oauth2_scheme)):
     current_user = get_current_user(token)
     user_id = current_user["id"]
 
-    # ノート数にtrashタグを持つノートを含めない
-    cur.execute("""
-        SELECT t.name,
-               COUNT(nt.note_id) AS note_count
-        FROM tags t
-        JOIN note_tags nt ON t.id = nt.tag_id
-        JOIN notes n ON nt.note_id = n.id
-        WHERE n.user_id = ?
-          AND nt.note_id NOT IN (
-              SELECT nt2.note_id
-              FROM note_tags nt2
-              JOIN tags t2 ON nt2.tag_id = t2.id
-              WHERE UPPER(t2.name) = ?
-          )
-        GROUP BY t.id
-        ORDER BY t.name COLLATE NOCASE
-    """, (user_id, TRASH_TAG_NAME))
-
-    tags = [{"name": row[0], "note_count": row[1]} for row in cur.fetchall()]
-
-    conn.close()
+    etag = make_etag(user_id, "tags")
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+
+        # ノート数はトリガーが更新する user_tag_counts から読む (trashタグを持つノートは含まない)
+        cur.execute("""
+            SELECT t.name, c.note_count
+            FROM user_tag_counts c
+            JOIN tags t ON t.id = c.tag_id
+            WHERE c.user_id = ? AND c.note_count > 0
+            ORDER BY t.name COLLATE NOCASE
+        """, (user_id,))
+
+        tags = [{"name": row[0], "note_count": row[1]} for row in cur.fetchall()]
+
     return tags
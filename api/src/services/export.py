@@ -0,0 +1,216 @@
+from datetime import datetime
+import io
+import os
+import time
+import zipfile
+
+from ..database import get_connection
+from ..utils import sanitize_filename
+from .storage import open_stored_file
+
+NOTE_BATCH_SIZE = 200           # 1回に読むノート数 (タグ・添付もこの単位でまとめて取得)
+FILE_CHUNK_SIZE = 1024 * 1024   # 添付ファイルを読む単位
+
+
+class _ZipStream(io.RawIOBase):
+    """
+    ZipFile の書き込み先
+    書かれたバイト列を溜めておき、drain() で取り出す (シーク不可なのでデータディスクリプタ形式になる)
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _fetch_tags(cur, note_ids):
+    tags = {note_id: [] for note_id in note_ids}
+    placeholders = ",".join(["?"] * len(note_ids))
+    cur.execute(
+        f"""
+        SELECT nt.note_id, t.name
+        FROM tags t
+        JOIN note_tags nt ON nt.tag_id = t.id
+        WHERE nt.note_id IN ({placeholders})
+        """,
+        note_ids,
+    )
+    for note_id, name in cur.fetchall():
+        tags[note_id].append(name)
+    return tags
+
+
+def _fetch_attachments(cur, note_ids):
+    attachments = {note_id: [] for note_id in note_ids}
+    placeholders = ",".join(["?"] * len(note_ids))
+    cur.execute(
+        f"""
+        SELECT note_id, filename_original, filename_stored
+        FROM attachments
+        WHERE note_id IN ({placeholders})
+        ORDER BY id
+        """,
+        note_ids,
+    )
+    for row in cur.fetchall():
+        attachments[row["note_id"]].append(row)
+    return attachments
+
+
+def _note_text(note, tags) -> str:
+
+    # 本文 + タグ追記
+    text = note["content"] or ""
+    lines = [text]
+
+    meta = []
+
+    if tags:
+        meta.append("Tags: " + ", ".join(tags))
+
+    if note["is_important"]:
+        meta.append("Important: true")
+
+    if meta:
+        lines.append("\n---")
+        lines.append("\n".join(meta))
+
+    return "\n".join(lines)
+
+
+def iter_export_zip(user_id: int, upload_dir: str):
+    """
+    ユーザの全ノートを ZIP にして、少しずつ bytes を yield する
+    ノートはバッチ単位で読み、添付ファイルはチャンク単位でコピーするので
+    メモリ使用量はノート数・添付ファイルの合計サイズに依存しない
+    """
+
+    buf = _ZipStream()
+
+    # 専用の接続で一貫したスナップショットから読む
+    conn = get_connection(readonly=True, dedicated=True)
+    notes_cur = conn.cursor()
+    cur = conn.cursor()
+
+    try:
+        conn.execute("BEGIN")
+
+        notes_cur.execute(
+            "SELECT id, title, content, is_important, updated_at FROM notes WHERE user_id=? ORDER BY id",
+            (user_id,),
+        )
+
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+
+            while True:
+
+                notes = notes_cur.fetchmany(NOTE_BATCH_SIZE)
+                if not notes:
+                    break
+
+                note_ids = [note["id"] for note in notes]
+                tags_by_note = _fetch_tags(cur, note_ids)
+                attachments_by_note = _fetch_attachments(cur, note_ids)
+
+                for note in notes:
+
+                    note_id = note["id"]
+                    raw_title = note["title"] or "untitled"
+                    safe_title = sanitize_filename(raw_title, maxlen=80)
+
+                    text = _note_text(note, tags_by_note[note_id])
+
+                    # 本文ファイルは note_id を含めて一意化
+                    txt_name = f"{note_id}`{safe_title}.txt"
+
+                    # updated_at をファイル日時に設定
+                    updated_at = note["updated_at"]
+
+                    if updated_at:
+                        # 例: "2025-11-11T12:34:56" → datetime オブジェクトに変換
+                        dt = datetime.fromisoformat(updated_at)
+                        # ZipInfo で日付を指定
+                        info = zipfile.ZipInfo(txt_name)
+                        info.date_time = dt.timetuple()[:6]  # (年, 月, 日, 時, 分, 秒)
+                        zf.writestr(info, text)
+                    else:
+                        # updated_at 無い場合は普通に書き込む
+                        zf.writestr(txt_name, text)
+
+                    data = buf.drain()
+                    if data:
+                        yield data
+
+                    # 添付は note_id ベースの一意ディレクトリへ
+                    attach_dir = f"attachments/{note_id}`{safe_title}/"
+
+                    # 同名回避のため、ZIP内で書いた名前を追跡
+                    written_names = set()
+
+                    for att in attachments_by_note[note_id]:
+                        src = open_stored_file(upload_dir, att["filename_stored"])
+                        if src is None:
+                            continue
+
+                        base = sanitize_filename(att["filename_original"], maxlen=100)
+
+                        # 拡張子分離
+                        if "." in base:
+                            stem, ext = base.rsplit(".", 1)
+                            ext = "." + ext
+                        else:
+                            stem, ext = base, ""
+
+                        # 衝突回避（-1, -2 ... 付与）
+                        candidate = stem + ext
+                        idx = 1
+                        while candidate in written_names:
+                            candidate = f"{stem}-{idx}{ext}"
+                            idx += 1
+
+                        written_names.add(candidate)
+
+                        st = os.fstat(src.fileno())
+                        info = zipfile.ZipInfo(f"{attach_dir}{candidate}", time.localtime(st.st_mtime)[:6])
+                        info.file_size = st.st_size
+                        info.external_attr = (st.st_mode & 0xFFFF) << 16
+                        info.compress_type = zipfile.ZIP_DEFLATED
+
+                        # ファイル全体を読み込まずにチャンク単位で書き出す
+                        with src, zf.open(info, "w") as dst:
+                            while True:
+                                chunk = src.read(FILE_CHUNK_SIZE)
+                                if not chunk:
+                                    break
+                                dst.write(chunk)
+                                data = buf.drain()
+                                if data:
+                                    yield data
+
+                        data = buf.drain()
+                        if data:
+                            yield data
+
+        # セントラルディレクトリ
+        data = buf.drain()
+        if data:
+            yield data
+
+    finally:
+        conn.close()
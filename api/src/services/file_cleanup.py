@@ -0,0 +1,280 @@
+"""
+添付ファイルの後片付け (バックグラウンド)
+
+- file_deletions (削除待ち) を消化する
+  行はトリガーが行の削除と同じトランザクションで積むので、リクエスト中にファイルを消す必要がない
+  失敗したものは間隔を伸ばしながら再試行する
+- upload_dir と DB を突き合わせ、どこからも参照されていないファイルを削除待ちに積む (バッチ単位)
+"""
+
+import logging
+import os
+import threading
+import time
+
+from ..database import get_connection
+from ..utils import SQL_IN_CHUNK
+from .storage import resolve_stored_file
+from .thumbnails import invalidate_thumbnails
+
+logger = logging.getLogger("file_cleanup")
+
+TEMP_PREFIXES = (".upload-", ".thumb-")
+
+_thread = None
+_stop = threading.Event()
+_wake = threading.Event()
+
+stats = {
+    "deleted": 0,
+    "kept": 0,              # 削除待ちの間に再び参照された
+    "failed": 0,
+    "swept": 0,             # 孤立ファイルとして積んだ数
+    "temp_removed": 0,
+    "last_drain_at": None,
+    "last_sweep_at": None,
+}
+
+
+def wake_file_cleanup():
+    """削除待ちを積んだ後に呼ぶ (次の周期を待たずに消化する)"""
+    _wake.set()
+
+
+def _is_referenced(cur, filename_stored: str) -> bool:
+    cur.execute(
+        """
+        SELECT EXISTS (SELECT 1 FROM attachments WHERE filename_stored = ?)
+            OR EXISTS (SELECT 1 FROM attachment_blobs WHERE filename_stored = ?)
+        """,
+        (filename_stored, filename_stored),
+    )
+    return bool(cur.fetchone()[0])
+
+
+def drain_deletions(upload_dir: str, batch_size: int = 100, max_backoff: int = 3600) -> int:
+    """
+    削除待ちを batch_size 件処理して、処理した件数を返す
+    ファイルの削除は書き込みロックを持ったまま行う (同じ内容の再アップロードと競合させない)
+    """
+
+    conn = get_connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(
+            """
+            SELECT id, filename_stored, thumbnail_key, attempts
+            FROM file_deletions
+            WHERE next_attempt_at <= datetime('now')
+            ORDER BY id
+            LIMIT ?
+            """,
+            (batch_size,),
+        )
+        rows = cur.fetchall()
+
+        done = []
+        for row in rows:
+
+            # 削除待ちの間に同じ内容がアップロードされた場合などは消さない
+            if _is_referenced(cur, row["filename_stored"]):
+                done.append((row["id"],))
+                stats["kept"] += 1
+                continue
+
+            path = resolve_stored_file(upload_dir, row["filename_stored"])
+            try:
+                if path:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                backoff = min(max_backoff, 10 * 2 ** row["attempts"])
+                cur.execute(
+                    """
+                    UPDATE file_deletions
+                    SET attempts = attempts + 1,
+                        next_attempt_at = datetime('now', ?),
+                        last_error = ?
+                    WHERE id = ?
+                    """,
+                    (f"+{backoff} seconds", str(e), row["id"]),
+                )
+                stats["failed"] += 1
+                logger.warning(f"Failed to delete file {path} (attempt {row['attempts'] + 1}): {e}")
+                continue
+
+            invalidate_thumbnails(row["thumbnail_key"])
+            done.append((row["id"],))
+            stats["deleted"] += 1
+
+        cur.executemany("DELETE FROM file_deletions WHERE id = ?", done)
+        conn.commit()
+
+    finally:
+        conn.close()
+
+    stats["last_drain_at"] = time.time()
+    return len(rows)
+
+
+def _iter_upload_files(upload_dir: str):
+    for root, _, files in os.walk(upload_dir):
+        for name in files:
+            yield root, name
+
+
+def sweep_batch(upload_dir: str, files_iter, batch_size: int = 500, grace_seconds: int = 3600) -> bool:
+    """
+    upload_dir のファイルを batch_size 件調べ、参照されていないものを削除待ちに積む
+    アップロード中のファイルを消さないよう、更新から grace_seconds 経っていないものは対象外
+    走査が終わったら False
+    """
+
+    now = time.time()
+    candidates = {}
+    finished = True
+
+    for root, name in files_iter:
+        path = os.path.join(root, name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue
+
+        if now - mtime < grace_seconds:
+            pass
+        elif name.startswith(TEMP_PREFIXES):
+            # 中断したアップロード・インポートの一時ファイル (どこからも参照されない)
+            try:
+                os.remove(path)
+                stats["temp_removed"] += 1
+            except OSError:
+                pass
+        elif not name.startswith("."):
+            candidates[name] = path
+
+        if len(candidates) >= batch_size:
+            finished = False
+            break
+
+    conn = get_connection()
+    cur = conn.cursor()
+
+    try:
+        if candidates:
+            names = list(candidates)
+            referenced = set()
+            # IN (...) は SQL_IN_CHUNK 件ずつ、表ごとに調べる (パラメータ数を上限内に収める)
+            for i in range(0, len(names), SQL_IN_CHUNK):
+                chunk = names[i:i + SQL_IN_CHUNK]
+                placeholders = ",".join(["?"] * len(chunk))
+                for table in ("attachments", "attachment_blobs"):
+                    cur.execute(
+                        f"SELECT filename_stored FROM {table} WHERE filename_stored IN ({placeholders})",
+                        chunk,
+                    )
+                    referenced.update(row[0] for row in cur.fetchall())
+            orphans = [(name,) for name in names if name not in referenced]
+
+            cur.executemany(
+                "INSERT OR IGNORE INTO file_deletions (filename_stored) VALUES (?)",
+                orphans,
+            )
+            stats["swept"] += len(orphans)
+
+            if orphans:
+                logger.info(f"🧹 Queued {len(orphans)} orphaned files for deletion")
+
+        # 参照の無いまま残った内容 (refcount 0) も片付ける
+        cur.execute(
+            """
+            SELECT sha256, filename_stored FROM attachment_blobs
+            WHERE refcount <= 0 AND created_at < ?
+            """,
+            (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now - grace_seconds)),),
+        )
+        for sha256, filename_stored in cur.fetchall():
+            cur.execute("DELETE FROM attachment_blobs WHERE sha256 = ? AND refcount <= 0", (sha256,))
+            cur.execute(
+                "INSERT OR IGNORE INTO file_deletions (filename_stored, thumbnail_key) VALUES (?, ?)",
+                (filename_stored, sha256),
+            )
+
+        conn.commit()
+    finally:
+        conn.close()
+
+    return not finished
+
+
+def _run(upload_dir: str, conf: dict):
+
+    interval = float(conf.get("interval_seconds", 30))
+    batch_size = int(conf.get("batch_size", 100))
+    max_backoff = int(conf.get("max_backoff_seconds", 3600))
+    sweep_interval = float(conf.get("sweep_interval_hours", 6)) * 3600
+    sweep_batch_size = int(conf.get("sweep_batch_size", 500))
+    grace_seconds = int(conf.get("grace_seconds", 3600))
+
+    files_iter = None
+    next_sweep_at = time.time() + min(sweep_interval, 300)
+
+    while not _stop.is_set():
+
+        _wake.wait(interval)
+        _wake.clear()
+        if _stop.is_set():
+            break
+
+        try:
+            while drain_deletions(upload_dir, batch_size, max_backoff) >= batch_size:
+                if _stop.is_set():
+                    break
+
+            # 走査は1周期に1バッチずつ進める
+            if files_iter is None and time.time() >= next_sweep_at:
+                files_iter = _iter_upload_files(upload_dir)
+
+            if files_iter is not None:
+                if not sweep_batch(upload_dir, files_iter, sweep_batch_size, grace_seconds):
+                    files_iter = None
+                    next_sweep_at = time.time() + sweep_interval
+                    stats["last_sweep_at"] = time.time()
+                _wake.set()     # 積んだものをすぐ消化する
+
+        except Exception:
+            logger.exception("File cleanup failed")
+
+
+def start_file_cleanup(upload_dir: str, config: dict):
+
+    global _thread
+
+    if _thread is not None and _thread.is_alive():
+        return
+
+    conf = config.get("upload", {}).get("cleanup", {})
+
+    _stop.clear()
+    _wake.set()     # 起動時に溜まっている分を消化する
+    _thread = threading.Thread(
+        target=_run, args=(upload_dir, conf), name="file-cleanup", daemon=True,
+    )
+    _thread.start()
+
+
+def stop_file_cleanup(timeout: float = 5.0):
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join(timeout)
+
+
+def cleanup_stats():
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*), COALESCE(MAX(attempts), 0) FROM file_deletions")
+        pending, max_attempts = cur.fetchone()
+    return {**stats, "pending": pending, "max_attempts": max_attempts}
@@ -0,0 +1,47 @@
+import threading
+import time
+import hashlib
+
+# ユーザごとの世代カウンタ (書き込みのたびに進める)
+# ETag をここから作るので、読み取り側は SQL を発行せずに 304 を返せる
+# ※ プロセス内のカウンタなので、複数ワーカーで動かす場合は共有ストアが必要
+
+_lock = threading.Lock()
+_generations = {}
+_global_generation = 0
+
+# 再起動後に古い ETag と一致しないよう起動時刻を混ぜる
+_epoch = format(time.time_ns(), "x")
+
+
+def bump_generation(user_id: int | None = None):
+    """書き込み後 (commit 後) に呼ぶ。user_id=None は全ユーザ"""
+    global _global_generation
+    with _lock:
+        if user_id is None:
+            _global_generation += 1
+        else:
+            _generations[user_id] = _generations.get(user_id, 0) + 1
+
+
+def current_generation(user_id: int) -> str:
+    with _lock:
+        return f"{_epoch}.{_global_generation}.{_generations.get(user_id, 0)}"
+
+
+def make_etag(user_id: int, *parts) -> str:
+    """世代とリソース (パス・クエリ) から強い ETag を作る"""
+    key = "\0".join(str(p) for p in parts)
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+    return f'"{current_generation(user_id)}.{digest}"'
+
+
+def is_not_modified(request, etag: str) -> bool:
+    """If-None-Match が ETag と一致するか"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [c.strip() for c in header.split(",")]
+    return etag in candidates or f"W/{etag}" in candidates
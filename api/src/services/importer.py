@@ -0,0 +1,493 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from datetime import datetime, timezone
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from ..database import deferred_fts_index, get_connection
+from ..utils import normalize_newlines, note_hashes, parse_important_flag, TRASH_TAG_NAME
+from .generation import bump_generation
+from .thumbnails import is_image, schedule_thumbnails
+from .tombstones import add_note_tombstones
+from .storage import (
+    copy_to_blob, guess_mime_type, remove_file, resolve_stored_file, store_blob, stored_path,
+)
+from .upload import TEMP_PREFIX, TEMP_SUFFIX
+
+logger = logging.getLogger("simplynote")
+
+ATTACHMENT_PREFIX = "attachments/"
+COPY_CHUNK_SIZE = 1024 * 1024
+BATCH_SIZE = 500                # 1トランザクションで書き込む件数 (書き込み接続はこの単位で手放す)
+PARSE_CHUNK_SIZE = 200          # 並列モードで1プロセスに渡すノート数
+
+# 並列モード用のプロセスプール (初回の並列インポートで作成して使い回す)
+_process_pool = None
+_process_pool_workers = 0
+_process_pool_lock = threading.Lock()
+
+
+def index_attachments(zf):
+    """
+    ZIP 内の添付ファイルを export 時の note_id ごとにまとめる (1パス)
+    attachments/{note_id}`{タイトル}/{ファイル名}
+    """
+    index = {}
+    for info in zf.infolist():
+        if info.is_dir() or not info.filename.startswith(ATTACHMENT_PREFIX):
+            continue
+        rest = info.filename[len(ATTACHMENT_PREFIX):]
+        if "`" not in rest:
+            continue
+        export_note_id = rest.split("`", 1)[0]
+        index.setdefault(export_note_id, []).append(info)
+    return index
+
+
+def is_note_entry(info) -> bool:
+    # .txt, .md (添付ファイルのディレクトリは除く)
+    if not info.filename.endswith((".txt", ".md")):
+        return False
+    return not info.filename.startswith(ATTACHMENT_PREFIX)
+
+
+def parse_note_entry(filename: str, date_time, data: bytes):
+    """
+    ZIP 内のノート1件を解析する (DB に触らない純粋な処理)
+    UTF-8 でない場合は None
+    """
+
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+    # ファイル名分離 (例: 123`タイトル.txt or タイトル.txt)
+    name = filename.rsplit("/", 1)[-1]
+    base = name.rsplit(".", 1)[0]
+
+    export_note_id = None
+    title = base
+    if "`" in base:
+        note_parts = base.split("`", 1)
+        export_note_id = note_parts[0]
+        title = note_parts[1]
+
+    # ZIP内の更新日時を datetime に変換
+    # zip内のファイルのタイムゾーンが不明なのでサーバのタイムゾーンと合わせる
+    local_tz = datetime.now().astimezone().tzinfo
+    local = datetime(*date_time, tzinfo=local_tz)
+    updated_at = local.astimezone(timezone.utc)
+
+    # タグ・重要フラグなどのメタデータを本文から分離
+    tags = []
+    is_important = 0
+    content_text = text
+
+    if "\n---\n" in text:
+        body, meta_raw = text.split("\n---\n", 1)
+        content_text = body.rstrip("\n\r")
+
+        for line in meta_raw.splitlines():
+            line = line.strip()
+            if line.startswith("Tags:"):
+                tag_line = line.replace("Tags:", "", 1).strip()
+                tags = [t.strip() for t in tag_line.split(",") if t.strip()]
+            if line.startswith("Important:"):
+                val = line.replace("Important:", "", 1).strip().lower()
+                is_important = parse_important_flag(val)
+
+    # 改行コードの正規化 (指紋も並列モードではここで計算する)
+    content = normalize_newlines(content_text)
+    note_hash, content_hash = note_hashes(title, content)
+
+    return {
+        "export_note_id": export_note_id,
+        "title": title,
+        "content": content,
+        "note_hash": note_hash,
+        "content_hash": content_hash,
+        "is_important": is_important,
+        "tags": tags,
+        "updated_at": updated_at,
+    }
+
+
+def parse_note_chunk(entries):
+    """プロセスプールで実行する: [(filename, date_time, data), ...] -> [(filename, record), ...]"""
+    return [(filename, parse_note_entry(filename, date_time, data)) for filename, date_time, data in entries]
+
+
+def _get_process_pool(workers: int):
+
+    global _process_pool, _process_pool_workers
+
+    with _process_pool_lock:
+        if _process_pool is not None and _process_pool_workers != workers:
+            _process_pool.shutdown(wait=False)
+            _process_pool = None
+
+        if _process_pool is None:
+            # スレッドを持つサーバプロセスからの fork は避ける
+            _process_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _process_pool_workers = workers
+
+        return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+
+
+def _iter_records(zf):
+    for info in zf.infolist():
+        if is_note_entry(info):
+            yield info.filename, parse_note_entry(info.filename, info.date_time, zf.read(info))
+
+
+def _iter_records_parallel(zf, workers: int, chunk_size: int = PARSE_CHUNK_SIZE):
+    """
+    ノートの解析をプロセスプールに分散する
+    ZIP の展開はこのスレッドで行い、チャンク単位で投入して投入順に結果を返す (順序は決定的)
+    同時に処理中のチャンク数は workers * 2 までに抑える
+    """
+
+    pool = _get_process_pool(workers)
+    pending = deque()
+    chunk = []
+
+    for info in zf.infolist():
+
+        if not is_note_entry(info):
+            continue
+
+        chunk.append((info.filename, info.date_time, zf.read(info)))
+
+        if len(chunk) >= chunk_size:
+            pending.append(pool.submit(parse_note_chunk, chunk))
+            chunk = []
+
+            while len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+
+    if chunk:
+        pending.append(pool.submit(parse_note_chunk, chunk))
+
+    while pending:
+        yield from pending.popleft().result()
+
+
+class NoteImportWriter:
+    """
+    解析済みのノートをチャンク単位で DB に書き込む
+    チャンクごとに書き込み接続を取り、commit して手放す (取り込み中も他の書き込みを止めない)
+    添付ファイルのハッシュ計算と一時ファイルへのコピーは書き込み接続を取る前に済ませる
+    既存タイトル・指紋は最初に読み込んでおき、ノートごとの SELECT をなくす
+    タイトルと本文が同じノート (note_hash が一致) が既にあれば取り込まない
+    """
+
+    def __init__(self, user_id: int, upload_dir: str, zf, attachments_by_export_id):
+
+        self.user_id = user_id
+        self.upload_dir = upload_dir
+        self.zf = zf
+        self.attachments_by_export_id = attachments_by_export_id
+
+        with get_connection(readonly=True) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT title, note_hash FROM notes WHERE user_id=?", (user_id,))
+            self.titles = set()
+            self.note_hashes = set()
+            for title, note_hash in cur.fetchall():
+                self.titles.add(title)
+                self.note_hashes.add(note_hash)
+
+        self.pending = []               # 次のチャンクで書き込むノート
+        self.staged_files = {}          # sha256 -> 書き込み接続の外でコピーした一時ファイル
+        self.imported = 0
+        self.duplicates = 0
+        self.chunks = 0
+
+    def _blob_exists(self, sha256: str) -> bool:
+        with get_connection(readonly=True) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT filename_stored FROM attachment_blobs WHERE sha256=?", (sha256,))
+            row = cur.fetchone()
+        return row is not None and resolve_stored_file(self.upload_dir, row[0]) is not None
+
+    def _stage_attachment(self, att_info):
+        """
+        一時ファイルへコピーしながらハッシュを計算する (書き込み接続の外、展開は1回だけ)
+        保存済みの内容だった場合は一時ファイルを消す
+        """
+
+        fd, temp_path = tempfile.mkstemp(dir=self.upload_dir, prefix=TEMP_PREFIX, suffix=TEMP_SUFFIX)
+        hasher = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as dst, self.zf.open(att_info) as src:
+                while True:
+                    chunk = src.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    dst.write(chunk)
+        except BaseException:
+            remove_file(temp_path)
+            raise
+
+        sha256 = hasher.hexdigest()
+        if sha256 in self.staged_files or self._blob_exists(sha256):
+            remove_file(temp_path)
+        else:
+            self.staged_files[sha256] = temp_path
+
+        return sha256
+
+    def add(self, record) -> bool:
+        """取り込んだら True、同じノートが既にあって飛ばしたら False"""
+
+        # 同じタイトル・本文のノートは取り込み済み (再インポート・ZIP 内の重複)
+        if record["note_hash"] in self.note_hashes:
+            self.duplicates += 1
+            return False
+        self.note_hashes.add(record["note_hash"])
+
+        title = record["title"]
+        note_hash = record["note_hash"]
+        content_hash = record["content_hash"]
+        updated_at = record["updated_at"]
+
+        # タイトル重複チェック
+        if title in self.titles:
+            # note_id 付きでない場合は重複を避けるため suffix を付加
+            suffix = f" (imported {updated_at.strftime('%Y%m%d%H%M%S')})"
+            title += suffix
+            note_hash, content_hash = note_hashes(title, record["content"])
+            self.note_hashes.add(note_hash)
+        self.titles.add(title)
+
+        # 添付ファイル (同じ export id の添付は一度だけ取り込む)
+        attachments = []
+        export_note_id = record["export_note_id"]
+        if export_note_id:
+            for att_info in self.attachments_by_export_id.pop(export_note_id, []):
+                # サブディレクトリを除いてファイル名のみ取得
+                att_filename = os.path.basename(att_info.filename)
+                sha256 = self._stage_attachment(att_info)
+                attachments.append((att_info, att_filename, sha256, guess_mime_type(att_filename)))
+
+        self.pending.append({
+            "title": title,
+            "content": record["content"],
+            "note_hash": note_hash,
+            "content_hash": content_hash,
+            "is_important": record["is_important"],
+            "updated_at": updated_at.isoformat(),
+            "tags": record["tags"],
+            "attachments": attachments,
+        })
+
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+        return True
+
+    def _place(self, sha256: str, att_info):
+        def place(path):
+            temp_path = self.staged_files.pop(sha256, None)
+            if temp_path is not None:
+                os.replace(temp_path, path)
+                return
+            # 確認した後に保存済みの内容が消えた場合だけ、ここで ZIP からコピーする
+            with self.zf.open(att_info) as src:
+                copy_to_blob(src, path, COPY_CHUNK_SIZE)
+        return place
+
+    def _write_chunk(self, cur, created_files, created_images) -> int:
+
+        # 読み込んだ後に同じノートが作られていれば飛ばす (UNIQUE(user_id, note_hash))
+        hashes = [note["note_hash"] for note in self.pending]
+        cur.execute(
+            f"SELECT note_hash FROM notes WHERE user_id=? AND note_hash IN ({','.join('?' * len(hashes))})",
+            (self.user_id, *hashes),
+        )
+        existing = {row[0] for row in cur.fetchall()}
+
+        cur.execute("SELECT id, name FROM tags")
+        tag_ids = {name: tag_id for tag_id, name in cur.fetchall()}
+
+        imported = 0
+        note_tag_rows = []
+        trashed_note_ids = []           # ゴミ箱のタグ付きで取り込んだノート (墓標を作る)
+        attachment_rows = []
+
+        for note in self.pending:
+
+            if note["note_hash"] in existing:
+                self.duplicates += 1
+                continue
+
+            # ID は AUTOINCREMENT に任せる (note_tags・attachments は同じトランザクションで後から入れる)
+            cur.execute(
+                """
+                INSERT INTO notes
+                    (user_id, title, content, note_hash, content_hash, is_important, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                RETURNING id
+                """,
+                (
+                    self.user_id, note["title"], note["content"], note["note_hash"], note["content_hash"],
+                    note["is_important"], note["updated_at"], note["updated_at"],
+                ),
+            )
+            note_id = cur.fetchone()[0]
+            imported += 1
+
+            # タグ登録
+            note_tag_ids = []
+            for name in note["tags"]:
+                tag_id = tag_ids.get(name)
+                if tag_id is None:
+                    cur.execute("INSERT INTO tags (name) VALUES (?)", (name,))
+                    tag_id = tag_ids[name] = cur.lastrowid
+                note_tag_ids.append(tag_id)
+            for tag_id in dict.fromkeys(note_tag_ids):
+                note_tag_rows.append((note_id, tag_id))
+            if any(name.upper() == TRASH_TAG_NAME for name in note["tags"]):
+                trashed_note_ids.append(note_id)
+
+            # 添付ファイル復元 (一時ファイルを保存先へ移すだけ)
+            for att_info, att_filename, sha256, mime_type in note["attachments"]:
+                stored_name, created = store_blob(
+                    cur, self.upload_dir, sha256, att_info.file_size, mime_type,
+                    self._place(sha256, att_info),
+                )
+                if created:
+                    path = stored_path(self.upload_dir, stored_name)
+                    created_files.append(path)
+                    if is_image(mime_type):
+                        created_images.append((sha256, path, mime_type))
+
+                uploaded_at = datetime.now(timezone.utc).isoformat()
+                attachment_rows.append((
+                    note_id, att_filename, stored_name, uploaded_at, sha256, att_info.file_size, mime_type,
+                ))
+
+        # notes (上で登録済み) -> note_tags -> attachments の順 (外部キー)
+        if note_tag_rows:
+            cur.executemany(
+                "INSERT INTO note_tags (note_id, tag_id) VALUES (?, ?)",
+                note_tag_rows,
+            )
+        if trashed_note_ids:
+            add_note_tombstones(cur, trashed_note_ids)
+        if attachment_rows:
+            cur.executemany(
+                """
+                INSERT INTO attachments
+                    (note_id, filename_original, filename_stored, uploaded_at, sha256, size, mime_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                attachment_rows,
+            )
+
+        return imported
+
+    def flush(self):
+        """溜まったノートを1トランザクションで書き込み、commit して書き込み接続を手放す"""
+
+        if not self.pending:
+            return
+
+        created_files = []              # 失敗時に消すため、このチャンクで新しく置いたファイル
+        created_images = []             # commit 後にサムネイルを作る (sha256, パス, MIME)
+
+        try:
+            with get_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("BEGIN")
+                with deferred_fts_index(cur):
+                    imported = self._write_chunk(cur, created_files, created_images)
+        except BaseException:
+            for path in created_files:
+                remove_file(path)
+            raise
+
+        self.pending.clear()
+        self.imported += imported
+        self.chunks += 1
+
+        # 使わなかった一時ファイル (同じ内容が先に保存されていた等) を消す
+        self.discard()
+
+        bump_generation(self.user_id)
+
+        for sha256, path, mime_type in created_images:
+            schedule_thumbnails(sha256, path, mime_type)
+
+    def discard(self):
+        """保存先へ移さなかった一時ファイルを消す"""
+        for temp_path in self.staged_files.values():
+            remove_file(temp_path)
+        self.staged_files.clear()
+
+
+def import_zip(zf, user_id: int, upload_dir: str, workers: int = 0):
+    """
+    ZIP のノートを BATCH_SIZE 件ずつのトランザクションで取り込む
+    FTS の索引はチャンクごとにまとめて作る
+    途中で失敗しても commit 済みのチャンクは残る (もう一度取り込めば指紋で重複を飛ばして続きから入る)
+    workers > 0 の場合はノートの解析をプロセスプールで並列に行う (DB への書き込みはこのスレッドのみ)
+    """
+
+    started = time.perf_counter()
+    skipped = 0
+
+    attachments_by_export_id = index_attachments(zf)
+    writer = NoteImportWriter(user_id, upload_dir, zf, attachments_by_export_id)
+
+    if workers > 0:
+        records = _iter_records_parallel(zf, workers)
+    else:
+        records = _iter_records(zf)
+
+    try:
+        for filename, record in records:
+
+            if record is None:
+                logger.info(f"[IMPORT SKIP] {filename}")
+                skipped += 1
+                continue
+
+            if not writer.add(record):
+                logger.info(f"[IMPORT DUPLICATE] {filename}")
+                skipped += 1
+
+        writer.flush()
+
+    finally:
+        writer.discard()
+
+    elapsed = time.perf_counter() - started
+
+    return {
+        "imported": writer.imported,
+        "skipped": skipped,
+        "duplicates": writer.duplicates,
+        "chunks": writer.chunks,
+        "workers": workers,
+        "elapsed_sec": round(elapsed, 3),
+        "notes_per_sec": round(writer.imported / elapsed, 1) if elapsed > 0 else None,
+    }
@@ -1,92 +1,361 @@
 import logging
+import threading
+import time
 
-from ..database import get_connection
-from ..config import load_config
-from ..utils import TRASH_TAG_NAME
-from .tombstones import add_note_tombstone
+from ..database import get_connection, USER_TAG_COUNTS_SQL
+from ..config import get_config
+from .tombstones import add_note_tombstones, compact_tombstones
+from .generation import bump_generation
+from .file_cleanup import wake_file_cleanup
 
-config = load_config()
+config = get_config()
 logger = logging.getLogger("maintenance")
 
+_maintenance_conf = config.get("maintenance", {})
 
-def purge_expired_trashed_notes(cur, user_id=None):
-    """期限切れのゴミ箱ノートを削除"""
+DEBOUNCE_SECONDS = float(_maintenance_conf.get("debounce_seconds", 5))
+INTERVAL_SECONDS = float(_maintenance_conf.get("interval_minutes", 60)) * 60
+BATCH_SIZE = int(_maintenance_conf.get("batch_size", 500))
+TIME_BUDGET = float(_maintenance_conf.get("time_budget_ms", 200)) / 1000
+GLOBAL_TIME_BUDGET = float(_maintenance_conf.get("global_time_budget_ms", 2000)) / 1000
+RECONCILE_INTERVAL_SECONDS = float(_maintenance_conf.get("reconcile_tag_counts_hours", 24)) * 3600
+
+# 定期実行が時間切れで終わらなかったときは、この秒数後に続きを行う
+GLOBAL_RETRY_SECONDS = 5
+
+
+def purge_expired_trashed_notes(cur, user_id=None, limit=None):
+    """期限切れのゴミ箱ノートを削除 (limit 件まで)。削除したノートの user_id のリストを返す"""
 
     trash_conf = (config or {}).get("trash", {})
 
     if trash_conf.get("enabled") and trash_conf.get("auto_empty_days", 0) > 0:
         days = int(trash_conf["auto_empty_days"])
+        limit = -1 if limit is None else limit
 
+        # ゴミ箱に入れてから days 日経ったもの (trashed_at の部分インデックス)
+        expires = f"-{days} days"
         if user_id:
             cur.execute("""
-                SELECT n.id, n.user_id, n.title, n.content
-                FROM notes n
-                JOIN note_tags nt ON n.id = nt.note_id
-                JOIN tags t ON nt.tag_id = t.id
-                WHERE upper(t.name) = ?
-                  AND n.user_id = ?
-                  AND n.updated_at < datetime('now', ?)
-            """, (TRASH_TAG_NAME, user_id, f'-{days} days'))
+                SELECT id, user_id
+                FROM notes
+                WHERE user_id = ?
+                  AND trashed_at < strftime('%Y-%m-%dT%H:%M:%S', 'now', ?)
+                LIMIT ?
+            """, (user_id, expires, limit))
 
         else:
             cur.execute("""
-                SELECT n.id, n.user_id, n.title, n.content
-                FROM notes n
-                JOIN note_tags nt ON n.id = nt.note_id
-                JOIN tags t ON nt.tag_id = t.id
-                WHERE upper(t.name) = ?
-                  AND n.updated_at < datetime('now', ?)
-            """, (TRASH_TAG_NAME, f'-{days} days'))
+                SELECT id, user_id
+                FROM notes
+                WHERE trashed_at < strftime('%Y-%m-%dT%H:%M:%S', 'now', ?)
+                LIMIT ?
+            """, (expires, limit))
 
         rows = cur.fetchall()
-        for row in rows:
-            add_note_tombstone(cur, row["user_id"], row["title"], row["content"], row["id"])
+        note_ids = [row["id"] for row in rows]
 
         cnt = 0
-        if rows:
-            placeholders = ",".join(["?"] * len(rows))
-            cur.execute(
-                f"DELETE FROM notes WHERE id IN ({placeholders})",
-                [row["id"] for row in rows],
-            )
+        if note_ids:
+            # 墓標は保存済みの指紋をコピーする (本文は読まない)
+            add_note_tombstones(cur, note_ids)
+            placeholders = ",".join(["?"] * len(note_ids))
+            cur.execute(f"DELETE FROM notes WHERE id IN ({placeholders})", note_ids)
             cnt = cur.rowcount or 0
 
         if cnt > 0:
             logger.info(f"🗑️ Deleted {cnt} trashed notes older than {days} days")
 
+        return [row["user_id"] for row in rows]
+
+    return []
+
 
-def remove_orphan_note_tags(cur):
-    """孤立したnote_tagsを削除"""
+def remove_orphan_note_tags(cur, limit=None):
+    """孤立したnote_tagsを削除 (limit 件まで)"""
     cur.execute("""
         DELETE FROM note_tags
-        WHERE note_id NOT IN (SELECT id FROM notes)
-    """)
+        WHERE rowid IN (
+            SELECT nt.rowid FROM note_tags nt
+            WHERE NOT EXISTS (SELECT 1 FROM notes n WHERE n.id = nt.note_id)
+            LIMIT ?
+        )
+    """, (-1 if limit is None else limit,))
     cnt = cur.rowcount or 0
     if cnt > 0:
         logger.info(f"🧹 Deleted {cnt} orphaned note_tags")
+    return cnt
 
 
-def remove_unused_tags(cur):
-    """未使用タグを削除"""
-    cur.execute("""
-        DELETE FROM tags
-        WHERE id NOT IN (SELECT DISTINCT tag_id FROM note_tags)
-    """)
+def remove_unused_tags(cur, tag_ids=None, limit=None):
+    """未使用タグを削除 (tag_ids を指定したときはその中だけ調べる)"""
+    if tag_ids is not None:
+        tag_ids = list(tag_ids)
+        if not tag_ids:
+            return 0
+        placeholders = ",".join(["?"] * len(tag_ids))
+        cur.execute(f"""
+            DELETE FROM tags
+            WHERE id IN ({placeholders})
+              AND NOT EXISTS (SELECT 1 FROM note_tags nt WHERE nt.tag_id = tags.id)
+        """, tag_ids)
+    else:
+        cur.execute("""
+            DELETE FROM tags
+            WHERE id IN (
+                SELECT t.id FROM tags t
+                WHERE NOT EXISTS (SELECT 1 FROM note_tags nt WHERE nt.tag_id = t.id)
+                LIMIT ?
+            )
+        """, (-1 if limit is None else limit,))
     cnt = cur.rowcount or 0
     if cnt > 0:
         logger.info(f"🧽 Deleted {cnt} unused tags")
+    return cnt
+
+
+def reconcile_tag_counts(cur):
+    """
+    user_tag_counts を note_tags から数え直して比較し、違っていた行を直す
+    (トリガーで更新している集計の検証用)。違っていた行数を返す
+    """
 
+    cur.execute(USER_TAG_COUNTS_SQL)
+    expected = {(row[0], row[1]): row[2] for row in cur.fetchall()}
 
-def run_maintenance(user_id=None):
-    """メンテナンス処理を実行"""
+    cur.execute("SELECT user_id, tag_id, note_count FROM user_tag_counts")
+    actual = {(row[0], row[1]): row[2] for row in cur.fetchall()}
 
+    diff = [key for key in expected.keys() | actual.keys() if expected.get(key) != actual.get(key)]
+    for user_id, tag_id in diff:
+        count = expected.get((user_id, tag_id))
+        if count is None:
+            cur.execute("DELETE FROM user_tag_counts WHERE user_id=? AND tag_id=?", (user_id, tag_id))
+        else:
+            cur.execute(
+                """
+                INSERT INTO user_tag_counts (user_id, tag_id, note_count) VALUES (?, ?, ?)
+                ON CONFLICT(user_id, tag_id) DO UPDATE SET note_count = excluded.note_count
+                """,
+                (user_id, tag_id, count),
+            )
+
+    if diff:
+        logger.warning(f"🔢 Fixed {len(diff)} drifted user_tag_counts rows")
+
+    return len(diff)
+
+
+def _run_batch(step, *args, **kwargs):
+    """1バッチを1トランザクションで実行する (バッチの間は書き込みロックを離す)"""
     conn = get_connection()
     cur = conn.cursor()
+    try:
+        result = step(cur, *args, **kwargs)
+        conn.commit()
+    finally:
+        conn.close()
+    return result
+
+
+def run_maintenance(user_id=None, tag_ids=None, time_budget=None, batch_size=BATCH_SIZE):
+    """
+    メンテナンス処理を実行
+    user_id を指定したときはそのユーザのゴミ箱と tag_ids のタグだけを見る
+    (孤立した note_tags と全タグの走査、墓標の整理は user_id=None の定期実行で行う)
+    time_budget (秒) を超えたら途中で止め、complete=False を返す
+    """
+
+    started = time.perf_counter()
+    deadline = None if time_budget is None else started + time_budget
+    result = {
+        "user_id": user_id,
+        "purged": 0,
+        "orphan_note_tags": 0,
+        "unused_tags": 0,
+        "tombstones_compacted": 0,
+        "complete": True,
+    }
+
+    def out_of_time():
+        return deadline is not None and time.perf_counter() >= deadline
 
     # 順番はこの通りで
-    purge_expired_trashed_notes(cur, user_id=user_id)
-    remove_orphan_note_tags(cur)
-    remove_unused_tags(cur)
+    purged_users = set()
+    while True:
+        users = _run_batch(purge_expired_trashed_notes, user_id=user_id, limit=batch_size)
+        purged_users.update(users)
+        result["purged"] += len(users)
+        if len(users) < batch_size:
+            break
+        if out_of_time():
+            result["complete"] = False
+            break
+
+    if user_id is None:
+        steps = [
+            ("orphan_note_tags", lambda: _run_batch(remove_orphan_note_tags, limit=batch_size)),
+            ("unused_tags", lambda: _run_batch(remove_unused_tags, limit=batch_size)),
+            ("tombstones_compacted", lambda: _run_batch(compact_tombstones, limit=batch_size)),
+        ]
+    else:
+        steps = [("unused_tags", lambda: _run_batch(remove_unused_tags, tag_ids=tag_ids or ()))]
+
+    for key, step in steps:
+        if not result["complete"]:
+            break
+        while True:
+            cnt = step()
+            result[key] += cnt
+            if cnt < batch_size or user_id is not None:
+                break
+            if out_of_time():
+                result["complete"] = False
+                break
+
+    # 削除したノートの添付 (カスケード削除) のファイルはトリガーが削除待ちに積んでいる
+    if purged_users:
+        wake_file_cleanup()
+    for uid in purged_users:
+        bump_generation(uid)
+
+    result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+# -------------------------------------------
+# スケジューラ
+# 書き込み側は request_maintenance() で要求を積むだけにする
+# 同じユーザへの要求は DEBOUNCE_SECONDS の間まとめて1回にする
+# -------------------------------------------
+
+_cond = threading.Condition()
+_pending = {}           # user_id -> 調べるタグ id の集合
+_due_at = None          # 積まれた要求を実行する時刻 (最初の要求から DEBOUNCE_SECONDS 後)
+_next_global_at = None
+_next_reconcile_at = None
+_stop = threading.Event()
+_thread = None
+
+stats = {
+    "requests": 0,
+    "user_runs": 0,
+    "global_runs": 0,
+    "last_user_run": None,
+    "last_global_run": None,
+    "last_tag_count_reconcile": None,
+    "last_error": None,
+}
+
+
+def request_maintenance(user_id: int, tag_ids=()):
+    """commit 後に呼ぶ。タグを外したときは外したタグの id を渡す (未使用なら消す)"""
+    global _due_at
+    with _cond:
+        _pending.setdefault(user_id, set()).update(tag_ids)
+        stats["requests"] += 1
+        if _due_at is None:
+            _due_at = time.monotonic() + DEBOUNCE_SECONDS
+            _cond.notify()
+
+
+def _take_due_work():
+    """実行する要求を取り出す (_cond を持って呼ぶ)"""
+    global _due_at, _next_global_at
+
+    now = time.monotonic()
+    users = {}
+    if _due_at is not None and now >= _due_at:
+        users = dict(_pending)
+        _pending.clear()
+        _due_at = None
+
+    run_global = _next_global_at is not None and now >= _next_global_at
+    return users, run_global
+
+
+def _wait_timeout():
+    now = time.monotonic()
+    deadlines = [t for t in (_due_at, _next_global_at) if t is not None]
+    if not deadlines:
+        return None
+    return max(0.0, min(deadlines) - now)
+
+
+def _run():
+    global _next_global_at, _next_reconcile_at
+
+    while not _stop.is_set():
+
+        with _cond:
+            users, run_global = _take_due_work()
+            if not users and not run_global:
+                _cond.wait(_wait_timeout())
+                continue
+
+        try:
+            for user_id, tag_ids in users.items():
+                result = run_maintenance(user_id, tag_ids, time_budget=TIME_BUDGET)
+                stats["user_runs"] += 1
+                stats["last_user_run"] = {**result, "finished_at": time.time()}
+                if not result["complete"]:
+                    # 残りは次の周期で
+                    request_maintenance(user_id, tag_ids)
+
+            if run_global:
+                result = run_maintenance(None, time_budget=GLOBAL_TIME_BUDGET)
+                stats["global_runs"] += 1
+                stats["last_global_run"] = {**result, "finished_at": time.time()}
+                with _cond:
+                    _next_global_at = time.monotonic() + (
+                        INTERVAL_SECONDS if result["complete"] else GLOBAL_RETRY_SECONDS
+                    )
+
+                # タグ件数の集計の検証は定期実行のついでに行う
+                if _next_reconcile_at is None or time.monotonic() >= _next_reconcile_at:
+                    started = time.perf_counter()
+                    fixed = _run_batch(reconcile_tag_counts)
+                    stats["last_tag_count_reconcile"] = {
+                        "fixed": fixed,
+                        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                        "finished_at": time.time(),
+                    }
+                    _next_reconcile_at = time.monotonic() + RECONCILE_INTERVAL_SECONDS
+
+        except Exception as e:
+            stats["last_error"] = str(e)
+            logger.exception("Maintenance failed")
+
+
+def start_maintenance_scheduler():
+    global _thread, _next_global_at
+
+    if _thread is not None and _thread.is_alive():
+        return
+
+    with _cond:
+        # 起動直後は他の初期化を優先し、最初の定期実行は少し後に行う
+        _next_global_at = time.monotonic() + min(INTERVAL_SECONDS, 60)
+
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="maintenance", daemon=True)
+    _thread.start()
+
+
+def stop_maintenance_scheduler(timeout: float = 5.0):
+    _stop.set()
+    with _cond:
+        _cond.notify_all()
+    if _thread is not None:
+        _thread.join(timeout)
+
 
-    conn.commit()
-    conn.close()
+def maintenance_stats():
+    with _cond:
+        return {
+            **stats,
+            "pending_users": len(_pending),
+            "next_global_in_seconds": (
+                round(_next_global_at - time.monotonic(), 1) if _next_global_at is not None else None
+            ),
+        }
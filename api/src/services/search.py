@@ -0,0 +1,210 @@
+import html
+import re
+
+from ..utils import parse_important_flag
+
+# snippet()/highlight() には制御文字を渡し、エスケープ後に <mark> へ置き換える
+_HL_START = "\x02"
+_HL_END = "\x03"
+
+# bm25 の列ごとの重み (title, content)
+TITLE_WEIGHT = 10.0
+CONTENT_WEIGHT = 1.0
+
+SNIPPET_TOKENS = 16
+SNIPPET_CHARS = 32          # LIKE 検索時のスニペット前後の文字数
+
+# 日本語などの分かち書きしない文字 (ひらがな・カタカナ・漢字・半角カナ・ハングル)
+_CJK_RE = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f\uac00-\ud7af]"
+)
+
+# trigram トークナイザで索引を引ける最短の語長
+TRIGRAM_MIN_CHARS = 3
+
+
+def _split_terms(q: str) -> list[str]:
+    return [t for t in (q or "").split() if t]
+
+
+def build_match_query(terms) -> str:
+    """
+    検索語を FTS5 の MATCH 式に変換する
+    空白区切りの各語をフレーズとして AND 検索する (FTS5 の構文は解釈させない)
+    """
+    if isinstance(terms, str):
+        terms = _split_terms(terms)
+    return " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+def choose_index(q: str) -> str:
+    """
+    検索語に応じて使う索引を選ぶ
+    - "unicode61": 通常の notes_fts (語単位)
+    - "trigram"  : notes_fts_trigram (部分一致、日本語など)
+    - "like"     : 索引を使わない LIKE 検索 (3文字未満の日本語のみの場合)
+    """
+    terms = _split_terms(q)
+    if not any(_CJK_RE.search(t) for t in terms):
+        return "unicode61"
+    if any(len(t) >= TRIGRAM_MIN_CHARS for t in terms):
+        return "trigram"
+    return "like"
+
+
+def _escape_like(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _like_conditions(terms) -> tuple[list[str], list[str]]:
+    where = []
+    params = []
+    for t in terms:
+        pattern = f"%{_escape_like(t)}%"
+        where.append("(n.title LIKE ? ESCAPE '\\' OR n.content LIKE ? ESCAPE '\\')")
+        params.extend([pattern, pattern])
+    return where, params
+
+
+def _render_highlight(text: str) -> str:
+    escaped = html.escape(text or "", quote=False)
+    return escaped.replace(_HL_START, "<mark>").replace(_HL_END, "</mark>")
+
+
+def _mark_terms(text: str, terms) -> str:
+    """LIKE 検索用: 一致箇所を制御文字で囲む"""
+    if not terms:
+        return text
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    return pattern.sub(lambda m: f"{_HL_START}{m.group(0)}{_HL_END}", text)
+
+
+def _like_snippet(content: str, terms) -> str:
+    """LIKE 検索用: 最初の一致箇所の前後を切り出す"""
+    content = content or ""
+    lowered = content.lower()
+    positions = [p for p in (lowered.find(t.lower()) for t in terms) if p >= 0]
+
+    if not positions:
+        return content[:SNIPPET_CHARS * 2]
+
+    pos = min(positions)
+    start = max(0, pos - SNIPPET_CHARS)
+    end = min(len(content), pos + SNIPPET_CHARS)
+
+    text = content[start:end]
+    if start > 0:
+        text = "…" + text
+    if end < len(content):
+        text = text + "…"
+    return _mark_terms(text, terms)
+
+
+def search_notes(cur, user_id: int, q: str, tag: str | None = None,
+                 important: bool | None = None, limit: int = 50, offset: int = 0):
+    """
+    ノートを検索する
+    日本語を含む検索語は trigram 索引、それ以外は notes_fts を bm25 順で引く
+    (結果, 続きがあるか) を返す
+    """
+
+    terms = _split_terms(q)
+    if not terms:
+        return [], False
+
+    where = ["n.user_id = ?"]
+    params = [user_id]
+
+    if tag:
+        where.append("""
+            EXISTS (
+                SELECT 1
+                FROM note_tags nt1
+                JOIN tags t1 ON nt1.tag_id = t1.id
+                WHERE nt1.note_id = n.id AND t1.name = ?
+            )
+        """)
+        params.append(tag)
+
+    if important is not None:
+        where.append("n.is_important = ?")
+        params.append(1 if important else 0)
+
+    index = choose_index(q)
+
+    if index == "like":
+        like_where, like_params = _like_conditions(terms)
+        cur.execute(f"""
+            SELECT n.id, n.title, n.content, n.is_important, n.created_at, n.updated_at
+            FROM notes n
+            WHERE {" AND ".join(where + like_where)}
+            ORDER BY n.is_important DESC, n.updated_at DESC, n.id DESC
+            LIMIT ? OFFSET ?
+        """, [*params, *like_params, limit + 1, offset])
+        rows = [
+            {
+                **dict(row),
+                "score": 0.0,
+                "title_highlight": _mark_terms(row["title"], terms),
+                "snippet": _like_snippet(row["content"], terms),
+            }
+            for row in cur.fetchall()
+        ]
+
+    else:
+        if index == "trigram":
+            fts_table = "notes_fts_trigram"
+            # 3文字未満の語は trigram で引けないので LIKE で絞り込む
+            match_terms = [t for t in terms if len(t) >= TRIGRAM_MIN_CHARS]
+            like_where, like_params = _like_conditions(
+                [t for t in terms if len(t) < TRIGRAM_MIN_CHARS]
+            )
+        else:
+            fts_table = "notes_fts"
+            match_terms = terms
+            like_where, like_params = [], []
+
+        cur.execute(f"""
+            SELECT n.id, n.title, n.is_important, n.created_at, n.updated_at,
+                   bm25({fts_table}, {TITLE_WEIGHT}, {CONTENT_WEIGHT}) AS score,
+                   highlight({fts_table}, 0, '{_HL_START}', '{_HL_END}') AS title_highlight,
+                   snippet({fts_table}, 1, '{_HL_START}', '{_HL_END}', '…', {SNIPPET_TOKENS}) AS snippet
+            FROM {fts_table}
+            JOIN notes n ON n.id = {fts_table}.rowid
+            WHERE {fts_table} MATCH ? AND {" AND ".join(where + like_where)}
+            ORDER BY score, n.id DESC
+            LIMIT ? OFFSET ?
+        """, [build_match_query(match_terms), *params, *like_params, limit + 1, offset])
+        rows = [dict(row) for row in cur.fetchall()]
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # タグ (ページ分をまとめて取得)
+    tags = {row["id"]: [] for row in rows}
+    if rows:
+        placeholders = ",".join(["?"] * len(rows))
+        cur.execute(f"""
+            SELECT nt.note_id, t.name
+            FROM note_tags nt
+            JOIN tags t ON nt.tag_id = t.id
+            WHERE nt.note_id IN ({placeholders})
+        """, list(tags))
+        for note_id, name in cur.fetchall():
+            tags[note_id].append(name)
+
+    results = []
+    for row in rows:
+        results.append({
+            "id": row["id"],
+            "title": row["title"],
+            "title_highlight": _render_highlight(row["title_highlight"]),
+            "snippet": _render_highlight(row["snippet"]),
+            "is_important": parse_important_flag(row["is_important"]),
+            "tags": tags[row["id"]],
+            "score": row["score"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        })
+
+    return results, has_more
@@ -0,0 +1,160 @@
+from datetime import datetime, timezone
+import hashlib
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+
+logger = logging.getLogger("attachments")
+
+# 添付ファイルの実体は SHA-256 をキーに1内容1ファイルで保存する (attachment_blobs)
+# 参照カウントが 0 になった内容はトリガーが file_deletions に積み、file_cleanup が消す
+# 登録と削除はどちらも書き込み接続 (ライターロック) を持ったまま行うこと
+#   → 「既存ファイルを再利用した直後に別リクエストがそのファイルを消す」競合を防ぐ
+
+
+# 保存ディレクトリは名前の先頭4文字で2段に分ける (例: ab/cd/abcd1234....png)
+# 以前のファイルは upload_dir 直下にあり、移行ツール (storage_migration) で順次移す
+SHARD_WIDTH = 2
+SHARD_DEPTH = 2
+
+
+def sharded_relpath(filename: str) -> str:
+    parts = [filename[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    return os.path.join(*parts, filename)
+
+
+def stored_path(upload_dir: str, filename: str) -> str:
+    """新しく置くファイルのパス (シャード化したレイアウト)"""
+    return os.path.join(upload_dir, sharded_relpath(filename))
+
+
+def resolve_stored_file(upload_dir: str, filename: str) -> str | None:
+    """
+    保存名から実際のパスを探す (シャード → 直下 の順)
+    移行ツールが直下から移動している最中でも見つかるよう、最後にもう一度シャードを見る
+    """
+
+    if not filename or "/" in filename or "\\" in filename or filename.startswith("."):
+        return None
+
+    sharded = stored_path(upload_dir, filename)
+    if os.path.isfile(sharded):
+        return sharded
+
+    flat = os.path.join(upload_dir, filename)
+    if os.path.isfile(flat):
+        return flat
+
+    if os.path.isfile(sharded):
+        return sharded
+
+    return None
+
+
+def open_stored_file(upload_dir: str, filename: str):
+    """resolve_stored_file して開く。見つからなければ None"""
+    for _ in range(2):
+        path = resolve_stored_file(upload_dir, filename)
+        if path is None:
+            return None
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            # 解決と open の間に移動された
+            continue
+    return None
+
+
+def resolve_alias(cur, filename: str) -> str | None:
+    """移行前の保存名 (uuid 形式) を内容単位の保存名に変換する"""
+    cur.execute("SELECT filename_stored FROM attachment_aliases WHERE filename=?", (filename,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def file_entry(attachment_id: int, filename: str, filename_stored: str) -> dict:
+    """API で返す添付ファイル情報 (url は以前の /files/、どちらも認証付きで所有者のみ)"""
+    return {
+        "id": attachment_id,
+        "filename": filename,
+        "url": f"/files/{filename_stored}",
+        "download_url": f"/attachments/{attachment_id}",
+    }
+
+
+def guess_mime_type(filename: str, content_type: str | None = None) -> str:
+    if content_type and content_type != "application/octet-stream":
+        return content_type
+    return mimetypes.guess_type(filename or "")[0] or "application/octet-stream"
+
+
+def blob_filename(sha256: str) -> str:
+    # 同じ内容を別の名前・種類で登録した添付と共有するので拡張子は付けない
+    # (Content-Type は保存名からではなく attachments.mime_type で決める)
+    return sha256
+
+
+def store_blob(cur, upload_dir: str, sha256: str, size: int, mime_type: str, place):
+    """
+    内容を attachment_blobs に登録し、保存名と新しくファイルを置いたかを返す
+    同じ内容が既にあれば place は呼ばない。無ければ place(保存先パス) でファイルを置く
+    refcount は attachments への INSERT 時にトリガーで増える
+    """
+
+    cur.execute("SELECT filename_stored FROM attachment_blobs WHERE sha256=?", (sha256,))
+    row = cur.fetchone()
+
+    if row is not None:
+        filename_stored = row[0]
+        if resolve_stored_file(upload_dir, filename_stored):
+            return filename_stored, False
+    else:
+        filename_stored = blob_filename(sha256)
+
+    dest_path = stored_path(upload_dir, filename_stored)
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    place(dest_path)
+
+    if row is None:
+        cur.execute(
+            """
+            INSERT INTO attachment_blobs (sha256, filename_stored, size, mime_type, refcount, created_at)
+            VALUES (?, ?, ?, ?, 0, ?)
+            """,
+            (sha256, filename_stored, size, mime_type, datetime.now(timezone.utc).isoformat()),
+        )
+
+    return filename_stored, True
+
+
+def hash_fileobj(src, chunk_size: int = 1024 * 1024) -> str:
+    hasher = hashlib.sha256()
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def copy_to_blob(src, dest_path: str, chunk_size: int = 1024 * 1024):
+    """src をチャンク単位で一時ファイルへ書き、最後にリネームする (途中のファイルを保存名で見せない)"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), prefix=".upload-", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as dst:
+            shutil.copyfileobj(src, dst, chunk_size)
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        remove_file(temp_path)
+        raise
+
+
+def remove_file(path: str):
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except Exception as e:
+        # ログだけ出す (DB との整合性優先)
+        logger.warning(f"Failed to delete file {path}: {e}")
@@ -0,0 +1,296 @@
+"""
+添付ファイルの保存形式の移行ツール
+
+1. 以前の形式の添付 (sha256 が NULL、1添付1ファイル) を内容単位の保存 (attachment_blobs) に変換する
+   古い保存名は attachment_aliases に残し、/files/{古い保存名} も引き続き解決できるようにする
+2. upload_dir 直下のファイルをシャード化したディレクトリ (ab/cd/名前) へ移動する
+
+どちらもバッチ単位で書き込みロックを取り、バッチの間はロックを離すのでサーバを止めずに実行できる
+(ハッシュの計算はロックの外で行う)
+
+起動時には実行しない (upload.migration.on_startup で有効にできる)。次のどちらかで明示的に実行する
+移した・変換したファイルは1件ずつログに出す
+
+    cd api && python -m src.services.storage_migration [--batch-size 200] [--pause 0.2]
+    POST /maintenance/storage-migration (管理者のみ、バックグラウンドで実行し結果は /maintenance/stats)
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+
+from ..database import get_connection
+from .storage import (
+    copy_to_blob, guess_mime_type, hash_fileobj, remove_file, resolve_stored_file, store_blob, stored_path,
+)
+
+logger = logging.getLogger("storage_migration")
+
+_thread = None
+_stop = threading.Event()
+
+stats = {
+    "running": False,
+    "converted": 0,
+    "moved": 0,
+    "last_run": None,       # 最後に終わった実行の結果
+}
+
+
+def _link_or_copy(src_path: str, dest_path: str):
+    # 同じファイルシステム内なのでハードリンクで済ませる (元ファイルは commit 後に消す)
+    try:
+        os.link(src_path, dest_path)
+    except FileExistsError:
+        # 保存名は内容のハッシュなので、既にあるファイルは同じ内容
+        pass
+    except OSError:
+        with open(src_path, "rb") as src:
+            copy_to_blob(src, dest_path)
+
+
+def migrate_legacy_batch(upload_dir: str, batch_size: int, after_id: int = 0):
+    """
+    以前の形式の添付を batch_size 件変換する
+    (処理した件数, 最後の id) を返す。0 件なら完了
+    """
+
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, filename_original, filename_stored
+            FROM attachments
+            WHERE sha256 IS NULL AND id > ?
+            ORDER BY id
+            LIMIT ?
+            """,
+            (after_id, batch_size),
+        )
+        rows = cur.fetchall()
+
+    if not rows:
+        return 0, after_id
+
+    # ハッシュは書き込みロックの外で計算する
+    hashed = []
+    for row in rows:
+        path = resolve_stored_file(upload_dir, row["filename_stored"])
+        if path is None:
+            logger.warning(f"Missing file for attachment {row['id']}: {row['filename_stored']}")
+            continue
+        try:
+            with open(path, "rb") as f:
+                sha256 = hash_fileobj(f)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            continue
+        hashed.append((row, path, sha256, size))
+
+    replaced = []
+
+    conn = get_connection()
+    cur = conn.cursor()
+
+    try:
+        for row, path, sha256, size in hashed:
+
+            # ロックを取るまでに削除・変換されていないか確認
+            cur.execute("SELECT filename_stored FROM attachments WHERE id=? AND sha256 IS NULL", (row["id"],))
+            current = cur.fetchone()
+            if current is None or current[0] != row["filename_stored"]:
+                continue
+
+            mime_type = guess_mime_type(row["filename_original"])
+            filename_stored, _ = store_blob(
+                cur, upload_dir, sha256, size, mime_type,
+                lambda dest, path=path: _link_or_copy(path, dest),
+            )
+
+            cur.execute(
+                "UPDATE attachments SET filename_stored=?, sha256=?, size=?, mime_type=? WHERE id=?",
+                (filename_stored, sha256, size, mime_type, row["id"]),
+            )
+            # トリガーは INSERT/DELETE のみなので参照カウントはここで増やす
+            cur.execute("UPDATE attachment_blobs SET refcount = refcount + 1 WHERE sha256=?", (sha256,))
+            cur.execute(
+                "INSERT OR REPLACE INTO attachment_aliases (filename, filename_stored) VALUES (?, ?)",
+                (row["filename_stored"], filename_stored),
+            )
+            replaced.append(path)
+            logger.info(f"Converted attachment {row['id']}: {row['filename_stored']} -> {filename_stored}")
+
+        conn.commit()
+
+        # 古いファイルは commit 後に消す (ロックを持ったまま)
+        for path in replaced:
+            remove_file(path)
+
+    finally:
+        conn.close()
+
+    return len(rows), rows[-1]["id"]
+
+
+def shard_flat_batch(upload_dir: str, batch_size: int, skip: set) -> int:
+    """
+    upload_dir 直下のファイルを batch_size 件シャードへ移動する
+    移動した件数を返す。0 件なら完了
+    """
+
+    names = []
+    with os.scandir(upload_dir) as it:
+        for entry in it:
+            # 一時ファイル (.upload-*.part) とシャードのディレクトリは対象外
+            if entry.name.startswith(".") or entry.name in skip:
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            names.append(entry.name)
+            if len(names) >= batch_size:
+                break
+
+    if not names:
+        return 0
+
+    moved = 0
+
+    # 参照カウントによる削除・同じ内容の再利用と同時に動かないよう書き込みロックを取る
+    conn = get_connection()
+    try:
+        for name in names:
+            src = os.path.join(upload_dir, name)
+            dest = stored_path(upload_dir, name)
+            try:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                if os.path.exists(dest):
+                    os.remove(src)
+                    logger.info(f"Removed {name} (already in {os.path.relpath(dest, upload_dir)})")
+                else:
+                    os.replace(src, dest)
+                    logger.info(f"Moved {name} -> {os.path.relpath(dest, upload_dir)}")
+                moved += 1
+            except FileNotFoundError:
+                # 削除された
+                continue
+            except OSError as e:
+                logger.warning(f"Failed to move {src}: {e}")
+                skip.add(name)
+    finally:
+        conn.close()
+
+    return moved
+
+
+def migrate_storage(upload_dir: str, batch_size: int = 200, pause_seconds: float = 0.0, stop_event=None):
+    """移行が終わる (または stop_event がセットされる) まで繰り返す"""
+
+    started = time.perf_counter()
+    result = {"converted": 0, "moved": 0}
+
+    def stopped():
+        return stop_event is not None and stop_event.is_set()
+
+    stats.update(running=True, converted=0, moved=0)
+
+    try:
+        last_id = 0
+        while not stopped():
+            count, last_id = migrate_legacy_batch(upload_dir, batch_size, last_id)
+            if count == 0:
+                break
+            result["converted"] += count
+            stats["converted"] = result["converted"]
+            time.sleep(pause_seconds)
+
+        skip = set()
+        while not stopped():
+            count = shard_flat_batch(upload_dir, batch_size, skip)
+            if count == 0:
+                break
+            result["moved"] += count
+            stats["moved"] = result["moved"]
+            time.sleep(pause_seconds)
+
+    finally:
+        result["elapsed_sec"] = round(time.perf_counter() - started, 3)
+        stats.update(running=False, last_run={**result, "finished_at": time.time()})
+
+    logger.info(f"📦 Storage migration: {result}")
+
+    return result
+
+
+def start_storage_migration(upload_dir: str, config=None, force: bool = False) -> bool:
+    """
+    バックグラウンドで移行する。始めたら True (実行中なら何もせず False)
+    force=False (起動時) は upload.migration.on_startup が有効な場合だけ
+    """
+
+    global _thread
+
+    if config is None:
+        from ..config import get_config
+        config = get_config()
+
+    migration_conf = config.get("upload", {}).get("migration", {})
+    if not force and not migration_conf.get("on_startup", False):
+        return False
+
+    if _thread is not None and _thread.is_alive():
+        return False
+
+    _stop.clear()
+    _thread = threading.Thread(
+        target=migrate_storage,
+        kwargs={
+            "upload_dir": upload_dir,
+            "batch_size": int(migration_conf.get("batch_size", 200)),
+            "pause_seconds": float(migration_conf.get("pause_seconds", 0.2)),
+            "stop_event": _stop,
+        },
+        name="storage-migration",
+        daemon=True,
+    )
+    _thread.start()
+    return True
+
+
+def migration_stats():
+    return dict(stats)
+
+
+def stop_storage_migration(timeout: float = 5.0):
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout)
+
+
+def main(argv=None):
+
+    from ..config import get_config
+    from ..database import init_db, close_pool
+
+    parser = argparse.ArgumentParser(description="Migrate attachment storage to the content-addressed, sharded layout")
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    config = get_config()
+    init_db(config)
+
+    upload_dir = os.path.abspath(config["upload"]["dir"])
+    try:
+        stats = migrate_storage(upload_dir, args.batch_size, args.pause)
+    finally:
+        close_pool()
+
+    print(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from ..config import get_config
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow が無い環境ではサムネイルを作らない
+    Image = None
+
+logger = logging.getLogger("thumbnails")
+
+config = get_config()
+_thumb_config = config.get("thumbnails", {})
+
+THUMBNAIL_DIR = _thumb_config.get("dir", "/data/thumbs")
+THUMBNAIL_SIZES = sorted(int(s) for s in _thumb_config.get("sizes", [256, 1024]))
+MAX_CACHE_BYTES = int(_thumb_config.get("max_cache_mb", 512)) * 1024 * 1024
+JPEG_QUALITY = int(_thumb_config.get("quality", 80))
+GENERATE_TIMEOUT = float(_thumb_config.get("timeout_seconds", 30))
+
+# 開けなかったキーを覚えておく数 (超えたら古いものから忘れる)
+MAX_FAILED = 10000
+
+# 使用時刻 (mtime) の更新はこの間隔より古いときだけ行う
+TOUCH_INTERVAL = 3600
+
+# サムネイルはキー (内容の SHA-256、以前の形式の添付は保存名) とサイズで1ファイル
+# 同じ内容の添付は同じサムネイルを共有する
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_lock = threading.Lock()
+_inflight = {}          # (key, size) -> Future
+_failed = OrderedDict() # 画像として開けなかったキー (再試行しない、古い順に MAX_FAILED 件まで)
+
+# LRU: path -> bytes (古い順)。初回アクセス時にディレクトリを走査して作る
+_index = None
+_total_bytes = 0
+
+stats = {"generated": 0, "hits": 0, "evicted": 0, "failed": 0}
+
+
+def available() -> bool:
+    return Image is not None and _thumb_config.get("enabled", True)
+
+
+def is_image(mime_type: str | None) -> bool:
+    # SVG はラスタライズしない
+    return bool(mime_type) and mime_type.startswith("image/") and mime_type != "image/svg+xml"
+
+
+def pick_size(requested: int) -> int:
+    """要求サイズ以上で最小の設定サイズ (無ければ最大)。キャッシュの種類を設定の数に抑える"""
+    for size in THUMBNAIL_SIZES:
+        if size >= requested:
+            return size
+    return THUMBNAIL_SIZES[-1]
+
+
+def thumbnail_path(key: str, size: int) -> str:
+    return os.path.join(THUMBNAIL_DIR, key[:2], f"{key}_{size}.jpg")
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(_thumb_config.get("workers", 2)),
+                thread_name_prefix="thumbnail",
+            )
+        return _executor
+
+
+def shutdown_thumbnail_pool():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+# -------------------------------------------
+# LRU (ディスク上のキャッシュ)
+# -------------------------------------------
+
+def _load_index():
+    """_lock を持って呼ぶ"""
+    global _index, _total_bytes
+
+    if _index is not None:
+        return
+
+    entries = []
+    if os.path.isdir(THUMBNAIL_DIR):
+        for root, _, files in os.walk(THUMBNAIL_DIR):
+            for name in files:
+                if name.startswith("."):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, path, st.st_size))
+
+    entries.sort()
+    _index = OrderedDict((path, size) for _, path, size in entries)
+    _total_bytes = sum(_index.values())
+
+
+def _record(path: str, size: int):
+    """生成したファイルを LRU に登録し、上限を超えた分を古い順に消す"""
+    global _total_bytes
+
+    evict = []
+    with _lock:
+        _load_index()
+        _total_bytes += size - _index.pop(path, 0)
+        _index[path] = size
+        while _total_bytes > MAX_CACHE_BYTES and len(_index) > 1:
+            old_path, old_size = _index.popitem(last=False)
+            _total_bytes -= old_size
+            evict.append(old_path)
+        stats["evicted"] += len(evict)
+
+    for old_path in evict:
+        try:
+            os.remove(old_path)
+        except FileNotFoundError:
+            pass
+
+
+def _touch(path: str):
+    with _lock:
+        _load_index()
+        if path in _index:
+            _index.move_to_end(path)
+        stats["hits"] += 1
+    try:
+        if time.time() - os.stat(path).st_mtime > TOUCH_INTERVAL:
+            os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _forget(path: str):
+    global _total_bytes
+    with _lock:
+        if _index is not None and path in _index:
+            _total_bytes -= _index.pop(path)
+
+
+# -------------------------------------------
+# 生成
+# -------------------------------------------
+
+def _render(src_path: str, dest_path: str, size: int) -> bool:
+
+    try:
+        with Image.open(src_path) as img:
+            # JPEG は縮小しながらデコードできる
+            img.draft("RGB", (size, size))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((size, size))
+
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), prefix=".thumb-")
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    img.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True)
+                os.replace(temp_path, dest_path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.info(f"Cannot create thumbnail for {src_path}: {e}")
+        return False
+
+    return True
+
+
+def _generate(key: str, src_path: str, size: int) -> str | None:
+
+    dest_path = thumbnail_path(key, size)
+
+    try:
+        if key in _failed:
+            return None
+
+        if os.path.exists(dest_path):
+            return dest_path
+
+        if not src_path or not os.path.exists(src_path):
+            return None
+
+        if not _render(src_path, dest_path, size):
+            with _lock:
+                _failed[key] = True
+                while len(_failed) > MAX_FAILED:
+                    _failed.popitem(last=False)
+                stats["failed"] += 1
+            return None
+
+        with _lock:
+            stats["generated"] += 1
+        _record(dest_path, os.path.getsize(dest_path))
+        return dest_path
+
+    finally:
+        with _lock:
+            _inflight.pop((key, size), None)
+
+
+def _submit(key: str, src_path: str, size: int):
+    """同じ (キー, サイズ) の生成が実行中ならその Future を返す"""
+    with _lock:
+        future = _inflight.get((key, size))
+        if future is None:
+            future = _get_executor().submit(_generate, key, src_path, size)
+            _inflight[(key, size)] = future
+        return future
+
+
+def schedule_thumbnails(key: str, src_path: str, mime_type: str | None):
+    """アップロード・インポート後に全サイズをバックグラウンドで作る"""
+    if not available() or not is_image(mime_type):
+        return
+    for size in THUMBNAIL_SIZES:
+        if not os.path.exists(thumbnail_path(key, size)):
+            _submit(key, src_path, size)
+
+
+def get_thumbnail(key: str, src_path: str, size: int, timeout: float = GENERATE_TIMEOUT) -> str | None:
+    """
+    キャッシュにあればそのパス、無ければ作って返す (作れなければ None)
+    timeout 秒で作り終わらなければ TimeoutError (生成は続け、次の要求でキャッシュから返す)
+    """
+
+    path = thumbnail_path(key, size)
+    if os.path.exists(path):
+        _touch(path)
+        return path
+
+    return _submit(key, src_path, size).result(timeout)
+
+
+def invalidate_thumbnails(key: str):
+    """元ファイルの削除時に呼ぶ"""
+    if not key:
+        return
+    with _lock:
+        _failed.pop(key, None)
+    for size in THUMBNAIL_SIZES:
+        path = thumbnail_path(key, size)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        _forget(path)
+
+
+def thumbnail_stats():
+    with _lock:
+        return {
+            **stats,
+            "files": len(_index) if _index is not None else None,
+            "bytes": _total_bytes if _index is not None else None,
+            "max_bytes": MAX_CACHE_BYTES,
+            "failed_keys": len(_failed),
+            "inflight": len(_inflight),
+        }
@@ -1,31 +1,250 @@
-from datetime import datetime, timezone
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import logging
+import math
+import threading
+import time
 
-from ..utils import note_content_fingerprint, note_fingerprint
+from ..config import get_config
+from ..utils import SQL_IN_CHUNK
 
+logger = logging.getLogger("tombstones")
+
+config = get_config()
+_tombstone_conf = config.get("tombstones", {})
+
+BLOOM_ENABLED = bool(_tombstone_conf.get("bloom_filter", True))
+BLOOM_FP_RATE = float(_tombstone_conf.get("false_positive_rate", 0.01))
+BLOOM_MAX_USERS = int(_tombstone_conf.get("max_cached_users", 1000))
+RETENTION_DAYS = int(_tombstone_conf.get("retention_days", 0))     # 既定は無期限 (以前と同じく再作成を拒否し続ける)
+MAX_PER_USER = int(_tombstone_conf.get("max_per_user", 0))
+
+# 読み込み時の件数に対してこの倍率の余裕を持たせる (超えたら次の確認時に作り直す)
+BLOOM_HEADROOM = 2
+BLOOM_MIN_CAPACITY = 1024
+
+stats = {
+    "checks": 0,
+    "bloom_skipped": 0,         # フィルタで「無い」と分かり SQL を省いた
+    "sql_checks": 0,
+    "false_positives": 0,       # フィルタは「あるかも」だったが SQL では無かった
+    "filters_loaded": 0,
+    "compacted": 0,
+    "last_compaction": None,
+}
+
+
+class _BloomFilter:
+    """
+    指紋 (SHA-256 の16進) の集合。「無い」は確実、「ある」は誤判定を含む
+    値が既にハッシュなので、先頭 128bit から2つの値を取り double hashing で k 個の位置を作る
+    """
+
+    def __init__(self, capacity: int, fp_rate: float):
+        self.capacity = capacity
+        self.count = 0
+        self.size = max(64, int(math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, fingerprint: str):
+        h1 = int(fingerprint[:16], 16)
+        h2 = int(fingerprint[16:32], 16) | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, fingerprint: str):
+        for pos in self._positions(fingerprint):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, fingerprint: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(fingerprint))
+
+    @property
+    def full(self) -> bool:
+        return self.count > self.capacity
+
+
+# user_id -> _BloomFilter (使われた順、BLOOM_MAX_USERS を超えたら古いものから捨てる)
+# ※ プロセス内のキャッシュなので、ワーカー1つで動かす前提 (config.py の database を参照)
+_filters = OrderedDict()
+_lock = threading.Lock()
+
+
+def _load_filter(cur, user_id: int) -> _BloomFilter:
+    cur.execute("SELECT note_hash, content_hash FROM note_tombstones WHERE user_id = ?", (user_id,))
+    rows = cur.fetchall()
+
+    bloom = _BloomFilter(max(BLOOM_MIN_CAPACITY, len(rows) * 2 * BLOOM_HEADROOM), BLOOM_FP_RATE)
+    for note_hash, content_hash in rows:
+        bloom.add(note_hash)
+        if content_hash:
+            bloom.add(content_hash)
+
+    with _lock:
+        _filters[user_id] = bloom
+        _filters.move_to_end(user_id)
+        while len(_filters) > BLOOM_MAX_USERS:
+            _filters.popitem(last=False)
+        stats["filters_loaded"] += 1
+
+    return bloom
+
+
+def _get_filter(cur, user_id: int) -> _BloomFilter:
+    """
+    書き込み接続 (ライターロック) を持って呼ぶ
+    読み込み中に他のリクエストが墓標を追加し、フィルタから漏れることを防ぐ
+    """
+    with _lock:
+        bloom = _filters.get(user_id)
+        if bloom is not None and not bloom.full:
+            _filters.move_to_end(user_id)
+            return bloom
+    return _load_filter(cur, user_id)
+
+
+def invalidate_tombstone_filters(user_ids=None):
+    """墓標を削除したら呼ぶ (ブルームフィルタからは消せないので作り直す)"""
+    with _lock:
+        if user_ids is None:
+            _filters.clear()
+        else:
+            for user_id in user_ids:
+                _filters.pop(user_id, None)
+
+
+def add_note_tombstones(cur, note_ids, user_id: int | None = None):
+    """
+    削除・ゴミ箱に入れるノートの墓標を作る (notes.note_hash / content_hash をコピーする)
+    user_id を指定したときはそのユーザのノートだけ (IN (...) は SQL_IN_CHUNK 件ずつ)
+    """
+    note_ids = list(note_ids)
+    if not note_ids:
+        return
 
-def add_note_tombstone(cur, user_id: int, title: str, content: str, source_note_id: int | None = None):
     deleted_at = datetime.now(timezone.utc).isoformat()
-    note_hash = note_fingerprint(title, content)
-    content_hash = note_content_fingerprint(content)
-    cur.execute("""
-        INSERT INTO note_tombstones
-            (user_id, note_hash, content_hash, source_note_id, deleted_at)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(user_id, note_hash) DO UPDATE SET
-            content_hash = excluded.content_hash,
-            source_note_id = excluded.source_note_id,
-            deleted_at = excluded.deleted_at
-    """, (user_id, note_hash, content_hash, source_note_id, deleted_at))
-
-
-def note_tombstone_exists(cur, user_id: int, title: str, content: str) -> bool:
-    note_hash = note_fingerprint(title, content)
-    content_hash = note_content_fingerprint(content)
+    owner = "AND user_id = ?" if user_id is not None else ""
+
+    rows = []
+    for i in range(0, len(note_ids), SQL_IN_CHUNK):
+        chunk = note_ids[i:i + SQL_IN_CHUNK]
+        placeholders = ",".join(["?"] * len(chunk))
+        params = [deleted_at, *chunk] + ([user_id] if user_id is not None else [])
+
+        cur.execute(f"""
+            INSERT INTO note_tombstones
+                (user_id, note_hash, content_hash, source_note_id, deleted_at)
+            SELECT user_id, note_hash, content_hash, id, ?
+            FROM notes
+            WHERE id IN ({placeholders}) {owner}
+            ON CONFLICT(user_id, note_hash) DO UPDATE SET
+                content_hash = excluded.content_hash,
+                source_note_id = excluded.source_note_id,
+                deleted_at = excluded.deleted_at
+            RETURNING user_id, note_hash, content_hash
+        """, params)
+        rows.extend(cur.fetchall())
+
+    # 読み込み済みのフィルタにだけ追加する (ロールバックされても誤判定が増えるだけ)
+    with _lock:
+        for row_user_id, note_hash, content_hash in rows:
+            bloom = _filters.get(row_user_id)
+            if bloom is not None:
+                bloom.add(note_hash)
+                bloom.add(content_hash)
+
+
+def note_tombstone_exists(cur, user_id: int, note_hash: str, content_hash: str) -> bool:
+    """
+    指紋は utils.note_hashes で作ったもの
+    cur は書き込み接続のもの (フィルタの読み込みと墓標の追加を同時に行わせない)
+    """
+
+    stats["checks"] += 1
+
+    if BLOOM_ENABLED:
+        bloom = _get_filter(cur, user_id)
+        if note_hash not in bloom and content_hash not in bloom:
+            stats["bloom_skipped"] += 1
+            return False
+
+    stats["sql_checks"] += 1
+    # OR で1つの WHERE にすると user_id だけで索引を引くので、それぞれの索引で調べる
     cur.execute("""
-        SELECT 1
-        FROM note_tombstones
-        WHERE user_id = ?
-          AND (note_hash = ? OR content_hash = ?)
-        LIMIT 1
-    """, (user_id, note_hash, content_hash))
-    return cur.fetchone() is not None
+        SELECT EXISTS (SELECT 1 FROM note_tombstones WHERE user_id = ? AND note_hash = ?)
+            OR EXISTS (SELECT 1 FROM note_tombstones WHERE user_id = ? AND content_hash = ?)
+    """, (user_id, note_hash, user_id, content_hash))
+    found = bool(cur.fetchone()[0])
+
+    if BLOOM_ENABLED and not found:
+        stats["false_positives"] += 1
+
+    return found
+
+
+# -------------------------------------------
+# 保持期間を過ぎた墓標の削除 (maintenance の定期実行から呼ぶ)
+# -------------------------------------------
+
+def compact_tombstones(cur, limit: int = 1000) -> int:
+    """
+    retention_days より古い墓標と、ユーザごとに max_per_user を超えた古い墓標を limit 件まで消す
+    消した件数を返す。消した後は該当ユーザのフィルタを作り直す
+    """
+
+    users = set()
+    deleted = 0
+
+    if RETENTION_DAYS > 0:
+        threshold = (datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS)).isoformat()
+        cur.execute("""
+            DELETE FROM note_tombstones
+            WHERE id IN (SELECT id FROM note_tombstones WHERE deleted_at < ? ORDER BY deleted_at LIMIT ?)
+            RETURNING user_id
+        """, (threshold, limit))
+        rows = cur.fetchall()
+        users.update(row[0] for row in rows)
+        deleted += len(rows)
+
+    if MAX_PER_USER > 0 and deleted < limit:
+        cur.execute("""
+            SELECT user_id, COUNT(*) FROM note_tombstones
+            GROUP BY user_id HAVING COUNT(*) > ?
+        """, (MAX_PER_USER,))
+        for user_id, count in cur.fetchall():
+            overflow = min(count - MAX_PER_USER, limit - deleted)
+            if overflow <= 0:
+                break
+            cur.execute("""
+                DELETE FROM note_tombstones
+                WHERE id IN (
+                    SELECT id FROM note_tombstones WHERE user_id = ?
+                    ORDER BY deleted_at LIMIT ?
+                )
+            """, (user_id, overflow))
+            users.add(user_id)
+            deleted += cur.rowcount or 0
+
+    if deleted:
+        logger.info(f"🪦 Compacted {deleted} note tombstones")
+        invalidate_tombstone_filters(users)
+
+    stats["compacted"] += deleted
+    stats["last_compaction"] = {"deleted": deleted, "finished_at": time.time()}
+    return deleted
+
+
+def tombstone_stats():
+    with _lock:
+        cached = len(_filters)
+        bloom_bytes = sum(len(f.bits) for f in _filters.values())
+    return {
+        **stats,
+        "cached_filters": cached,
+        "filter_bytes": bloom_bytes,
+        "bloom_filter": BLOOM_ENABLED,
+        "retention_days": RETENTION_DAYS,
+        "max_per_user": MAX_PER_USER,
+    }
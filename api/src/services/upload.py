@@ -0,0 +1,182 @@
+import hashlib
+import os
+import tempfile
+
+from starlette.concurrency import run_in_threadpool
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # 古い python-multipart
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# Content-Length で先に判定するとき、境界文字列やヘッダの分として許容するバイト数
+MULTIPART_OVERHEAD = 16 * 1024
+
+TEMP_PREFIX = ".upload-"
+TEMP_SUFFIX = ".part"
+
+
+class UploadError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class StreamedUpload:
+    """ストリーミングで受け取ったファイル (一時ファイルに書き込み済み)"""
+
+    def __init__(self, filename: str, content_type: str | None, temp_path: str, size: int, sha256: str):
+        self.filename = filename
+        self.content_type = content_type
+        self.temp_path = temp_path
+        self.size = size
+        self.sha256 = sha256
+
+    def commit(self, dest_path: str):
+        """一時ファイルを最終的なパスへ移動する (同じディレクトリ内なのでアトミック)"""
+        os.replace(self.temp_path, dest_path)
+        self.temp_path = None
+
+    def discard(self):
+        if self.temp_path:
+            try:
+                os.remove(self.temp_path)
+            except FileNotFoundError:
+                pass
+            self.temp_path = None
+
+
+class _TempWriter:
+    """一時ファイルへの書き込みとハッシュ計算を同じパスで行う"""
+
+    def __init__(self, upload_dir: str, max_bytes: int):
+        fd, self.path = tempfile.mkstemp(dir=upload_dir, prefix=TEMP_PREFIX, suffix=TEMP_SUFFIX)
+        self.file = os.fdopen(fd, "wb")
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.max_bytes = max_bytes
+
+    def write(self, chunks):
+        for data in chunks:
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                raise UploadError(413, "File too large")
+            self.hasher.update(data)
+            self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+async def receive_upload(request, field_name: str, upload_dir: str, max_bytes: int) -> StreamedUpload:
+    """
+    multipart/form-data のリクエストボディを読みながら field_name のファイルを upload_dir の一時ファイルへ書き込む
+    - Content-Length が上限を超えていれば本文を読まずに 413
+    - 書き込み中に上限を超えた時点で中断して 413 (一時ファイルは削除)
+    - SHA-256 とサイズは書き込みと同時に計算する
+    """
+
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + MULTIPART_OVERHEAD:
+        raise UploadError(413, "File too large")
+
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadError(400, "multipart/form-data is required")
+
+    state = {
+        "header_field": b"",
+        "header_value": b"",
+        "headers": {},
+        "in_target": False,
+        "filename": None,
+        "content_type": None,
+        "found": False,
+    }
+    pending = []
+
+    def on_part_begin():
+        state["headers"] = {}
+        state["in_target"] = False
+
+    def on_header_field(data, start, end):
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["header_value"] += data[start:end]
+
+    def on_header_end():
+        state["headers"][state["header_field"].lower()] = state["header_value"]
+        state["header_field"] = b""
+        state["header_value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        filename = options.get(b"filename")
+        # 最初に見つかった対象フィールドだけを受け取る
+        if name == field_name and filename is not None and not state["found"]:
+            state["in_target"] = True
+            state["found"] = True
+            state["filename"] = filename.decode("utf-8", "replace")
+            part_type = state["headers"].get(b"content-type")
+            state["content_type"] = part_type.decode("latin-1") if part_type else None
+
+    def on_part_data(data, start, end):
+        if state["in_target"]:
+            pending.append(data[start:end])
+
+    def on_part_end():
+        state["in_target"] = False
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    writer = _TempWriter(upload_dir, max_bytes)
+
+    try:
+        async for chunk in request.stream():
+            try:
+                parser.write(chunk)
+            except Exception:
+                raise UploadError(400, "Invalid multipart body")
+
+            if pending:
+                chunks = pending[:]
+                pending.clear()
+                await run_in_threadpool(writer.write, chunks)
+
+        parser.finalize()
+
+        if not state["found"]:
+            raise UploadError(400, f"Field '{field_name}' is required")
+
+        await run_in_threadpool(writer.close)
+
+    except BaseException:
+        writer.discard()
+        raise
+
+    return StreamedUpload(
+        filename=state["filename"],
+        content_type=state["content_type"],
+        temp_path=writer.path,
+        size=writer.size,
+        sha256=writer.hasher.hexdigest(),
+    )
@@ -8,21 +8,18 @@ def normalize_newlines(text: str) -> str:
     return text.replace("\r\n", "\n").replace("\r", "\n")
 
 
-def note_fingerprint(title: str, content: str) -> str:
-    """本文を保存せず、削除済みノートの再作成検出に使う指紋を作る。"""
-    normalized_title = title or ""
-    normalized_content = normalize_newlines(content or "")
+def note_hashes(title: str, content: str) -> tuple[str, str]:
+    """
+    ノートの指紋 (note_hash, content_hash) を作る (削除済みノートの再作成の検出・重複の判定に使う)
+    note_hash はタイトルと本文、content_hash は本文だけの SHA-256 (タイトルだけ変えた再送も検出する)
+    content は normalize_newlines 済みのもの (保存する値) を渡す
+    """
+    body = (content or "").encode("utf-8")
     h = hashlib.sha256()
-    h.update(normalized_title.encode("utf-8"))
+    h.update((title or "").encode("utf-8"))
     h.update(b"\0")
-    h.update(normalized_content.encode("utf-8"))
-    return h.hexdigest()
-
-
-def note_content_fingerprint(content: str) -> str:
-    """タイトルだけ変形して再送された削除済みノートを検出する。"""
-    normalized_content = normalize_newlines(content or "")
-    return hashlib.sha256(normalized_content.encode("utf-8")).hexdigest()
+    h.update(body)
+    return h.hexdigest(), hashlib.sha256(body).hexdigest()
 
 
 def normalize_tag_name(name: str) -> str:
@@ -40,6 +37,8 @@ def normalize_tag_name(name: str) -> str:
 
 TRASH_TAG_NAME = "TRASH"
 
+SQL_IN_CHUNK = 500      # IN (...) に渡すパラメータ数の上限 (古い SQLite の変数の上限 999 より小さく)
+
 
 def parse_important_flag(value) -> int:
     """Parse import metadata into the integer flag stored in the DB."""
@@ -0,0 +1,62 @@
+"""
+テスト用の設定
+src を import する前に共有の設定 (config.get_config) を一時ディレクトリ向けに差し替える
+
+    cd api && pip install -r requirements-dev.txt && python -m pytest
+"""
+
+import copy
+import os
+import sys
+import tempfile
+
+import pytest
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, API_DIR)
+
+from src import config as config_module  # noqa: E402
+
+TMP_DIR = tempfile.mkdtemp(prefix="simplynote-test-")
+
+TEST_CONFIG = copy.deepcopy(config_module.DEFAULT_CONFIG)
+TEST_CONFIG["database"]["path"] = os.path.join(TMP_DIR, "test.db")
+TEST_CONFIG["database"]["pool"]["writer_timeout"] = 2
+TEST_CONFIG["upload"]["dir"] = os.path.join(TMP_DIR, "files")
+TEST_CONFIG["thumbnails"]["dir"] = os.path.join(TMP_DIR, "thumbs")
+TEST_CONFIG["auth"]["password"]["bcrypt_rounds"] = 4
+config_module._config = TEST_CONFIG
+
+ADMIN = {"username": "admin", "password": "password"}
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from src.main import app
+
+    os.environ["ADMIN_USER"] = ADMIN["username"]
+    os.environ["ADMIN_PASS"] = ADMIN["password"]
+
+    # 500 になる場合も応答として受け取る
+    with TestClient(app, raise_server_exceptions=False) as c:
+        yield c
+
+
+@pytest.fixture(scope="session")
+def auth_headers(client):
+    r = client.post("/auth/token", data=ADMIN)
+    assert r.status_code == 200, r.text
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+@pytest.fixture(scope="session")
+def other_headers(client):
+    """admin とは別の一般ユーザ"""
+    from src.auth import init_users
+
+    other = {"username": "other", "password": "other-pass"}
+    init_users([other])
+    r = client.post("/auth/token", data=other)
+    assert r.status_code == 200, r.text
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
@@ -0,0 +1,49 @@
+def _attachment(client, headers, content=b"download me"):
+    r = client.post("/notes", json={"title": "download", "content": "token"}, headers=headers)
+    note_id = r.json()["id"]
+    r = client.post(
+        f"/notes/{note_id}/attachments",
+        files={"file": ("d.txt", content, "text/plain")},
+        headers=headers,
+    )
+    assert r.status_code == 200, r.text
+    return r.json()["id"]
+
+
+def _download_token(client, headers, attachment_id):
+    r = client.post(f"/attachments/{attachment_id}/download-token", headers=headers)
+    assert r.status_code == 200, r.text
+    return r.json()["token"]
+
+
+def test_download_with_signed_token(client, auth_headers):
+    attachment_id = _attachment(client, auth_headers)
+    dl = _download_token(client, auth_headers, attachment_id)
+
+    r = client.get(f"/attachments/{attachment_id}?dl={dl}")
+    assert r.status_code == 200
+    assert r.content == b"download me"
+
+
+def test_access_token_not_accepted_in_query(client, auth_headers):
+    attachment_id = _attachment(client, auth_headers)
+    access_token = auth_headers["Authorization"].split()[1]
+
+    assert client.get(f"/attachments/{attachment_id}?token={access_token}").status_code == 401
+    assert client.get(f"/attachments/{attachment_id}?dl={access_token}").status_code == 401
+
+
+def test_download_token_is_scoped_to_one_attachment(client, auth_headers):
+    first = _attachment(client, auth_headers, b"first")
+    second = _attachment(client, auth_headers, b"second")
+    dl = _download_token(client, auth_headers, first)
+
+    assert client.get(f"/attachments/{second}?dl={dl}").status_code == 401
+    # アクセストークンとしては使えない
+    assert client.get("/notes", headers={"Authorization": f"Bearer {dl}"}).status_code == 401
+
+
+def test_download_token_requires_ownership(client, auth_headers, other_headers):
+    attachment_id = _attachment(client, auth_headers)
+    r = client.post(f"/attachments/{attachment_id}/download-token", headers=other_headers)
+    assert r.status_code == 404
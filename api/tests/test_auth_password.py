@@ -0,0 +1,73 @@
+from passlib.context import CryptContext
+
+from src import auth
+from src.database import get_connection
+
+OTHER = {"username": "other", "password": "other-pass"}
+
+
+def _stored_hash(username):
+    with get_connection(readonly=True) as conn:
+        return conn.execute("SELECT password FROM users WHERE username=?", (username,)).fetchone()[0]
+
+
+def test_login_returns_503_when_password_workers_are_saturated(client, other_headers, monkeypatch):
+    called = []
+    authenticate_user = auth.authenticate_user
+
+    def recording_authenticate(*args):
+        called.append(args[0])
+        return authenticate_user(*args)
+
+    monkeypatch.setattr(auth, "authenticate_user", recording_authenticate)
+
+    # 実行中と待ち行列の枠をすべて埋める
+    slots = auth.PASSWORD_WORKERS + auth.PASSWORD_QUEUE_SIZE
+    taken = 0
+    while auth._password_slots.acquire(blocking=False):
+        taken += 1
+    assert taken == slots
+
+    try:
+        r = client.post("/auth/token", data=OTHER)
+        assert r.status_code == 503
+        assert r.headers["retry-after"] == "1"
+        # bcrypt の計算は始めていない
+        assert called == []
+    finally:
+        for _ in range(taken):
+            auth._password_slots.release()
+
+    r = client.post("/auth/token", data=OTHER)
+    assert r.status_code == 200, r.text
+    assert called == ["other"]
+
+
+def test_login_rehashes_after_rounds_change(client, other_headers, monkeypatch):
+    old_hash = _stored_hash("other")
+    assert old_hash.startswith(f"$2b${auth.BCRYPT_ROUNDS:02d}$")
+
+    rounds = auth.BCRYPT_ROUNDS + 1
+    monkeypatch.setattr(auth, "pwd_context", CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds))
+
+    # 誤ったパスワードでは作り直さない
+    r = client.post("/auth/token", data={**OTHER, "password": "wrong"})
+    assert r.status_code == 401
+    assert _stored_hash("other") == old_hash
+
+    r = client.post("/auth/token", data=OTHER)
+    assert r.status_code == 200, r.text
+    new_hash = _stored_hash("other")
+    assert new_hash.startswith(f"$2b${rounds:02d}$")
+    assert auth.pwd_context.verify(OTHER["password"], new_hash)
+
+    # 設定どおりのハッシュになった後は書き換えない
+    r = client.post("/auth/token", data=OTHER)
+    assert r.status_code == 200, r.text
+    assert _stored_hash("other") == new_hash
+
+    # 元の設定に戻すと、次のログインで元のコストに作り直す
+    monkeypatch.undo()
+    r = client.post("/auth/token", data=OTHER)
+    assert r.status_code == 200, r.text
+    assert _stored_hash("other").startswith(f"$2b${auth.BCRYPT_ROUNDS:02d}$")
@@ -0,0 +1,63 @@
+import threading
+
+from src import database
+from src.database import get_connection, pool_status
+from src.routers import tags as tags_router
+
+
+def _write_from_other_thread():
+    """別スレッドで書き込み接続を取得して1行書き込む。発生した例外を返す"""
+    errors = []
+
+    def run():
+        try:
+            with get_connection() as conn:
+                conn.execute("INSERT INTO tags (name) VALUES ('POOL-TEST') ON CONFLICT(name) DO NOTHING")
+        except Exception as e:
+            errors.append(e)
+
+    t = threading.Thread(target=run)
+    t.start()
+    t.join(10)
+    return errors
+
+
+def test_writer_released_when_handler_raises(client, auth_headers, monkeypatch):
+    r = client.post("/notes", json={"title": "pool", "content": "writer"}, headers=auth_headers)
+    note_id = r.json()["id"]
+
+    def boom(name):
+        raise RuntimeError("boom")
+
+    # タグ名の正規化は書き込み接続を持った状態で呼ばれる
+    monkeypatch.setattr(tags_router, "normalize_tag_name", boom)
+    r = client.post(f"/notes/{note_id}/tags", json={"name": "work"}, headers=auth_headers)
+    assert r.status_code == 500
+
+    assert pool_status()["writer_busy"] is False
+    assert _write_from_other_thread() == []
+
+
+def test_invalid_tag_name_is_rejected(client, auth_headers):
+    r = client.post("/notes", json={"title": "pool", "content": "tag type"}, headers=auth_headers)
+    r = client.post(f"/notes/{r.json()['id']}/tags", json={"name": 123}, headers=auth_headers)
+    assert r.status_code == 400
+    assert pool_status()["writer_busy"] is False
+
+
+def test_nested_writer_close_keeps_outer_transaction(client):
+    with get_connection() as outer:
+        outer.execute("INSERT INTO tags (name) VALUES ('NESTED-OUTER')")
+
+        inner = get_connection()
+        assert inner.nested
+        inner.close()
+        with get_connection():
+            pass
+
+        assert outer.in_transaction
+
+    with get_connection(readonly=True) as conn:
+        row = conn.execute("SELECT 1 FROM tags WHERE name = 'NESTED-OUTER'").fetchone()
+    assert row is not None
+    assert database._pool._writer_owner is None
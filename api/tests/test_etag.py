@@ -0,0 +1,68 @@
+import uuid
+
+
+def _etag(client, headers, url):
+    r = client.get(url, headers=headers)
+    assert r.status_code == 200, r.text
+    return r.headers["etag"]
+
+
+def _not_modified(client, headers, url, etag):
+    r = client.get(url, headers={**headers, "If-None-Match": etag})
+    return r.status_code == 304
+
+
+def _create(client, headers):
+    content = uuid.uuid4().hex
+    r = client.post("/notes", json={"title": "etag", "content": content}, headers=headers)
+    assert r.status_code == 200, r.text
+    return r.json()["id"], content
+
+
+def test_unchanged_resources_return_304(client, auth_headers):
+    note_id, _ = _create(client, auth_headers)
+
+    for url in ("/notes", "/tags", f"/notes/{note_id}"):
+        etag = _etag(client, auth_headers, url)
+        r = client.get(url, headers={**auth_headers, "If-None-Match": etag})
+        assert r.status_code == 304
+        assert r.headers["etag"] == etag
+        assert r.content == b""
+
+        # 弱い比較と複数指定
+        assert _not_modified(client, auth_headers, url, f'"other", W/{etag}')
+        assert not _not_modified(client, auth_headers, url, '"other"')
+
+
+def test_etag_changes_after_writes(client, auth_headers):
+    note_id, content = _create(client, auth_headers)
+    urls = ("/notes", "/tags", f"/notes/{note_id}")
+
+    def assert_changed(write, urls=urls):
+        etags = {url: _etag(client, auth_headers, url) for url in urls}
+        r = write()
+        assert r.status_code == 200, r.text
+        for url, etag in etags.items():
+            assert not _not_modified(client, auth_headers, url, etag), url
+            assert _etag(client, auth_headers, url) != etag
+
+    # ノート
+    assert_changed(lambda: client.put(
+        f"/notes/{note_id}", json={"title": "etag", "content": content + " edited"}, headers=auth_headers
+    ))
+    assert_changed(lambda: client.post("/notes", json={"title": "etag", "content": uuid.uuid4().hex}, headers=auth_headers))
+
+    # タグ
+    assert_changed(lambda: client.post(f"/notes/{note_id}/tags", json={"name": "etag"}, headers=auth_headers))
+    assert_changed(lambda: client.delete(f"/notes/{note_id}/tags/ETAG", headers=auth_headers))
+
+    # ゴミ箱
+    assert_changed(lambda: client.post(f"/notes/{note_id}/tags", json={"name": "trash"}, headers=auth_headers))
+    # 空にするとノート自体が無くなるので一覧だけ
+    assert_changed(lambda: client.delete("/trash", headers=auth_headers), urls[:2])
+
+
+def test_other_users_writes_keep_etag(client, auth_headers, other_headers):
+    etag = _etag(client, auth_headers, "/notes")
+    _create(client, other_headers)
+    assert _not_modified(client, auth_headers, "/notes", etag)
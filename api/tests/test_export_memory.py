@@ -0,0 +1,28 @@
+"""エクスポートが添付ファイルを丸ごとメモリに載せずに ZIP を組み立てることの確認 (bench.export_memory の縮小版)"""
+
+import tracemalloc
+
+from bench.export_memory import build_data
+from src.services.export import FILE_CHUNK_SIZE, iter_export_zip
+
+FILE_MB = 16
+
+
+def test_export_memory_is_bounded(client, tmp_path):
+    user_id = build_data(str(tmp_path), n_files=3, file_mb=FILE_MB, n_notes=300)
+
+    total = 0
+    largest = 0
+    tracemalloc.start()
+    try:
+        for data in iter_export_zip(user_id, str(tmp_path)):
+            total += len(data)
+            largest = max(largest, len(data))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert total > 3 * FILE_MB * 1024 * 1024
+    # 1回に返すのは添付の読み込み単位程度、ピークも読み込み単位の数倍で添付1ファイルより小さい
+    assert largest <= 2 * FILE_CHUNK_SIZE
+    assert peak < 8 * FILE_CHUNK_SIZE < FILE_MB * 1024 * 1024
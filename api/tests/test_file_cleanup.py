@@ -0,0 +1,44 @@
+import os
+import sqlite3
+import time
+import uuid
+
+from src.database import get_connection
+from src.services.file_cleanup import sweep_batch
+
+
+def test_sweep_batch_over_sqlite_variable_limit(client, auth_headers, tmp_path):
+    r = client.post("/notes", json={"title": uuid.uuid4().hex, "content": "sweep"}, headers=auth_headers)
+    r = client.post(
+        f"/notes/{r.json()['id']}/attachments",
+        files={"file": ("kept.txt", uuid.uuid4().bytes, "text/plain")},
+        headers=auth_headers,
+    )
+    kept = r.json()["url"].rsplit("/", 1)[1]
+
+    # sweep_batch_size の既定 (500) より多い候補。猶予期間より古くしておく
+    names = [uuid.uuid4().hex for _ in range(600)] + [kept]
+    old = time.time() - 7200
+    for name in names:
+        path = tmp_path / name
+        path.write_bytes(b"x")
+        os.utime(path, (old, old))
+
+    with get_connection() as conn:
+        # 古い SQLite と同じ変数の上限 (999)
+        previous = conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    try:
+        sweep_batch(str(tmp_path), ((str(tmp_path), name) for name in names), batch_size=len(names))
+    finally:
+        with get_connection() as conn:
+            conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, previous)
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT filename_stored FROM file_deletions")
+        queued = {row[0] for row in cur.fetchall()}
+        # 一時ディレクトリのファイルなので、テストの後は削除待ちから外す
+        cur.executemany("DELETE FROM file_deletions WHERE filename_stored = ?", [(name,) for name in names[:-1]])
+
+    assert set(names[:-1]) <= queued
+    assert kept not in queued
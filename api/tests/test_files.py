@@ -0,0 +1,107 @@
+import uuid
+
+from src.database import get_connection
+
+from test_storage_migration import _add_legacy_attachment
+
+
+def _upload(client, headers, content=b"secret attachment"):
+    r = client.post("/notes", json={"title": "files", "content": "owner check"}, headers=headers)
+    note_id = r.json()["id"]
+    r = client.post(
+        f"/notes/{note_id}/attachments",
+        files={"file": ("a.txt", content, "text/plain")},
+        headers=headers,
+    )
+    assert r.status_code == 200, r.text
+    return r.json()
+
+
+def test_files_requires_authentication(client, auth_headers):
+    url = _upload(client, auth_headers)["url"]
+    assert client.get(url).status_code == 401
+
+
+def test_files_served_to_owner(client, auth_headers):
+    url = _upload(client, auth_headers)["url"]
+    r = client.get(url, headers=auth_headers)
+    assert r.status_code == 200
+    assert r.content == b"secret attachment"
+
+
+def test_files_hidden_from_other_users(client, auth_headers, other_headers):
+    # 同じ内容は共有の blob になるので、保存名はユーザによらず同じ
+    url = _upload(client, auth_headers, b"shared content")["url"]
+    assert client.get(url, headers=other_headers).status_code == 404
+
+    own_url = _upload(client, other_headers, b"shared content")["url"]
+    assert own_url == url
+    assert client.get(url, headers=other_headers).status_code == 200
+
+
+def _download_token(client, headers, attachment_id):
+    r = client.post(f"/attachments/{attachment_id}/download-token", headers=headers)
+    assert r.status_code == 200, r.text
+    return r.json()["token"]
+
+
+def test_legacy_url_loads_with_download_token(client, auth_headers):
+    # <img> / <a href> と同じくヘッダ無しで、移行前の保存名の URL を開く
+    attachment_id, filename = _add_legacy_attachment(client, auth_headers)
+    dl = _download_token(client, auth_headers, attachment_id)
+
+    r = client.get(f"/files/{filename}?dl={dl}")
+    assert r.status_code == 200
+    assert r.content == filename.encode()
+
+
+def test_aliased_url_loads_with_download_token(client, auth_headers):
+    entry = _upload(client, auth_headers, b"aliased content")
+    stored = entry["url"].rsplit("/", 1)[1]
+    old_name = f"{uuid.uuid4().hex}.txt"
+    with get_connection() as conn:
+        conn.execute(
+            "INSERT INTO attachment_aliases (filename, filename_stored) VALUES (?, ?)", (old_name, stored)
+        )
+
+    dl = _download_token(client, auth_headers, entry["id"])
+    r = client.get(f"/files/{old_name}?dl={dl}")
+    assert r.status_code == 200
+    assert r.content == b"aliased content"
+
+
+def test_download_token_is_scoped_to_its_file(client, auth_headers):
+    first = _upload(client, auth_headers, b"first file")
+    second = _upload(client, auth_headers, b"second file")
+    dl = _download_token(client, auth_headers, first["id"])
+
+    assert client.get(f"{second['url']}?dl={dl}").status_code == 404
+    assert client.get(f"{first['url']}?dl=invalid").status_code == 401
+
+
+def test_shared_blob_is_served_with_each_attachments_type(client, auth_headers):
+    content = uuid.uuid4().bytes * 4
+
+    def upload(name, content_type):
+        r = client.post("/notes", json={"title": uuid.uuid4().hex, "content": "mime"}, headers=auth_headers)
+        r = client.post(
+            f"/notes/{r.json()['id']}/attachments",
+            files={"file": (name, content, content_type)},
+            headers=auth_headers,
+        )
+        assert r.status_code == 200, r.text
+        return r.json()
+
+    png = upload("a.png", "image/png")
+    txt = upload("b.txt", "text/plain")
+
+    # 同じ内容なので保存名は共通、拡張子は付けない
+    assert png["url"] == txt["url"]
+    assert "." not in png["url"].rsplit("/", 1)[1]
+
+    for entry, media_type in ((png, "image/png"), (txt, "text/plain")):
+        dl = _download_token(client, auth_headers, entry["id"])
+        r = client.get(f"{entry['url']}?dl={dl}")
+        assert r.status_code == 200
+        assert r.headers["content-type"].startswith(media_type)
+        assert r.headers["x-content-type-options"] == "nosniff"
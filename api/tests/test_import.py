@@ -0,0 +1,135 @@
+import io
+import os
+import uuid
+import zipfile
+
+from src.config import get_config
+from src.database import get_connection, pool_status
+from src.services import importer
+
+from test_connection_pool import _write_from_other_thread
+
+
+def _zip(notes, attachments=()):
+    """notes: [(ファイル名, 本文)], attachments: [(ZIP 内のパス, 内容)]"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, text in notes:
+            zf.writestr(name, text)
+        for name, data in attachments:
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+
+def _import(client, headers, data):
+    return client.post("/import", files={"file": ("notes.zip", data, "application/zip")}, headers=headers)
+
+
+def _count_notes(prefix):
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM notes WHERE title LIKE ?", (prefix + "%",))
+        return cur.fetchone()[0]
+
+
+def _temp_files():
+    upload_dir = get_config()["upload"]["dir"]
+    return [name for name in os.listdir(upload_dir) if name.startswith(importer.TEMP_PREFIX)]
+
+
+def test_import_releases_writer_between_chunks(client, auth_headers, monkeypatch):
+    prefix = uuid.uuid4().hex
+    notes = [(f"{i}`{prefix}-{i}.txt", f"body {i}") for i in range(5)]
+    attachments = [(f"attachments/{i}`{prefix}-{i}/a{i}.bin", f"{prefix}-{i}".encode()) for i in range(5)]
+
+    monkeypatch.setattr(importer, "BATCH_SIZE", 2)
+
+    # 添付のコピーとハッシュ計算は書き込み接続の外
+    hashed_with_writer = []
+    stage_attachment = importer.NoteImportWriter._stage_attachment
+
+    def checked_stage(self, att_info):
+        hashed_with_writer.append(pool_status()["writer_busy"])
+        return stage_attachment(self, att_info)
+
+    monkeypatch.setattr(importer.NoteImportWriter, "_stage_attachment", checked_stage)
+
+    # チャンクの commit 後は他のスレッドから書き込める
+    other_writes = []
+    bump_generation = importer.bump_generation
+
+    def write_between_chunks(user_id):
+        other_writes.append(_write_from_other_thread())
+        bump_generation(user_id)
+
+    monkeypatch.setattr(importer, "bump_generation", write_between_chunks)
+
+    r = _import(client, auth_headers, _zip(notes, attachments))
+    assert r.status_code == 200, r.text
+    assert r.json()["imported"] == 5
+    assert r.json()["chunks"] == 3
+
+    assert other_writes == [[], [], []]
+    assert hashed_with_writer == [False] * 5
+    assert _count_notes(prefix) == 5
+    assert _temp_files() == []
+
+
+def test_failed_chunk_keeps_committed_chunks(client, auth_headers, monkeypatch):
+    prefix = uuid.uuid4().hex
+    # 3件目 (2つ目のチャンク) はゴミ箱のノートで、墓標の作成で失敗させる
+    notes = [
+        (f"1`{prefix}-1.txt", "one"),
+        (f"2`{prefix}-2.txt", "two"),
+        (f"3`{prefix}-3.txt", "three\n---\nTags: TRASH"),
+    ]
+    attachments = [(f"attachments/3`{prefix}-3/a.bin", f"{prefix}-3".encode())]
+
+    monkeypatch.setattr(importer, "BATCH_SIZE", 2)
+
+    def boom(cur, note_ids, user_id=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(importer, "add_note_tombstones", boom)
+
+    upload_dir = get_config()["upload"]["dir"]
+    before = {os.path.join(d, f) for d, _, files in os.walk(upload_dir) for f in files}
+
+    r = _import(client, auth_headers, _zip(notes, attachments))
+    assert r.status_code == 500
+
+    assert _count_notes(prefix) == 2
+    assert _temp_files() == []
+    after = {os.path.join(d, f) for d, _, files in os.walk(upload_dir) for f in files}
+    assert after == before
+    assert pool_status()["writer_busy"] is False
+
+    # もう一度取り込むと commit 済みのノートは飛ばして続きから入る
+    monkeypatch.undo()
+    r = _import(client, auth_headers, _zip(notes, attachments))
+    assert r.status_code == 200, r.text
+    assert r.json()["imported"] == 1
+    assert r.json()["duplicates"] == 2
+    assert _count_notes(prefix) == 3
+
+
+def test_attachment_is_decompressed_once(client, auth_headers, monkeypatch):
+    prefix = uuid.uuid4().hex
+    notes = [(f"{i}`{prefix}-{i}.txt", f"body {i}") for i in range(2)]
+    attachments = [(f"attachments/{i}`{prefix}-{i}/a{i}.bin", f"{prefix}-{i}".encode() * 1000) for i in range(2)]
+    data = _zip(notes, attachments)
+
+    opened = []
+    zip_open = zipfile.ZipFile.open
+
+    def counting_open(self, name, *args, **kwargs):
+        filename = getattr(name, "filename", name)
+        if filename.startswith(importer.ATTACHMENT_PREFIX):
+            opened.append(filename)
+        return zip_open(self, name, *args, **kwargs)
+
+    monkeypatch.setattr(zipfile.ZipFile, "open", counting_open)
+
+    r = _import(client, auth_headers, data)
+    assert r.status_code == 200, r.text
+    assert sorted(opened) == sorted(name for name, _ in attachments)
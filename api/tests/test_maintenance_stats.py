@@ -0,0 +1,14 @@
+def test_stats_include_auth_cache(client, auth_headers):
+    # 同じトークンで2回目以降はキャッシュから引く
+    client.get("/maintenance/stats", headers=auth_headers)
+    r = client.get("/maintenance/stats", headers=auth_headers)
+    assert r.status_code == 200, r.text
+
+    auth_cache = r.json()["auth_cache"]
+    assert set(auth_cache) == {"tokens", "users"}
+    assert auth_cache["tokens"]["hits"] >= 1
+
+
+def test_stats_are_admin_only(client, other_headers):
+    r = client.get("/maintenance/stats", headers=other_headers)
+    assert r.status_code == 403
@@ -0,0 +1,29 @@
+import uuid
+
+
+def test_cursor_header_is_exposed_to_browsers(client, other_headers):
+    tag = uuid.uuid4().hex.upper()
+    created = []
+    for i in range(3):
+        r = client.post("/notes", json={"title": f"{tag}-{i}", "content": "page"}, headers=other_headers)
+        note_id = r.json()["id"]
+        client.post(f"/notes/{note_id}/tags", json={"name": tag}, headers=other_headers)
+        created.append(note_id)
+
+    # 別オリジンの画面から読めるよう CORS で公開している
+    headers = {**other_headers, "Origin": "http://ui.example"}
+    seen = []
+    cursor = None
+    while True:
+        params = {"tag": tag, "limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        r = client.get("/notes", params=params, headers=headers)
+        assert r.status_code == 200, r.text
+        assert "x-next-cursor" in r.headers["access-control-expose-headers"].lower()
+        seen.extend(note["id"] for note in r.json())
+        cursor = r.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    assert sorted(seen) == sorted(created)
@@ -0,0 +1,24 @@
+"""bench.query_plans の実行計画の確認をテストでも行う (インデックスを使わない走査に戻ったら失敗する)"""
+
+import pytest
+
+from bench.query_plans import QUERIES, full_scans, seed
+from src.database import get_connection
+
+
+@pytest.fixture(scope="module")
+def plan_cursor(client):
+    # 計画を見るだけなので、最低限の行を入れた状態で調べて最後に rollback する
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN")
+        seed(cur)
+        yield cur
+        conn.rollback()
+
+
+@pytest.mark.parametrize("name, sql, params, allowed", QUERIES, ids=[q[0] for q in QUERIES])
+def test_query_uses_index(plan_cursor, name, sql, params, allowed):
+    scans, plan = full_scans(plan_cursor, sql, params)
+    bad = [s for s in scans if s not in allowed]
+    assert not bad, f"{name}: full scan of {', '.join(bad)}\n" + "\n".join(plan)
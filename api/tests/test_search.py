@@ -0,0 +1,83 @@
+import random
+import uuid
+
+import pytest
+
+from src.database import get_connection
+from src.services.search import choose_index
+
+
+def _kanji(n):
+    """他のテストのノートと重ならない漢字の語"""
+    return "".join(chr(random.randint(0x4E00, 0x9FA5)) for _ in range(n))
+
+
+def _search(client, headers, q):
+    r = client.get("/notes/search", params={"q": q}, headers=headers)
+    assert r.status_code == 200, r.text
+    return {result["id"] for result in r.json()["results"]}
+
+
+def _create(client, headers, title, content):
+    r = client.post("/notes", json={"title": title, "content": content}, headers=headers)
+    assert r.status_code == 200, r.text
+    return r.json()["id"]
+
+
+def _trigram_ids(word):
+    with get_connection(readonly=True) as conn:
+        cur = conn.execute(
+            "SELECT rowid FROM notes_fts_trigram WHERE notes_fts_trigram MATCH ?", (f'"{word}"',)
+        )
+        return {row[0] for row in cur.fetchall()}
+
+
+@pytest.mark.parametrize("q, index", [
+    ("apple pie", "unicode61"),
+    ("ab", "unicode61"),
+    ("東京都", "trigram"),
+    ("日本 東京都", "trigram"),
+    ("日本", "like"),
+    ("日本 東京", "like"),
+    ("ニホン", "trigram"),
+    ("ﾆﾎ", "like"),
+])
+def test_choose_index(q, index):
+    assert choose_index(q) == index
+
+
+def test_two_char_cjk_query_falls_back_to_like(client, auth_headers):
+    word = _kanji(2)
+    note_id = _create(client, auth_headers, uuid.uuid4().hex, f"本文に{word}を含む")
+
+    # trigram 索引は3文字未満の語を引けないので、LIKE でなければ見つからない
+    assert _trigram_ids(word) == set()
+    assert note_id in _search(client, auth_headers, word)
+
+
+def test_unicode61_query(client, auth_headers):
+    word = f"w{uuid.uuid4().hex}"
+    note_id = _create(client, auth_headers, uuid.uuid4().hex, f"plain {word} text")
+    assert _search(client, auth_headers, word) == {note_id}
+
+
+def test_trigram_index_follows_update_and_delete(client, auth_headers):
+    old_word, new_word = _kanji(4), _kanji(4)
+    note_id = _create(client, auth_headers, uuid.uuid4().hex, f"{old_word}の本文")
+
+    assert _trigram_ids(old_word) == {note_id}
+    assert _search(client, auth_headers, old_word) == {note_id}
+
+    r = client.put(
+        f"/notes/{note_id}", json={"title": uuid.uuid4().hex, "content": f"{new_word}の本文"}, headers=auth_headers,
+    )
+    assert r.status_code == 200, r.text
+    assert _trigram_ids(old_word) == set()
+    assert _trigram_ids(new_word) == {note_id}
+    assert _search(client, auth_headers, old_word) == set()
+    assert _search(client, auth_headers, new_word) == {note_id}
+
+    r = client.delete(f"/notes/{note_id}", headers=auth_headers)
+    assert r.status_code == 200, r.text
+    assert _trigram_ids(new_word) == set()
+    assert _search(client, auth_headers, new_word) == set()
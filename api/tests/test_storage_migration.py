@@ -0,0 +1,61 @@
+import logging
+import os
+import time
+import uuid
+
+from src.config import get_config
+from src.database import get_connection
+from src.services import storage_migration
+
+
+def _add_legacy_attachment(client, headers):
+    """以前の形式の添付 (upload_dir 直下、sha256 が NULL) を作る"""
+    r = client.post("/notes", json={"title": uuid.uuid4().hex, "content": "legacy"}, headers=headers)
+    note_id = r.json()["id"]
+
+    upload_dir = get_config()["upload"]["dir"]
+    os.makedirs(upload_dir, exist_ok=True)
+    filename = f"{uuid.uuid4().hex}.txt"
+    with open(os.path.join(upload_dir, filename), "wb") as f:
+        f.write(filename.encode())
+
+    with get_connection() as conn:
+        cur = conn.execute(
+            "INSERT INTO attachments (note_id, filename_original, filename_stored, uploaded_at) VALUES (?, ?, ?, ?)",
+            (note_id, "a.txt", filename, "2020-01-01T00:00:00+00:00"),
+        )
+        return cur.lastrowid, filename
+
+
+def _wait_for_migration():
+    deadline = time.time() + 10
+    while storage_migration.stats["running"] and time.time() < deadline:
+        time.sleep(0.05)
+    assert storage_migration._thread is not None
+    storage_migration._thread.join(10)
+
+
+def test_migration_is_not_started_on_startup(client):
+    assert storage_migration.stats["last_run"] is None
+
+
+def test_admin_starts_storage_migration(client, auth_headers, other_headers, caplog):
+    attachment_id, filename = _add_legacy_attachment(client, auth_headers)
+
+    r = client.post("/maintenance/storage-migration", headers=other_headers)
+    assert r.status_code == 403
+
+    with caplog.at_level(logging.INFO, logger="storage_migration"):
+        r = client.post("/maintenance/storage-migration", headers=auth_headers)
+        assert r.status_code == 200, r.text
+        assert r.json()["started"] is True
+        _wait_for_migration()
+
+    with get_connection(readonly=True) as conn:
+        row = conn.execute("SELECT sha256 FROM attachments WHERE id=?", (attachment_id,)).fetchone()
+    assert row[0] is not None
+    assert any(f"Converted attachment {attachment_id}: {filename}" in m for m in caplog.messages)
+
+    r = client.get("/maintenance/stats", headers=auth_headers)
+    last_run = r.json()["storage_migration"]["last_run"]
+    assert last_run["converted"] >= 1
@@ -0,0 +1,93 @@
+import sqlite3
+import uuid
+
+from src.database import apply_migrations, get_connection
+
+
+def _sync(client, headers, since):
+    r = client.get("/sync", params={"since": since}, headers=headers)
+    assert r.status_code == 200, r.text
+    return r.json()
+
+
+def _create(client, headers):
+    r = client.post("/notes", json={"title": uuid.uuid4().hex, "content": uuid.uuid4().hex}, headers=headers)
+    assert r.status_code == 200, r.text
+    return r.json()["id"]
+
+
+def test_since_zero_is_full_sync(client, auth_headers):
+    note_id = _create(client, auth_headers)
+
+    body = _sync(client, auth_headers, 0)
+    assert body["full"] is True
+    assert body["deleted"] == []
+    assert note_id in {note["id"] for note in body["notes"]}
+
+
+def test_unknown_seq_is_full_sync(client, auth_headers):
+    note_id = _create(client, auth_headers)
+    seq = _sync(client, auth_headers, 0)["seq"]
+
+    # サーバの DB を作り直した場合など、クライアントの方が進んでいる
+    body = _sync(client, auth_headers, seq + 1000)
+    assert body["full"] is True
+    assert note_id in {note["id"] for note in body["notes"]}
+
+
+def test_delta_contains_updates_and_deletions(client, auth_headers):
+    updated = _create(client, auth_headers)
+    deleted = _create(client, auth_headers)
+    untouched = _create(client, auth_headers)
+    seq = _sync(client, auth_headers, 0)["seq"]
+
+    r = client.put(f"/notes/{updated}", json={"title": uuid.uuid4().hex, "content": uuid.uuid4().hex}, headers=auth_headers)
+    assert r.status_code == 200, r.text
+    r = client.delete(f"/notes/{deleted}", headers=auth_headers)
+    assert r.status_code == 200, r.text
+
+    body = _sync(client, auth_headers, seq)
+    assert body["full"] is False
+    assert body["seq"] > seq
+    ids = {note["id"] for note in body["notes"]}
+    assert updated in ids
+    assert untouched not in ids
+    assert deleted not in ids
+    assert body["deleted"] == [deleted]
+
+    # 最新のシーケンスからは差分なし
+    body = _sync(client, auth_headers, body["seq"])
+    assert body["full"] is False
+    assert body["notes"] == [] and body["deleted"] == []
+
+
+def test_sync_trigger_survives_note_hash_migration(client, auth_headers, tmp_path):
+    _create(client, auth_headers)
+
+    # 現在の DB を複製し、マイグレーション 5 の前 (指紋の列が無い) の状態に戻す
+    old = sqlite3.connect(tmp_path / "old.db", isolation_level=None)
+    with get_connection(readonly=True) as conn:
+        conn.backup(old)
+    old.execute("DROP INDEX idx_notes_user_note_hash")
+    old.execute("ALTER TABLE notes DROP COLUMN note_hash")
+    old.execute("ALTER TABLE notes DROP COLUMN content_hash")
+    old.execute("PRAGMA user_version = 4")
+
+    changes = old.execute("SELECT COUNT(*), MAX(seq) FROM note_changes").fetchone()
+    apply_migrations(old)
+
+    # 既存ノートの指紋の計算では変更履歴を付けない
+    assert old.execute("SELECT COUNT(*), MAX(seq) FROM note_changes").fetchone() == changes
+    assert old.execute("SELECT COUNT(*) FROM notes WHERE note_hash IS NULL").fetchone()[0] == 0
+
+    # トリガーは作り直されていて、更新が変更履歴に載る
+    assert old.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type='trigger' AND name='notes_sync_au'"
+    ).fetchone()[0] == 1
+    note_id, user_id = old.execute("SELECT id, user_id FROM notes ORDER BY id DESC LIMIT 1").fetchone()
+    before = old.execute("SELECT seq FROM sync_seq WHERE user_id=?", (user_id,)).fetchone()[0]
+    old.execute("UPDATE notes SET title = title || ' (edited)' WHERE id=?", (note_id,))
+    after = old.execute("SELECT seq FROM sync_seq WHERE user_id=?", (user_id,)).fetchone()[0]
+    assert after == before + 1
+    assert old.execute("SELECT seq FROM note_changes WHERE note_id=?", (note_id,)).fetchone()[0] == after
+    old.close()
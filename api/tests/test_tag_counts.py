@@ -0,0 +1,115 @@
+import uuid
+
+from src.database import get_connection, USER_TAG_COUNTS_SQL
+from src.services.maintenance import reconcile_tag_counts
+
+
+def _create(client, headers, tags=()):
+    r = client.post("/notes", json={"title": "count", "content": uuid.uuid4().hex}, headers=headers)
+    assert r.status_code == 200, r.text
+    note_id = r.json()["id"]
+    for tag in tags:
+        _tag(client, headers, note_id, tag)
+    return note_id
+
+
+def _tag(client, headers, note_id, tag):
+    r = client.post(f"/notes/{note_id}/tags", json={"name": tag}, headers=headers)
+    assert r.status_code == 200, r.text
+
+
+def _untag(client, headers, note_id, tag):
+    r = client.delete(f"/notes/{note_id}/tags/{tag}", headers=headers)
+    assert r.status_code == 200, r.text
+
+
+def _counts(client, headers, *tags):
+    r = client.get("/tags", headers=headers)
+    assert r.status_code == 200, r.text
+    counts = {t["name"]: t["note_count"] for t in r.json()}
+    return [counts.get(tag, 0) for tag in tags]
+
+
+def _stored_counts():
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id, tag_id, note_count FROM user_tag_counts")
+        return {(row[0], row[1]): row[2] for row in cur.fetchall()}
+
+
+def _recounted():
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute(USER_TAG_COUNTS_SQL)
+        return {(row[0], row[1]): row[2] for row in cur.fetchall()}
+
+
+def test_counts_follow_tag_trash_and_delete(client, other_headers):
+    a, b = f"A{uuid.uuid4().hex[:8]}".upper(), f"B{uuid.uuid4().hex[:8]}".upper()
+
+    n1 = _create(client, other_headers, [a, b])
+    n2 = _create(client, other_headers, [a])
+    n3 = _create(client, other_headers, [a])
+    assert _counts(client, other_headers, a, b) == [3, 1]
+
+    # タグの付け外し (同じタグをもう一度付けても増えない)
+    _tag(client, other_headers, n2, b)
+    _tag(client, other_headers, n2, b)
+    assert _counts(client, other_headers, a, b) == [3, 2]
+    _untag(client, other_headers, n1, b)
+    assert _counts(client, other_headers, a, b) == [3, 1]
+
+    # ゴミ箱のノートは数えない、戻すと数える
+    _tag(client, other_headers, n2, "trash")
+    assert _counts(client, other_headers, a, b) == [2, 0]
+    _untag(client, other_headers, n2, "TRASH")
+    assert _counts(client, other_headers, a, b) == [3, 1]
+
+    # ゴミ箱にあるノートのタグを外しても減らない
+    _tag(client, other_headers, n2, "trash")
+    _untag(client, other_headers, n2, b)
+    assert _counts(client, other_headers, a, b) == [2, 0]
+    _untag(client, other_headers, n2, "TRASH")
+    assert _counts(client, other_headers, a, b) == [3, 0]
+
+    # ノートの削除 (通常のノートとゴミ箱を空にした場合)
+    r = client.delete(f"/notes/{n1}", headers=other_headers)
+    assert r.status_code == 200, r.text
+    assert _counts(client, other_headers, a) == [2]
+    _tag(client, other_headers, n3, "trash")
+    r = client.delete("/trash", headers=other_headers)
+    assert r.status_code == 200, r.text
+    assert _counts(client, other_headers, a) == [1]
+
+    assert _stored_counts() == _recounted()
+
+
+def test_reconcile_fixes_drifted_counts(client, other_headers):
+    a, b = f"A{uuid.uuid4().hex[:8]}".upper(), f"B{uuid.uuid4().hex[:8]}".upper()
+    _create(client, other_headers, [a, b])
+    _create(client, other_headers, [a])
+
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM users WHERE username='other'")
+        user_id = cur.fetchone()[0]
+        cur.execute("SELECT name, id FROM tags WHERE name IN (?, ?)", (a, b))
+        tag_ids = dict(cur.fetchall())
+
+    # 集計をずらす (件数の誤り・行の欠落・存在しないタグの行)
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE user_tag_counts SET note_count = 7 WHERE user_id=? AND tag_id=?", (user_id, tag_ids[a]))
+        cur.execute("DELETE FROM user_tag_counts WHERE user_id=? AND tag_id=?", (user_id, tag_ids[b]))
+        cur.execute("INSERT INTO user_tag_counts (user_id, tag_id, note_count) VALUES (?, -1, 3)", (user_id,))
+    assert _counts(client, other_headers, a, b) == [7, 0]
+
+    with get_connection() as conn:
+        assert reconcile_tag_counts(conn.cursor()) == 3
+
+    assert _stored_counts() == _recounted()
+    assert _counts(client, other_headers, a, b) == [2, 1]
+
+    # 直した後はずれが無い
+    with get_connection() as conn:
+        assert reconcile_tag_counts(conn.cursor()) == 0
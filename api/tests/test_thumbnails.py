@@ -0,0 +1,59 @@
+import io
+import uuid
+
+from PIL import Image
+
+from src.services import thumbnails
+
+
+def _image_attachment(client, headers):
+    buf = io.BytesIO()
+    # 内容ごとにサムネイルを共有するので、テストごとに違う画像にする
+    Image.new("RGB", (64, 64), tuple(uuid.uuid4().bytes[:3])).save(buf, "PNG")
+
+    r = client.post("/notes", json={"title": uuid.uuid4().hex, "content": "thumb"}, headers=headers)
+    note_id = r.json()["id"]
+    r = client.post(
+        f"/notes/{note_id}/attachments",
+        files={"file": ("a.png", buf.getvalue(), "image/png")},
+        headers=headers,
+    )
+    assert r.status_code == 200, r.text
+    return r.json()["id"]
+
+
+def test_thumbnail(client, auth_headers):
+    attachment_id = _image_attachment(client, auth_headers)
+    r = client.get(f"/attachments/{attachment_id}/thumbnail?size=256", headers=auth_headers)
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "image/jpeg"
+
+
+def test_slow_thumbnail_returns_503(client, auth_headers, monkeypatch):
+    attachment_id = _image_attachment(client, auth_headers)
+
+    def slow(key, src_path, size, timeout=None):
+        raise TimeoutError()
+
+    monkeypatch.setattr(thumbnails, "get_thumbnail", slow)
+    r = client.get(f"/attachments/{attachment_id}/thumbnail?size=1024", headers=auth_headers)
+    assert r.status_code == 503
+    assert r.headers["retry-after"]
+
+
+def test_failed_keys_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbnails, "MAX_FAILED", 2)
+    monkeypatch.setattr(thumbnails, "_failed", type(thumbnails._failed)())
+    monkeypatch.setattr(thumbnails, "_render", lambda src, dest, size: False)
+
+    src = tmp_path / "broken.png"
+    src.write_bytes(b"not an image")
+    for key in ("k1", "k2", "k3"):
+        assert thumbnails._generate(key, str(src), 256) is None
+
+    assert list(thumbnails._failed) == ["k2", "k3"]
+
+
+def test_stats_include_thumbnails(client, auth_headers):
+    r = client.get("/maintenance/stats", headers=auth_headers)
+    assert "generated" in r.json()["thumbnails"]
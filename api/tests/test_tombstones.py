@@ -0,0 +1,121 @@
+import hashlib
+import uuid
+
+from src.database import get_connection
+from src.services import tombstones
+from src.utils import note_hashes
+
+
+def _add_tombstone(deleted_at):
+    note_hash = uuid.uuid4().hex
+    with get_connection() as conn:
+        conn.execute(
+            "INSERT INTO note_tombstones (user_id, note_hash, deleted_at) VALUES (1, ?, ?)",
+            (note_hash, deleted_at),
+        )
+    return note_hash
+
+
+def _exists(note_hash):
+    with get_connection(readonly=True) as conn:
+        cur = conn.execute("SELECT EXISTS(SELECT 1 FROM note_tombstones WHERE note_hash=?)", (note_hash,))
+        return bool(cur.fetchone()[0])
+
+
+def test_tombstones_are_kept_forever_by_default(client):
+    assert tombstones.RETENTION_DAYS == 0
+
+    note_hash = _add_tombstone("2000-01-01T00:00:00+00:00")
+    with get_connection() as conn:
+        tombstones.compact_tombstones(conn.cursor())
+
+    assert _exists(note_hash)
+
+
+def test_retention_days_is_opt_in(client, monkeypatch):
+    monkeypatch.setattr(tombstones, "RETENTION_DAYS", 30)
+
+    old = _add_tombstone("2000-01-01T00:00:00+00:00")
+    recent = _add_tombstone("2999-01-01T00:00:00+00:00")
+    with get_connection() as conn:
+        tombstones.compact_tombstones(conn.cursor())
+
+    assert not _exists(old)
+    assert _exists(recent)
+
+
+def _user_id(username):
+    with get_connection(readonly=True) as conn:
+        return conn.execute("SELECT id FROM users WHERE username=?", (username,)).fetchone()[0]
+
+
+def _tombstone_exists(user_id, title, content):
+    with get_connection() as conn:
+        return tombstones.note_tombstone_exists(conn.cursor(), user_id, *note_hashes(title, content))
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = tombstones._BloomFilter(1000, 0.01)
+    fingerprints = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(1000)]
+    for fingerprint in fingerprints:
+        bloom.add(fingerprint)
+
+    assert all(fingerprint in bloom for fingerprint in fingerprints)
+
+    others = [hashlib.sha256(f"other {i}".encode()).hexdigest() for i in range(10000)]
+    false_positives = sum(fingerprint in bloom for fingerprint in others)
+    assert false_positives < 10000 * 0.01 * 2
+
+
+def test_tombstones_added_after_load_are_found(client, other_headers):
+    user_id = _user_id("other")
+
+    # 先にフィルタを読み込んでおき、その後の墓標が読み込み済みのフィルタに入ることを確かめる
+    assert not _tombstone_exists(user_id, "bloom", uuid.uuid4().hex)
+    loaded = tombstones.stats["filters_loaded"]
+
+    contents = [uuid.uuid4().hex for _ in range(50)]
+    for content in contents:
+        r = client.post("/notes", json={"title": "bloom", "content": content}, headers=other_headers)
+        assert r.status_code == 200, r.text
+        r = client.post(f"/notes/{r.json()['id']}/tags", json={"name": "trash"}, headers=other_headers)
+        assert r.status_code == 200, r.text
+
+    assert tombstones.stats["filters_loaded"] == loaded
+    for content in contents:
+        assert _tombstone_exists(user_id, "bloom", content)
+        # 題名が違っても本文の指紋で見つかる
+        assert _tombstone_exists(user_id, "other title", content)
+
+    r = client.post("/notes", json={"title": "bloom", "content": contents[0]}, headers=other_headers)
+    assert r.status_code == 409
+
+    # ゴミ箱を空にしても墓標は残る
+    r = client.delete("/trash", headers=other_headers)
+    assert r.status_code == 200, r.text
+    assert _tombstone_exists(user_id, "bloom", contents[0])
+
+
+def test_compaction_rebuilds_filter(client, monkeypatch):
+    monkeypatch.setattr(tombstones, "RETENTION_DAYS", 30)
+    user_id = _user_id("admin")
+
+    title, content = "compacted", uuid.uuid4().hex
+    note_hash, content_hash = note_hashes(title, content)
+    with get_connection() as conn:
+        conn.execute(
+            "INSERT INTO note_tombstones (user_id, note_hash, content_hash, deleted_at) VALUES (?, ?, ?, ?)",
+            (user_id, note_hash, content_hash, "2000-01-01T00:00:00+00:00"),
+        )
+    assert _tombstone_exists(user_id, title, content)
+    old_filter = tombstones._filters[user_id]
+
+    with get_connection() as conn:
+        assert tombstones.compact_tombstones(conn.cursor()) >= 1
+    assert user_id not in tombstones._filters
+
+    # 次の確認で墓標から作り直し、消した墓標は見つからない
+    loaded = tombstones.stats["filters_loaded"]
+    assert not _tombstone_exists(user_id, title, content)
+    assert tombstones.stats["filters_loaded"] == loaded + 1
+    assert tombstones._filters[user_id] is not old_filter
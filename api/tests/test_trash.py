@@ -0,0 +1,46 @@
+import sqlite3
+
+from src.database import get_connection
+from src.utils import note_hashes
+
+N_NOTES = 1200
+
+
+def _user_id(username):
+    with get_connection(readonly=True) as conn:
+        return conn.execute("SELECT id FROM users WHERE username=?", (username,)).fetchone()[0]
+
+
+def test_empty_large_trash(client, other_headers):
+    user_id = _user_id("other")
+    ts = "2025-01-01T00:00:00+00:00"
+
+    with get_connection() as conn:
+        conn.executemany(
+            """
+            INSERT INTO notes (user_id, title, content, note_hash, content_hash, created_at, updated_at, trashed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (user_id, f"trash {i}", "x", *note_hashes(f"trash {i}", "x"), ts, ts, ts)
+                for i in range(N_NOTES)
+            ],
+        )
+        # 古い SQLite と同じ変数の上限 (999) にして、IN (...) を分けていることを確かめる
+        previous = conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+
+    try:
+        r = client.delete("/trash", headers=other_headers)
+    finally:
+        with get_connection() as conn:
+            conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, previous)
+
+    assert r.status_code == 200, r.text
+    assert r.json()["deleted"] == N_NOTES
+
+    with get_connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM notes WHERE user_id=? AND trashed_at IS NOT NULL", (user_id,))
+        assert cur.fetchone()[0] == 0
+        cur.execute("SELECT COUNT(*) FROM note_tombstones WHERE user_id=? AND deleted_at > ?", (user_id, ts))
+        assert cur.fetchone()[0] >= N_NOTES
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+from starlette.requests import ClientDisconnect
+
+from src.config import get_config
+from src.services import upload
+
+BOUNDARY = "simplynote-test-boundary"
+MB = 1024 * 1024
+
+
+def _note(client, headers):
+    r = client.post("/notes", json={"title": "upload", "content": uuid.uuid4().hex}, headers=headers)
+    assert r.status_code == 200, r.text
+    return r.json()["id"]
+
+
+def _multipart(data, filename="a.bin"):
+    head = (
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    return head, data, f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def _chunks(parts, size=64 * 1024):
+    for part in parts:
+        for i in range(0, len(part), size):
+            yield part[i:i + size]
+
+
+def _temp_files():
+    upload_dir = get_config()["upload"]["dir"]
+    return [name for name in os.listdir(upload_dir) if name.startswith(upload.TEMP_PREFIX)]
+
+
+@pytest.fixture
+def small_limit(monkeypatch):
+    monkeypatch.setitem(get_config()["upload"], "max_size_mb", 1)
+
+
+@pytest.fixture
+def writers(monkeypatch):
+    """作られた一時ファイルの書き込みを記録する"""
+    created = []
+    temp_writer = upload._TempWriter
+
+    def recording_writer(*args, **kwargs):
+        writer = temp_writer(*args, **kwargs)
+        created.append(writer)
+        return writer
+
+    monkeypatch.setattr(upload, "_TempWriter", recording_writer)
+    return created
+
+
+def _post(client, headers, note_id, content, **extra_headers):
+    return client.post(
+        f"/notes/{note_id}/attachments",
+        content=content,
+        headers={**headers, "Content-Type": f"multipart/form-data; boundary={BOUNDARY}", **extra_headers},
+    )
+
+
+def test_content_length_over_limit_is_rejected_before_reading(client, auth_headers, small_limit, writers):
+    note_id = _note(client, auth_headers)
+    body = b"".join(_multipart(b"x" * (2 * MB)))
+
+    r = _post(client, auth_headers, note_id, body)
+    assert r.status_code == 413
+    assert "1MB" in r.json()["detail"]
+    # 本文を読む前 (一時ファイルを作る前) に断っている
+    assert writers == []
+
+
+def test_streamed_body_over_limit_is_rejected(client, auth_headers, small_limit, writers):
+    note_id = _note(client, auth_headers)
+
+    # Content-Length の無い chunked の本文は、書き込み中に上限を超えた時点で断る
+    r = _post(client, auth_headers, note_id, _chunks(_multipart(b"x" * (2 * MB))))
+    assert r.status_code == 413
+    assert "1MB" in r.json()["detail"]
+    assert len(writers) == 1
+    assert _temp_files() == []
+
+
+def test_body_within_limit_is_stored(client, auth_headers, small_limit):
+    note_id = _note(client, auth_headers)
+    data = uuid.uuid4().bytes * (MB // 16)
+
+    r = _post(client, auth_headers, note_id, _chunks(_multipart(data)))
+    assert r.status_code == 200, r.text
+    assert r.json()["size"] == MB
+    assert _temp_files() == []
+
+
+class _Request:
+    """本文を少しずつ返すリクエスト (disconnect=True なら最後に接続が切れる)"""
+
+    def __init__(self, chunks, disconnect=False):
+        self.headers = {"content-type": f"multipart/form-data; boundary={BOUNDARY}"}
+        self.chunks = chunks
+        self.disconnect = disconnect
+        self.consumed = 0
+
+    async def stream(self):
+        for chunk in self.chunks:
+            self.consumed += 1
+            yield chunk
+        if self.disconnect:
+            raise ClientDisconnect()
+
+
+def _receive(request, max_bytes):
+    upload_dir = get_config()["upload"]["dir"]
+    return asyncio.run(upload.receive_upload(request, "file", upload_dir, max_bytes))
+
+
+def test_streaming_stops_reading_at_limit(client, writers):
+    request = _Request(list(_chunks(_multipart(b"x" * (4 * MB)))))
+
+    with pytest.raises(upload.UploadError) as e:
+        _receive(request, MB)
+
+    assert e.value.status_code == 413
+    # 上限を超えたチャンクで止め、残りの本文は読まない
+    assert request.consumed < len(request.chunks) // 2
+    assert writers[0].size <= MB + 64 * 1024
+    assert not os.path.exists(writers[0].path)
+    assert _temp_files() == []
+
+
+def test_temp_file_is_removed_on_abort(client, writers):
+    head, data, _ = _multipart(b"x" * MB)
+    request = _Request(list(_chunks([head, data])), disconnect=True)
+
+    with pytest.raises(ClientDisconnect):
+        _receive(request, 2 * MB)
+
+    assert len(writers) == 1
+    assert writers[0].size == MB
+    assert not os.path.exists(writers[0].path)
+    assert _temp_files() == []
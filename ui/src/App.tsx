@@ -6,6 +6,9 @@ import type { Note, Tag, Attachment } from "./dataSource";
 import { basePath } from "./utils"
 import { msUntilDriveTokenExpiry, hasDriveRefreshToken, clearDriveToken } from "./drive/driveAuth"
 
+// プレビューでサーバのサムネイルを使う画像 (GIF・SVG は元のファイルを表示する)
+const THUMBNAIL_FILE_RE = /\.(png|jpe?g|webp)$/i;
+
 export default function App() {
   const { t, i18n } = useTranslation();
 
@@ -21,6 +24,7 @@ export default function App() {
   const [attachments, setAttachments] = useState<Attachment[]>([]);
   const [draftFiles, setDraftFiles] = useState<File[]>([]);
   const [previewFile, setPreviewFile] = useState<any | null>(null);
+  const [previewUrls, setPreviewUrls] = useState<{ file: string; image: string } | null>(null);  // プレビュー用の署名付きURL
 
   const [tags, setTags] = useState<string[]>([]);
   const [newTagInput, setNewTagInput] = useState("");
@@ -844,6 +848,28 @@ export default function App() {
 
   }, []);
 
+  // プレビューする添付のURL (ダウンロード用トークンを取得してから表示)
+  useEffect(() => {
+
+    setPreviewUrls(null);
+    if (!previewFile) return;
+
+    let cancelled = false;
+    const fileUrl = previewFile.download_url ?? previewFile.url;
+    // サーバで縮小できる静止画だけサムネイルを使う (GIF はアニメーションが止まるので元のファイル)
+    const useThumbnail = !!previewFile.download_url && THUMBNAIL_FILE_RE.test(previewFile.filename);
+    const suffixes = useThumbnail ? ["", "/thumbnail?size=1024"] : [""];
+
+    ds.resolveAttachmentUrls(fileUrl, suffixes)
+      .then(([file, image]) => {
+        if (!cancelled) setPreviewUrls({ file, image: image ?? file });
+      })
+      .catch((err) => console.error("Failed to resolve attachment url", err));
+
+    return () => { cancelled = true; };
+
+  }, [previewFile]);
+
   // タブがフォーカスされた時に自動リフレッシュ
   useEffect(() => {
 
@@ -1539,15 +1565,19 @@ export default function App() {
               {previewFile.filename}
             </h3>
 
-            {previewFile.filename.match(/\.(png|jpe?g|gif|webp)$/i) ? (
+            {!previewUrls ? null : previewFile.filename.match(/\.(png|jpe?g|gif|webp)$/i) ? (
               <img
-                src={ds.resolveAttachmentUrl(previewFile.url)}
+                src={previewUrls.image}
                 alt={previewFile.filename}
+                // サムネイルが無い (Pillow 無し・無効・作れない画像) ときは元のファイルを表示
+                onError={() => setPreviewUrls((urls) =>
+                  urls && urls.image !== urls.file ? { ...urls, image: urls.file } : urls
+                )}
                 className="max-w-full max-h-[70vh] object-contain mx-auto"
               />
             ) : previewFile.filename.match(/\.(pdf)$/i) ? (
               <iframe
-                src={ds.resolveAttachmentUrl(previewFile.url)}
+                src={previewUrls.file}
                 className="w-full h-[70vh]"
                 title={previewFile.filename}
               />
@@ -1557,7 +1587,7 @@ export default function App() {
                   Preview is not available for this file.
                 </p>
                 <a
-                  href={ds.resolveAttachmentUrl(previewFile.url)}
+                  href={previewUrls.file}
                   target="_blank"
                   className="text-blue-600 underline" >
 
@@ -35,6 +35,7 @@ export interface Attachment {
   id: number;
   filename: string;
   url: string;
+  download_url?: string;
 }
 
 export interface Tag {
@@ -82,8 +83,9 @@ export interface NotesRepository {
   // ゴミ箱
   emptyTrash(): Promise<{ deleted: number }>;
 
-  // 添付ファイルURL解決
-  resolveAttachmentUrl(storedUrl: string): string;
+  // 添付ファイルURL解決 (<img> / <iframe> / リンクに使う)
+  // suffixes は同じ添付の派生URL (例: "/thumbnail?size=1024")。1回の解決でまとめて返す
+  resolveAttachmentUrls(storedUrl: string, suffixes?: string[]): Promise<string[]>;
 }
 
 // ============================================================
@@ -287,8 +289,26 @@ export class ApiDataSource implements NotesRepository {
     return res.json();
   }
 
-  resolveAttachmentUrl(storedUrl: string): string {
-    return apiUrl(storedUrl);
+  async resolveAttachmentUrls(storedUrl: string, suffixes: string[] = [""]): Promise<string[]> {
+    // 認証付きのダウンロード (<img> などはヘッダを付けられないので、その添付だけに使える短時間のトークンをクエリで渡す)
+    // 本体とサムネイルは同じ添付なので、トークンは1つで済ませる
+    const match = storedUrl.match(/^\/attachments\/(\d+)$/);
+    if (!match) return suffixes.map((suffix) => apiUrl(`${storedUrl}${suffix}`));
+
+    const token = this.getToken();
+    const res = await fetch(apiUrl(`/attachments/${match[1]}/download-token`), {
+      method: "POST",
+      headers: { Authorization: `Bearer ${token}` },
+    });
+    if (res.status === 401) throw new Error("unauthorized");
+    if (!res.ok) throw new Error("download_token_error");
+    const { token: dl } = await res.json();
+
+    return suffixes.map((suffix) => {
+      const url = `${storedUrl}${suffix}`;
+      const sep = url.includes("?") ? "&" : "?";
+      return apiUrl(`${url}${sep}dl=${encodeURIComponent(dl)}`);
+    });
   }
 }
 
@@ -842,9 +862,9 @@ export class DriveDataSource implements NotesRepository {
     return { deleted };
   }
 
-  resolveAttachmentUrl(storedUrl: string): string {
-    // Drive APIでダウンロードするURLを返す
-    return `https://drive.google.com/file/d/${storedUrl}/view?usp=drivesdk`;
+  async resolveAttachmentUrls(storedUrl: string, suffixes: string[] = [""]): Promise<string[]> {
+    // Drive APIでダウンロードするURLを返す (サムネイルは無いので全て同じURL)
+    return suffixes.map(() => `https://drive.google.com/file/d/${storedUrl}/view?usp=drivesdk`);
   }
 }
 